@@ -0,0 +1,164 @@
+import asyncio
+import time
+from collections import deque
+
+from prom_metrics import REGISTRY
+
+ACTION_RATE = 3 / 5 #actions of each kind started per second, the old MAX_ACTIONS per 5 second tick
+ACTION_BURST = 3
+CONFIRM_SECONDS = 120 #how long an accepted start/stop/destroy may take to show up in the instance list before it can be retried
+
+SCALE_ACTIONS = REGISTRY.counter("autoscaler_scale_actions_total", "Instances the autoscaler tried to start, stop, create or destroy", ["action", "outcome"])
+PENDING_ACTIONS = REGISTRY.gauge("autoscaler_pending_actions", "Scale actions queued, running or waiting to show up in the instance list", ["action", "state"])
+
+#what the instance list should show once an accepted action has taken effect
+def confirmed(action, instance):
+	if action == "start_instance":
+		return instance is not None and instance["intended_status"] == "running"
+	if action == "stop_instance":
+		return instance is not None and instance["intended_status"] == "stopped"
+	if action == "destroy_instance":
+		return instance is None
+	return True
+
+class Action:
+	def __init__(self, name, target_id, fn, args):
+		self.name = name
+		self.target_id = target_id #instance id, or ask id for creates
+		self.fn = fn
+		self.args = args
+		self.state = "queued" #then running, then confirming (start/stop/destroy that succeeded) until reconcile sees it
+		self.finished_at = None
+
+#Carries out the autoscaler's scale actions in the background, so deciding what to do never waits on the Vast API.
+#Lives on the tick engine's event loop and is only touched from it, so it needs no lock. Each instance has at most one
+#action queued, running or not yet visible in the instance list, so a decision repeated on the next tick (because the
+#instance list hasn't caught up) isn't sent twice. Each kind of action is rate limited, and reconcile() checks accepted
+#actions against every new instance list.
+class ActionExecutor:
+	def __init__(self, engine, rate=ACTION_RATE, burst=ACTION_BURST, confirm_seconds=CONFIRM_SECONDS, clock=time.time):
+		self.engine = engine
+		self.rate = rate
+		self.burst = burst
+		self.confirm_seconds = confirm_seconds
+		self.clock = clock
+		self.actions = {} #target id -> Action
+		self.queue = deque()
+		self.allowance = {} #action name -> (actions that may start now, when that was computed)
+		self.wakeup = None #created on the loop's own thread
+		self.stopped = False
+		PENDING_ACTIONS.set_function(self.pending_counts)
+
+	def pending(self, target_id):
+		return target_id in self.actions
+
+	def num_pending(self, name):
+		return sum(1 for action in self.actions.values() if action.name == name)
+
+	def pending_counts(self):
+		counts = {}
+		for action in list(self.actions.values()):
+			counts[(action.name, action.state)] = counts.get((action.name, action.state), 0) + 1
+		return counts
+
+	def submit(self, fn, target_id, *args):
+		#returns False if the target already has an action on its way
+		if target_id in self.actions:
+			return False
+		action = Action(fn.__name__, target_id, fn, args)
+		self.actions[target_id] = action
+		self.queue.append(action)
+		self.wake()
+		return True
+
+	def cancel_queued(self, name):
+		#drops actions of this kind that haven't started, e.g. queued stops once the strategy wants to start instances again
+		cancelled = [action for action in self.queue if action.name == name]
+		for action in cancelled:
+			self.queue.remove(action)
+			del self.actions[action.target_id]
+			SCALE_ACTIONS.labels(name, "cancelled").inc()
+		return len(cancelled)
+
+	def reconcile(self, instances):
+		#instances is the latest id -> instance map from the Vast API
+		now = self.clock()
+		for target_id, action in list(self.actions.items()):
+			if action.state != "confirming":
+				continue
+			if confirmed(action.name, instances.get(target_id)):
+				del self.actions[target_id]
+				SCALE_ACTIONS.labels(action.name, "confirmed").inc()
+			elif now - action.finished_at > self.confirm_seconds:
+				del self.actions[target_id]
+				SCALE_ACTIONS.labels(action.name, "unconfirmed").inc()
+				print(f"[actions] {action.name} on {target_id} was accepted but hasn't shown up after {self.confirm_seconds}s")
+
+	def take_allowance(self, name, now):
+		allowance, last = self.allowance.get(name, (self.burst, now))
+		allowance = min(self.burst, allowance + (now - last) * self.rate)
+		if allowance < 1:
+			self.allowance[name] = (allowance, now)
+			return False
+		self.allowance[name] = (allowance - 1, now)
+		return True
+
+	def wake(self):
+		if self.wakeup is not None:
+			self.engine.loop.call_soon_threadsafe(self.wakeup.set)
+
+	def take_due(self, now):
+		#queued actions that the rate limit lets start now, marked as running
+		started = []
+		for action in list(self.queue):
+			if self.take_allowance(action.name, now):
+				self.queue.remove(action)
+				action.state = "running"
+				started.append(action)
+		return started
+
+	async def execute(self, action):
+		try:
+			result = await self.engine.run_bounded(action.fn, *action.args)
+		except Exception as e:
+			print(f"[actions] {action.name} on {action.target_id} failed: {e}")
+			result = None
+		self.finish(action, result)
+
+	def run_due(self):
+		#runs the actions that may start now one after another on the caller's thread, for the discrete-event sim, which
+		#has no event loop and whose fake cloud answers instantly
+		for action in self.take_due(self.clock()):
+			try:
+				result = action.fn(*action.args)
+			except Exception as e:
+				print(f"[actions] {action.name} on {action.target_id} failed: {e}")
+				result = None
+			self.finish(action, result)
+
+	def finish(self, action, result):
+		action.finished_at = self.clock()
+		if result and action.name in ("start_instance", "stop_instance", "destroy_instance"):
+			action.state = "confirming"
+			SCALE_ACTIONS.labels(action.name, "ok").inc()
+			return
+		del self.actions[action.target_id]
+		SCALE_ACTIONS.labels(action.name, "ok" if result else "failed").inc()
+		if not result:
+			print(f"[actions] {action.name} on {action.target_id} failed")
+
+	async def run(self):
+		self.wakeup = asyncio.Event()
+		while not self.stopped:
+			for action in self.take_due(self.clock()):
+				asyncio.ensure_future(self.execute(action))
+			timeout = None if len(self.queue) == 0 else 1 / self.rate
+			try:
+				await asyncio.wait_for(self.wakeup.wait(), timeout)
+			except asyncio.TimeoutError:
+				pass
+			self.wakeup.clear()
+
+	def stop(self):
+		self.stopped = True
+		self.wake()
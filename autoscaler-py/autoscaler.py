@@ -1,57 +1,100 @@
-import subprocess
-from threading import Thread, Lock, Event
-from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Event
+import asyncio
 import time
 import re
 import json
 import secrets
 import os
-from ratio_manager import update_rolling_average
-from prompt_OOBA import send_vllm_request_auth, send_vllm_request_streaming_test_auth
+from prompt_OOBA import send_vllm_request_auth, send_vllm_request_streaming_test_auth, TEST_TIMEOUT
+from vast_api import VastClient, parse_env
+from ssh_pool import SSHPool, SSH_KEY_FILE
+from tick_engine import TickEngine
+from offer_cache import OfferCache
+from instance_store import InstanceStore
+from probe_scheduler import ProbeScheduler, EXPECTED_LOAD_SECONDS, DEFAULT_LOAD_SECONDS, WARM_LOAD_SECONDS
+from strategy import SimpleStrategy, STRATEGIES
+from prom_metrics import REGISTRY
+from action_executor import ActionExecutor, SCALE_ACTIONS
+from state_snapshot import SnapshotPublisher, hot_projection
+from machine_perf import MachinePerf
+from benchmark import run_benchmark, judge
 
 TIME_INTERVAL_SECONDS = 5
 MAX_COST_PER_HOUR = 10.0
 MAX_CONCURRENCY = 100
 MAX_ACTIONS = 3
+API_DEADLINE = 20 #per-operation deadlines (seconds) for the tick engine, calls that miss them are picked up on the next tick
+PROBE_DEADLINE = 15
+ACTION_DEADLINE = 30
 INSTANCE_CONFIG_NAME = "configs/OOBA_configs.json"
 IGNORE_INSTANCE_IDS = [6924410, 6924411, 6925426, 6924389, 6924390, 6924720] # 6925427
 BAD_MACHINE_IDS = [4424]
-ERROR_STRINGS = ["safetensors_rust.SafetensorError", "RuntimeError", "Error: remote port forwarding failed"]
 TEST_PROMPT = "What?"
+HEARTBEAT_TIMEOUT = 30 #seconds after which a model server that stopped reporting falls back to ssh probing
+AUTOSCALER_PUBLIC_ADDR = os.environ.get("AUTOSCALER_PUBLIC_ADDR") #where model servers on new instances should post heartbeats
+START_BOOT_SECONDS = 60 #rough time for a stopped instance to be running again, before its model loads
+CREATE_BOOT_SECONDS = 10 * 60 #and for a new instance, which has to pull the image first
+PERF_RECORD_SECONDS = 60 #how often throughput measured by the loadbalancer is saved to the machine performance database
+MAX_CONCURRENT_BENCHMARKS = 10 #newly hot instances benchmarked at once, the rest wait their turn
+MAX_BENCHMARK_ATTEMPTS = 3 #benchmarks that fail outright are retried, an instance that never gets through one is rejected
+
+TICK_SECONDS = REGISTRY.histogram("autoscaler_tick_seconds", "Autoscaler tick time, in total and for each phase (update_instance_info excludes update_hot_instances)", ["phase"])
+PROBE_SECONDS = REGISTRY.histogram("autoscaler_probe_seconds", "ssh check plus test prompt for instances that don't post heartbeats", ["outcome"])
+TEST_PROMPT_SECONDS = REGISTRY.histogram("autoscaler_test_prompt_seconds", "Test prompts sent to instances that look hot", ["outcome"])
+HEARTBEATS = REGISTRY.counter("autoscaler_heartbeats_total", "Heartbeats posted by model servers", ["outcome"])
+INSTANCES = REGISTRY.gauge("autoscaler_instances", "Instances in each state", ["state"])
+REPORTED_LOAD = REGISTRY.gauge("autoscaler_reported_load", "Load last reported by the loadbalancer", ["metric"])
+BENCHMARKS = REGISTRY.counter("autoscaler_benchmarks_total", "Benchmarks of newly hot instances, by verdict", ["verdict"])
+BENCHMARK_SECONDS = REGISTRY.histogram("autoscaler_benchmark_seconds", "Time to run the benchmark workload on a newly hot instance")
+COST_PER_HOUR = REGISTRY.gauge("autoscaler_cost_per_hour", "Dollars per hour of the instances that are running or loading")
 
 ####################################### INSTANCE ACCESS HELPERS #######################################
-def get_curr_instances():
-	result = subprocess.run(["vastai", "show", "instances", "--raw"], capture_output=True)
-	instance_info = result.stdout.decode('utf-8')
-	if instance_info:
-		try:
-			curr_instances = json.loads(instance_info)
-		except json.decoder.JSONDecodeError:
-			curr_instances = None
-	else:
-		curr_instances = None
-
-	return curr_instances
-
-#could be called on the output from 'show instance' or 'search offers'
-def tps(instance):
-	# print(instance['machine_id'])
-	if "tokens/s" in instance.keys():
-		return instance["tokens/s"]
-	# filepath = f"instance_info/{instance['machine_id']}.json"
-	# if os.path.exists(filepath):
-	# 	with open(filepath, "r") as f:
-	# 		instance_log = json.load(f)
-	# 		if "tokens/s" in instance_log.keys():
-	# 			return instance_log["tokens/s"]
-	return 0.0
-
-def expected_performance(instance): #could be made more sophisticated, change to cost per token
-	return float(instance['dlperf_per_dphtotal']) if instance['dlperf_per_dphtotal'] is not None else 0
+vast_client = None
+
+def get_vast_client():
+	global vast_client
+	if vast_client is None:
+		vast_client = VastClient()
+	return vast_client
+
+def get_curr_instances(client=None):
+	if client is None:
+		client = get_vast_client()
+	return client.show_instances()
 
 def get_instance_id(instance):
 	return instance["id"]
 
+def diff_instances(prev_instances, curr_instances): #both are id -> instance maps
+	added = [id for id in curr_instances.keys() if id not in prev_instances]
+	removed = [id for id in prev_instances.keys() if id not in curr_instances]
+	changed = [id for id, instance in curr_instances.items() if id in prev_instances and prev_instances[id] != instance]
+	return added, removed, changed
+
+def classify_instance(instance):
+	#"bad", "running", "loading", "cold" or None for a status we don't know, from an instance dict from the vast api
+	if (instance['actual_status'] == 'offline') or (instance['status_msg'] is not None and 'Error response from daemon' in instance['status_msg']) or (instance['machine_id'] in BAD_MACHINE_IDS):
+		return "bad"
+	if instance['actual_status'] == 'running':
+		return "running"
+	if instance['actual_status'] == 'loading' or instance['actual_status'] == None or (instance['actual_status'] == 'created' and instance['intended_status'] == 'running'):
+		return "loading"
+	if (instance['actual_status'] == 'created' and instance['intended_status'] == 'stopped') or instance['actual_status'] == 'stopping' or instance['actual_status'] == 'exited':
+		return "cold"
+	return None
+
+def handle_heartbeat(autoscaler, data):
+	#what every /heartbeat route answers, as (text, status). data is the parsed request body, None if it wasn't json.
+	if autoscaler is None:
+		return "InstanceSet hasn't been initialized", 503
+	if not isinstance(data, dict):
+		return "Expected a json object", 400
+	if "id" not in data:
+		return "Missing instance id", 400
+	if not autoscaler.report_heartbeat(data["id"], data.get("mtoken"), data.get("model_loaded", False), tps=data.get("tps"), queue_depth=data.get("queue_depth")):
+		return "Unknown instance id or bad master token", 401
+	return "Recorded heartbeat", 200
+
 def get_model_address(instance, streaming):
 	if streaming:
 		addr = instance["public_ipaddr"] + ":" + instance["ports"]["5005/tcp"][0]["HostPort"]
@@ -61,21 +104,6 @@ def get_model_address(instance, streaming):
 	return addr
 
 ####################################### MAIN CLASSES ##################################################
-class SimpleStrategy:
-	def __init__(self, avg_num_hot=0):
-		self.start_num_hot = 10
-
-		self.target_hot_busy_ratio_upper = 0.9
-		self.target_hot_busy_ratio_lower = 0.6
-		self.target_hot_ratio = 0.3
-
-		self.avg_num_busy = 0
-		self.avg_num_hot = avg_num_hot
-
-		self.avg_requests_per_second = 0 #should start using this soon
-
-		# self.price_limit = 0.3
-
 class InstanceSetMetrics: #Represents metrics that the client would have available to them, not the backend autoscaler
 	def __init__(self):
 		self.num_requests_started = 0
@@ -91,89 +119,288 @@ class InstanceSetMetrics: #Represents metrics that the client would have availab
 		ret = time.time() - self.session_start_time
 		return ret
 
-class InstanceSet:
-	def __init__(self, manage=False, streaming=False, model="vllm-13"):
+#State and decisions shared by InstanceSet and the discrete-event sim's SimInstanceSet (sim_des.py), so that what the sim
+#measures is what the autoscaler does: the load the loadbalancer reports, the snapshot the strategy decides on and how its
+#decision becomes queued actions. Subclasses keep the instance maps up to date and provide start_instance, stop_instance,
+#create_instance and destroy_instance for the actions.
+class InstanceSetBase:
+	def __init__(self, model, manage, instance_info_map, perf, actions, probes):
+		self.model = model
+		self.manage = manage
+		self.instance_info_map = instance_info_map #instance id -> what we know of it that the vast api doesn't say, see InstanceStore
+		self.perf = perf #MachinePerf
+		self.actions = actions #ActionExecutor
+		self.probes = probes #ProbeScheduler
+
 		self.num_hot = 0
 		self.num_busy = 0
+		self.num_in_flight = 0 #requests the load balancer has handed out that haven't finished yet
+		self.queue_depth = 0 #tokens of work those requests still represent
+		self.instance_load = {} #hot instance id -> its unfinished requests
+		self.instance_perf = {} #hot instance id -> tokens/s and time to first token measured by the load balancer
+		self.hot_perf = {} #and the other way: hot instance id -> tokens/s its model server reports and tokens/s we expect of it
+		self.request_rate = None #requests and tokens per second asked of the load balancer
+		self.token_rate = None
+		self.capacity = None #tokens/s the hot instances can serve, as estimated by the load balancer
+
+		#all of these map instance id -> latest instance dict from the vast api
+		self.instances = {}
+		self.hot_instances = {}
+		self.running_instances = {}
+		self.loading_instances = {}
+		self.cold_instances = {} #assumption is that all cold instances are available to be started
+		self.running_since = {} #instance id -> when we first saw it running, or roughly when it started for ones already running at startup
+		self.rejected_instance_ids = set() #current instances benchmarked far below the norm for their gpus, never sent traffic
+		self.ignore_instance_ids = []
+
+	def make_strategy(self, strategy):
+		#once the instance maps have been filled in
+		if strategy == "simple":
+			return SimpleStrategy(avg_num_hot=len(self.running_instances) + len(self.loading_instances) + len(self.cold_instances))
+		return STRATEGIES[strategy](model=self.model)
 
-		self.hot_instances = []
-		self.running_instances = []
-		self.loading_instances = []
-		self.cold_instances = [] #assumption is that all cold instances are available to be started
+	#call below with lock LOCKED
+	def report_load(self, num_in_flight, queue_depth, instance_load, request_rate=None, token_rate=None, capacity=None, instance_perf=None):
+		if num_in_flight is not None:
+			self.num_in_flight = num_in_flight
+		if queue_depth is not None:
+			self.queue_depth = queue_depth
+		if instance_load is not None:
+			self.instance_load = {int(id) : n for id, n in instance_load.items()}
+		if request_rate is not None:
+			self.request_rate = request_rate
+		if token_rate is not None:
+			self.token_rate = token_rate
+		if capacity is not None:
+			self.capacity = capacity
+		if instance_perf is not None:
+			self.instance_perf = {int(id) : perf for id, perf in instance_perf.items()}
+
+	def expected_load_seconds(self, instance_id):
+		if self.instance_info_map[instance_id].get("model_loaded") is not None:
+			return WARM_LOAD_SECONDS
+		return self.perf.time_to_hot(self.instances[instance_id]["machine_id"])
 
-		self.instance_info_map = {}
+	#call below with lock LOCKED
+	def metrics_snapshot(self, now=None):
+		#everything a strategy gets to decide on, including how long each not-yet-hot instance should take to become hot
+		now = now if now is not None else time.time()
+		default_load_seconds = self.probes.expected_load_seconds
+		def load_seconds(id):
+			expected = self.expected_load_seconds(id)
+			return expected if expected is not None else default_load_seconds
+		model_loading_ids = [id for id in self.running_instances.keys() if id not in self.hot_instances and id not in self.rejected_instance_ids]
+		loading_time_to_hot = [max(0, load_seconds(id) - (now - self.running_since.get(id, now))) for id in model_loading_ids]
+		loading_time_to_hot += [CREATE_BOOT_SECONDS + load_seconds(id) for id in self.loading_instances.keys()]
+		return {
+			"time" : now,
+			"interval" : TIME_INTERVAL_SECONDS,
+			"num_hot" : self.num_hot,
+			"num_busy" : self.num_busy,
+			"num_in_flight" : self.num_in_flight,
+			"queue_depth" : self.queue_depth,
+			"request_rate" : self.request_rate,
+			"token_rate" : self.token_rate,
+			"capacity" : self.capacity,
+			"num_model_loading" : len(self.running_instances) - self.num_hot,
+			"num_image_loading" : len(self.loading_instances),
+			"num_cold" : len(self.cold_instances),
+			"cold_time_to_hot" : [START_BOOT_SECONDS + load_seconds(id) for id in self.cold_instances.keys()],
+			"loading_time_to_hot" : loading_time_to_hot,
+			"start_seconds" : START_BOOT_SECONDS + WARM_LOAD_SECONDS,
+			"create_seconds" : CREATE_BOOT_SECONDS + default_load_seconds,
+		}
+
+	def queue_decision(self, decision, running_instances, cold_instances, instance_load, ask_list=None):
+		#turns the strategy's decision into queued actions. ask_list is the ranked offers to create from, or None if they
+		#couldn't be fetched.
+		if decision["stop"] > 0:
+			self.actions.cancel_queued(self.start_instance.__name__)
+			#the instances with the fewest requests in flight first, and of those the most expensive per token
+			running_instances = sorted(running_instances, key=self.perf.cost_per_1k_tokens, reverse=True)
+			running_instances = sorted(running_instances, key=lambda instance: instance_load.get(instance["id"], 0))
+			self.queue_actions(self.stop_instance, decision["stop"], running_instances)
+		elif decision["start"] > 0:
+			self.actions.cancel_queued(self.stop_instance.__name__)
+			self.queue_actions(self.start_instance, decision["start"], sorted(cold_instances, key=self.perf.cost_per_1k_tokens)) #cheapest per token first
+
+		if decision["create"] > 0:
+			self.actions.cancel_queued(self.destroy_instance.__name__)
+			if ask_list is not None:
+				self.queue_actions(self.create_instance, decision["create"], ask_list)
+		elif decision["destroy"] > 0:
+			self.actions.cancel_queued(self.create_instance.__name__)
+			self.queue_actions(self.destroy_instance, decision["destroy"], sorted(cold_instances, key=self.perf.cost_per_1k_tokens, reverse=True)) #most expensive per token first
+
+	def queue_actions(self, action, num_instances, instance_list):
+		#actions from earlier ticks that are still on their way count towards num_instances, and their instances are skipped
+		num_instances = min(num_instances, MAX_ACTIONS) - self.actions.num_pending(action.__name__)
+		num_queued = 0
+		for instance in instance_list:
+			if num_queued >= num_instances:
+				break
+			if instance["id"] in self.ignore_instance_ids:
+				continue
+			if self.actions.submit(action, instance["id"], instance):
+				num_queued += 1
+		print(f"[autoscaler] queued {action.__name__} on {num_queued} instances, {self.actions.num_pending(action.__name__)} pending")
+
+class InstanceSet(InstanceSetBase):
+	def __init__(self, manage=False, streaming=False, model="vllm-13", ssh_key_file=SSH_KEY_FILE, strategy="simple", benchmark=True):
+		self.store = InstanceStore()
+		self.engine = TickEngine(MAX_CONCURRENCY)
+		perf = MachinePerf(self.store, model) #machine id -> measured tps, time to first token and time to hot
+		probes = ProbeScheduler(expected_load_seconds=EXPECTED_LOAD_SECONDS.get(model, DEFAULT_LOAD_SECONDS))
+		super().__init__(model, manage, self.store.load_all(), perf, ActionExecutor(self.engine), probes)
+		self.perf_recorded_at = time.time()
+		self.estimated_running_since = set() #instance ids whose running_since is an estimate of when they started, made at startup
+		self.heartbeats = {} #instance id -> latest heartbeat posted by that instance's model server
+		self.heartbeat_tps = {} #instance id -> tokens/s its model server reported since the last record_reported_perf
 		self.started_instance_ids = []
-		self.bad_instance_ids = []
+		self.bad_instance_ids = set()
 		self.ignore_instance_ids = IGNORE_INSTANCE_IDS
+		#instances whose model has just loaded for the first time are benchmarked before they go hot. Their model_loaded
+		#is only saved once they pass, and the verdict is saved with it, so a restart picks up where the benchmarks left off.
+		self.benchmark = benchmark
+		self.first_loaded = {} #instance id -> when its model first loaded, while it waits for its benchmark verdict
+		self.benchmarking = {} #instance id -> its running benchmark task, or None while it waits for one
+		self.benchmark_failures = {} #instance id -> benchmarks that failed outright
 
 		self.streaming = streaming
-		self.manage = manage
-		self.model = model
 
 		self.cost_dict = {}
 		self.metrics = InstanceSetMetrics()
 		self.lock = Lock()
-		
-		self.update_instance_info(init=True)
-		self.strat = SimpleStrategy(avg_num_hot=len(self.running_instances) + len(self.loading_instances) + len(self.cold_instances))
+		self.api = get_vast_client()
+		self.ssh = SSHPool(key_file=ssh_key_file)
+		#what /hot and /status serve, republished whenever it changes so that reading it never takes the lock
+		self.hot_state = SnapshotPublisher({"hot_instances" : []})
+		self.status_state = SnapshotPublisher(self.status())
+
+		self.engine.run(self.update_instance_info(init=True))
+		self.strat = self.make_strategy(strategy)
 
 		with open(INSTANCE_CONFIG_NAME, "r") as f:
 			self.instance_config = json.load(f)
+		self.offers = OfferCache(self.api, self.instance_config[self.model]["get"], background=manage) #get_asks only ever asks for the budget ranking
 
+		self.register_metrics()
 		self.exit_event = Event()
-		self.manage_threads = []
-		self.p1 = Thread(target=self.update_and_manage_background, args=(self.exit_event,))
-		self.p1.start()
+		self.actions_future = self.engine.submit(self.actions.run())
+		self.tick_future = self.engine.submit(self.update_and_manage_background(self.exit_event))
+
+	def register_metrics(self):
+		#read when /metrics is scraped, the dicts are swapped rather than mutated so this doesn't need the lock
+		INSTANCES.set_function(lambda: {("hot",) : self.num_hot, ("model_loading",) : len(self.hot_instances) - self.num_hot, ("running",) : len(self.running_instances),
+			("loading",) : len(self.loading_instances), ("cold",) : len(self.cold_instances), ("bad",) : len(self.bad_instance_ids),
+			("benchmarking",) : len(self.benchmarking), ("rejected",) : len(self.rejected_instance_ids)})
+		REPORTED_LOAD.set_function(lambda: {("num_busy",) : self.num_busy, ("num_in_flight",) : self.num_in_flight, ("queue_depth",) : self.queue_depth,
+			("request_rate",) : self.request_rate, ("token_rate",) : self.token_rate, ("capacity",) : self.capacity})
+		COST_PER_HOUR.set_function(lambda: sum(instance.get("dph_total") or 0.0 for instance in list(self.running_instances.values()) + list(self.loading_instances.values())))
 
 	def deconstruct(self):
 		print("[autoscaler] deconstructing")
 		self.exit_event.set()
-		self.p1.join()
+		self.tick_future.result()
+		self.hot_state.publish({"hot_instances" : []}) #nothing is hot once the instance set is gone, which also answers any long polls
+		self.actions.stop()
+		self.actions_future.result()
+		self.engine.stop()
+		self.offers.stop()
+		self.ssh.close()
+		self.store.close()
 
 	def update_tokens_per_second(self, instance): #need lock here?
-		port_num = str(instance["ssh_port"])
-		host = instance["ssh_host"]
-		result = subprocess.run(["ssh", "-p", port_num, "-o", "StrictHostKeyChecking=no", "root@{}".format(host), "grep 'Output generated' /app/onstart.log | tail -n 1"], capture_output=True)
-		out = result.stdout
+		out = self.ssh.run(instance["ssh_host"], instance["ssh_port"], "grep 'Output generated' /app/onstart.log | tail -n 1")
 		tps = None
 		if out is not None:
-			line = out.decode('utf-8')
+			line = out
 			pattern = r"()\d+\.\d+(?=\stokens\/s)"
 			match = re.search(pattern, line)
 			if match is not None:
 				tps = float(match.group())
 
-		# if tps is not None:
-		# 	instance["tokens/s"] = tps
-		# 	with open(f"instance_info/{instance['machine_id']}.json", "w") as f:
-		# 		json.dump(instance, f)
+		if tps is not None:
+			self.record_machine_perf(instance, tps=tps)
+		return tps
 
-	def update_and_manage_background(self, event):
-		while not event.is_set():
-			print("[autoscaler] ticking")
-			self.update_instance_info(init=False)
-			self.manage_instances()
-			time.sleep(TIME_INTERVAL_SECONDS)
-
-	def read_instance_json(self, instance):
-		id = instance["id"]
-		filepath = f"instance_info/{id}.json"
-		if os.path.exists(filepath):
-			with open(filepath, "r") as f:
-				instance_log = json.load(f)
-				self.instance_info_map[id] = instance_log
-				return True
+	def record_machine_perf(self, instance, tps=None, time_to_hot=None):
+		self.perf.record(instance, tps=tps, time_to_hot=time_to_hot)
+
+	def record_reported_perf(self, instances):
+		#saves what the loadbalancer has measured of each hot instance, and the tokens/s model servers have reported in
+		#their heartbeats, to the machines' history. Heartbeats only buffer theirs, so they never wait on the database.
+		self.lock.acquire()
+		instance_perf = self.instance_perf
+		heartbeat_tps = self.heartbeat_tps
+		self.heartbeat_tps = {}
+		self.lock.release()
+		for id, tps in heartbeat_tps.items():
+			self.store.update(id, tps=tps)
+		measurements = [(instances[id], perf) for id, perf in instance_perf.items() if id in instances]
+		self.perf.record_many(measurements + [(instances[id], {"tps" : tps}) for id, tps in heartbeat_tps.items() if id in instances])
+		self.perf_recorded_at = time.time()
+
+	def mark_model_loaded(self, instance_id, loaded_time):
+		info = self.instance_info_map[instance_id]
+		if info["model_loaded"] is not None or info.get("benchmark") == "rejected":
+			return
+		if self.benchmark and info.get("benchmark") is None:
+			#loaded, but it only counts once it passes its benchmark (see update_benchmarks)
+			self.lock.acquire()
+			seen = instance_id in self.first_loaded
+			self.first_loaded.setdefault(instance_id, loaded_time)
+			self.lock.release()
+			if seen:
+				return
 		else:
-			return False
+			info["model_loaded"] = loaded_time
+			self.store.update(instance_id, model_loaded=loaded_time)
+		instance = self.instances.get(instance_id)
+		if instance is not None and instance_id in self.running_since and instance_id not in self.estimated_running_since:
+			self.record_machine_perf(instance, time_to_hot=loaded_time - self.running_since[instance_id])
 
-	def update_instance_info(self, init):
-		curr_instances = get_curr_instances()
-		if curr_instances is None:
+	async def update_and_manage_background(self, event):
+		while not event.is_set():
+			print("[autoscaler] ticking")
+			t1 = time.time()
+			try:
+				await self.update_instance_info(init=False)
+				await self.manage_instances()
+			except Exception as e:
+				print(f"[autoscaler] tick failed: {e}")
+			tick_duration = time.time() - t1
+			TICK_SECONDS.labels("tick").observe(tick_duration)
+			print(f"[autoscaler] tick took {tick_duration:.2f}s")
+			await asyncio.sleep(max(0, TIME_INTERVAL_SECONDS - tick_duration))
+
+	async def update_instance_info(self, init):
+		t1 = time.time()
+		done, curr_instances = await self.engine.call(("show",), API_DEADLINE, get_curr_instances, self.api)
+		if not done or curr_instances is None:
+			TICK_SECONDS.labels("update_instance_info").observe(time.time() - t1)
 			return
 
-		if init:
-			for instance in curr_instances: #could parallelize with act_on_instances
-				self.read_instance_json(instance)
+		curr_instance_map = {instance["id"] : instance for instance in curr_instances}
+		self.actions.reconcile(curr_instance_map)
+		added, removed, changed = diff_instances(self.instances, curr_instance_map)
+		print(f"[autoscaler] instance diff: {len(added)} added, {len(removed)} removed, {len(changed)} changed")
+
+		for id in removed:
+			self.bad_instance_ids.discard(id)
+			self.benchmark_failures.pop(id, None)
+			self.first_loaded.pop(id, None)
+		#one batched lookup picks up instances that another process (e.g. create_instances.py) has just created
+		unknown_ids = [id for id in curr_instance_map.keys() if id not in self.instance_info_map.keys() and id not in self.ignore_instance_ids]
+		if len(unknown_ids) != 0:
+			self.instance_info_map.update(self.store.get_many(unknown_ids))
+		for id in unknown_ids:
+			if id in self.instance_info_map.keys():
+				self.bad_instance_ids.discard(id)
+			elif id not in self.bad_instance_ids:
+				print(f"[autoscaler] instance id: {id} has no stored metadata (master token), treating it as bad")
+				self.bad_instance_ids.add(id)
+		self.rejected_instance_ids = set(id for id in curr_instance_map.keys() if self.instance_info_map.get(id, {}).get("benchmark") == "rejected")
 
 		running_instances = []
 		cold_instances = []
@@ -183,237 +410,317 @@ class InstanceSet:
 			if instance["id"] in self.ignore_instance_ids:
 				continue
 			if instance["id"] not in self.instance_info_map.keys():
-				if not (self.read_instance_json(instance)):
-					self.bad_instance_ids.append(instance['id'])
-					continue
-			if (instance['actual_status'] == 'offline') or (instance['status_msg'] is not None and 'Error response from daemon' in instance['status_msg']) or (instance['machine_id'] in BAD_MACHINE_IDS):
-				self.bad_instance_ids.append(instance['id'])
-			elif instance['actual_status'] == 'running':
+				continue
+			state = classify_instance(instance)
+			if state == "bad":
+				self.bad_instance_ids.add(instance['id'])
+			elif state == "running":
 				running_instances.append(instance)
-			elif instance['actual_status'] == 'loading' or instance['actual_status'] == None or (instance['actual_status'] == 'created' and instance['intended_status'] == 'running'):
+			elif state == "loading":
 				loading_instances.append(instance)
-			elif (instance['actual_status'] == 'created' and instance['intended_status'] == 'stopped') or instance['actual_status'] == 'stopping' or instance['actual_status'] == 'exited':
+			elif state == "cold":
 				cold_instances.append(instance)
 			else:
 				print("[autoscaler] instance id: {} has unidentified status: {}".format(instance['id'], instance['actual_status']))
 
-		running_instances.sort(key=tps, reverse=True)
-		cold_instances.sort(key=tps, reverse=True)
+		if time.time() - self.perf_recorded_at >= PERF_RECORD_SECONDS:
+			self.record_reported_perf(curr_instance_map)
+
+		now = time.time()
+		running_since = {}
+		for instance in running_instances:
+			if instance["id"] in self.running_since:
+				running_since[instance["id"]] = self.running_since[instance["id"]]
+			elif init:
+				running_since[instance["id"]] = self.estimate_running_since(instance, now)
+				self.estimated_running_since.add(instance["id"])
+			else:
+				running_since[instance["id"]] = now
+		self.estimated_running_since &= set(running_since.keys())
 
 		self.lock.acquire()
-		self.running_instances = running_instances
-		self.cold_instances = cold_instances
-		self.loading_instances = loading_instances
+		self.instances = curr_instance_map
+		self.running_since = running_since
+		self.running_instances = {instance["id"] : instance for instance in running_instances}
+		self.cold_instances = {instance["id"] : instance for instance in cold_instances}
+		self.loading_instances = {instance["id"] : instance for instance in loading_instances}
 		self.lock.release()
-
-		self.update_hot_instances()
-
-	# def check_server_error(self, instance): #will hang, might need to find a faster way to do this
-	# 	port_num = str(instance["ssh_port"])
-	# 	host = instance["ssh_host"]
-	# 	result = subprocess.run([f"ssh -p {port_num} -o StrictHostKeyChecking=no root@{host} grep -E '{ERROR_STRINGS[0]}|{ERROR_STRINGS[1]}' /app/onstart.log"], shell=True, capture_output=True)
-	# 	out = result.stdout
-	# 	if out is not None and ((ERROR_STRINGS[0] in out.decode('utf-8')) or (ERROR_STRINGS[1] in out.decode('utf-8'))):
-	# 		return True
-	# 	else:
-	# 		return False
-
-	# def find_error_instances(self):
-	# 	self.lock.acquire()
-
-	# 	loaded_but_not_hot = [inst for inst in self.running_instances if inst not in self.hot_instances]
-	# 	# loaded_but_not_hot = [self.running_instances[0]] if len(self.running_instances) != 0 else []
-	# 	if len(loaded_but_not_hot) == 0:
-	# 		self.lock.release()
-	# 		return
-
-	# 	error_instance_ids = []
-	# 	with ThreadPoolExecutor(MAX_CONCURRENCY) as e:
-	# 		for instance, result in zip(loaded_but_not_hot, e.map(self.check_server_error, loaded_but_not_hot)):
-	# 			if result:
-	# 				error_instance_ids.append(instance["id"])
-
-	# 	self.lock.release()
-	# 	return error_instance_ids
-
-	# def zero_ready_log(self, instance):
-	# 	port_num = str(instance["ssh_port"])
-	# 	host = instance["ssh_host"]
-	# 	ssh_string = f"ssh -p {port_num} -o StrictHostKeyChecking=no root@{host}"
-	# 	command_string1 = f"cp /app/onstart.log /app/onstart_og.log"
-	# 	command_string2 = f"echo -n '' > /app/onstart.log"
-	# 	result = subprocess.run([ssh_string + command_string1], shell=True, capture_output=True)
-	# 	result = subprocess.run([ssh_string + command_string2], shell=True, capture_output=True)
-
-	def check_server_hot(self, instance): #could get notified by the server directly in the future
-		port_num = str(instance["ssh_port"])
-		host = instance["ssh_host"]
-		key_file = "/home/nicholas/Desktop/VastAI/ssh/vast-2" #not necessary if shell=True
-		ssh_string = f"ssh -i {key_file} -p {port_num} -o StrictHostKeyChecking=no root@{host}"
+		TICK_SECONDS.labels("update_instance_info").observe(time.time() - t1)
+
+		await self.update_hot_instances()
+		return added, removed, changed
+
+	def estimate_running_since(self, instance, now):
+		#instances already running when the autoscaler starts (e.g. after a restart) may be well into loading their model, so
+		#they're taken to have been running since the Vast API says they started or, if their model has never loaded, since
+		#we created them. Both include the image pull, so probing starts early rather than late.
+		started = instance.get("start_date")
+		info = self.instance_info_map[instance["id"]]
+		if started is None and info.get("model_loaded") is None:
+			started = info.get("created_at")
+		return min(started, now) if started else now
+
+	def check_server_hot(self, instance): #fallback for model servers that don't post heartbeats
+		#None if the ssh pool had no slot free, so the instance wasn't checked at all
 		hot_str = "blocks"
 		command_string = f"grep '{hot_str}' /src/infer.log | tail -n 1"
-		result = subprocess.run([ssh_string + " " + command_string], shell=True, capture_output=True)
-		# print(result)
-		out = result.stdout
-		# print(out)
-		if out is not None and hot_str in out.decode('utf-8'):
+		ran, out = self.ssh.try_run(instance["ssh_host"], instance["ssh_port"], command_string)
+		if not ran:
+			return None
+		if out is not None and hot_str in out:
 			return True
 		else:
 			return False
 
+	def report_heartbeat(self, instance_id, mtoken, model_loaded, tps=None, queue_depth=None):
+		try:
+			instance_id = int(instance_id)
+		except (TypeError, ValueError):
+			HEARTBEATS.labels("rejected").inc()
+			return False
+		info = self.instance_info_map.get(instance_id)
+		if info is None or not isinstance(mtoken, str) or not secrets.compare_digest(info["mtoken"], mtoken): #compare_digest raises on non-strings
+			HEARTBEATS.labels("rejected").inc()
+			return False
+		HEARTBEATS.labels("accepted").inc()
+		heartbeat = {"model_loaded" : bool(model_loaded), "tps" : tps, "queue_depth" : queue_depth, "time" : time.time()}
+		self.lock.acquire()
+		self.heartbeats[instance_id] = heartbeat
+		if tps is not None and tps != info["tps"]:
+			info["tps"] = tps
+			self.heartbeat_tps[instance_id] = tps
+		self.lock.release()
+		if model_loaded:
+			self.mark_model_loaded(instance_id, heartbeat["time"])
+		return True
+
+	def report_hot_busy(self, num_hot, num_busy, num_in_flight=None, queue_depth=None, instance_load=None, request_rate=None, token_rate=None, capacity=None, instance_perf=None):
+		#returns the hot instances' reported and expected tokens/s for the loadbalancer's routing weights, which change too
+		#often to be part of the /hot snapshot
+		self.lock.acquire()
+		self.num_hot = num_hot
+		self.num_busy = num_busy
+		self.report_load(num_in_flight, queue_depth, instance_load, request_rate, token_rate, capacity, instance_perf)
+		self.status_state.publish(self.status())
+		hot_perf = self.hot_perf
+		self.lock.release()
+		return hot_perf
+
+	#call below with lock LOCKED
+	def status(self):
+		return {"num_hot" : self.num_hot, "num_cold" : len(self.cold_instances), "num_image_loading" : len(self.loading_instances), "num_model_loading" : len(self.hot_instances) - self.num_hot,
+			"num_busy" : self.num_busy, "num_in_flight" : self.num_in_flight, "queue_depth" : self.queue_depth, "num_benchmarking" : len(self.benchmarking)}
+
 	def test_hot_instance(self, instance, token):
+		t1 = time.time()
+		hot = self.send_test_prompt(instance, token)
+		TEST_PROMPT_SECONDS.labels("hot" if hot else "not_hot").observe(time.time() - t1)
+		return hot
+
+	def send_test_prompt(self, instance, token):
 		addr = get_model_address(instance, self.streaming)
 		if self.streaming:
 			return send_vllm_request_streaming_test_auth(addr, token)
 
 		print(f"[autoscaler] sending to instance: {instance['id']}")
-		response = send_vllm_request_auth(addr, token, TEST_PROMPT)
+		response = send_vllm_request_auth(addr, token, TEST_PROMPT, timeout=TEST_TIMEOUT) #a hung server mustn't keep a probe thread forever
 		print(f"[autoscaler] got response from instance: {instance['id']}")
 		if response["reply"] is not None:
 			if response["num_tokens"] != 0:
 				return True
 		return False
 
-	def update_hot_instances(self):
+	def probe_hot_instance(self, instance, token):
+		#hot is None if the instance couldn't be probed this time
+		t1 = time.time()
+		hot = self.check_server_hot(instance) and self.test_hot_instance(instance, token)
+		latency = time.time() - t1
+		PROBE_SECONDS.labels("not_probed" if hot is None else "hot" if hot else "not_hot").observe(latency)
+		return hot, latency
+
+	def benchmark_instance(self, instance, token):
+		t1 = time.time()
+		result = run_benchmark(get_model_address(instance, self.streaming), token, self.streaming)
+		BENCHMARK_SECONDS.observe(time.time() - t1)
+		return result
+
+	def save_benchmark_verdict(self, instance_id, verdict):
+		#an instance that passed (or was only demoted) now counts as loaded, from when its model first loaded
+		info = self.instance_info_map[instance_id]
+		self.lock.acquire()
+		loaded_time = self.first_loaded.pop(instance_id, time.time())
+		self.lock.release()
+		info["benchmark"] = verdict
+		if verdict == "rejected":
+			self.store.update(instance_id, benchmark=verdict)
+		else:
+			info["model_loaded"] = loaded_time
+			self.store.update(instance_id, model_loaded=loaded_time, benchmark=verdict)
+
+	def update_benchmarks(self, running_instances, instance_info_map):
+		#judges finished benchmarks against other machines with the same gpus and starts queued ones. Returns the ids of
+		#instances that passed (or were only demoted), which can go hot now.
+		for id in [id for id in self.benchmarking.keys() if id not in running_instances]:
+			task = self.benchmarking.pop(id)
+			if task is not None:
+				task.cancel()
+		ready_ids = set()
+		for id, task in list(self.benchmarking.items()):
+			if task is None or not task.done():
+				continue
+			del self.benchmarking[id]
+			instance = running_instances[id]
+			try:
+				result = task.result()
+			except Exception as e:
+				print(f"[autoscaler] benchmark of instance id: {id} failed: {e}")
+				result = None
+			norm_tps, measured = self.perf.gpu_norm(instance)
+			verdict = judge(result, norm_tps, measured)
+			if verdict == "failed":
+				self.benchmark_failures[id] = self.benchmark_failures.get(id, 0) + 1
+				if self.benchmark_failures[id] < MAX_BENCHMARK_ATTEMPTS:
+					print(f"[autoscaler] benchmark of instance id: {id} failed, retrying")
+					BENCHMARKS.labels(verdict).inc()
+					self.benchmarking[id] = None
+					continue
+				print(f"[autoscaler] instance id: {id} failed {MAX_BENCHMARK_ATTEMPTS} benchmarks, verdict: rejected")
+				verdict = "rejected"
+			else:
+				self.perf.record(instance, bench_tps=result["tps"], ttft=result["ttft"], max_concurrency=result["max_concurrency"])
+				ttft = f"{result['ttft']:.2f}s" if result["ttft"] is not None else "n/a" #only measured when streaming
+				print(f"[autoscaler] benchmarked instance id: {id} ({instance.get('num_gpus')}x {instance.get('gpu_name')}): {result['tps']:.1f} tokens/s ({'norm' if measured else 'prior'} {norm_tps:.1f}), single stream {result['single_tps']:.1f} tokens/s, ttft {ttft}, max concurrency {result['max_concurrency']}, verdict: {verdict}")
+			BENCHMARKS.labels(verdict).inc()
+			self.save_benchmark_verdict(id, verdict)
+			if verdict == "rejected":
+				self.rejected_instance_ids.add(id) #destroyed by manage_instances
+			else:
+				ready_ids.add(id)
+
+		num_running = len([task for task in self.benchmarking.values() if task is not None])
+		for id, task in self.benchmarking.items():
+			if num_running >= MAX_CONCURRENT_BENCHMARKS:
+				break
+			if task is None:
+				self.benchmarking[id] = asyncio.ensure_future(self.engine.run_bounded(self.benchmark_instance, running_instances[id], instance_info_map[id]["mtoken"]))
+				num_running += 1
+		return ready_ids
+
+	def probe_stats(self):
+		self.lock.acquire()
+		stats = self.probes.stats()
+		self.lock.release()
+		return stats
+
+	async def update_hot_instances(self):
+		t1 = time.time()
 		self.lock.acquire()
 		running_instances = self.running_instances
 		hot_instances = self.hot_instances
 		instance_info_map = self.instance_info_map
+		heartbeat_cutoff = time.time() - HEARTBEAT_TIMEOUT
+		heartbeats = {id : hb for id, hb in self.heartbeats.items() if hb["time"] >= heartbeat_cutoff}
 		self.lock.release()
+		self.ssh.evict_idle()
 
-		if len(running_instances) == 0:
-			return
+		#servers that report their own readiness go straight to hot, the rest are probed over ssh and sent a test prompt
+		running_but_not_hot = [i for id, i in running_instances.items() if id not in hot_instances and id not in self.benchmarking and id not in self.rejected_instance_ids] # and (i["id"] not in self.ignore_instance_ids)
+		reported_hot_ids = set(i["id"] for i in running_but_not_hot if i["id"] in heartbeats and heartbeats[i["id"]]["model_loaded"])
+		unreported = [i for i in running_but_not_hot if i["id"] not in heartbeats]
+		self.lock.acquire()
+		self.probes.prune(set(i["id"] for i in unreported))
+		due = [i for i in unreported if self.probes.due(i["id"], self.expected_load_seconds(i["id"]), self.running_since.get(i["id"]))]
+		self.lock.release()
 
-		running_but_not_hot = [i for i in running_instances if ((i not in hot_instances))] # and (i["id"] not in self.ignore_instance_ids)
-		new_hot_instances = []
-		with ThreadPoolExecutor(MAX_CONCURRENCY) as e:
-			for instance, result in zip(running_but_not_hot, e.map(self.check_server_hot, running_but_not_hot)):
-				if result:
-					new_hot_instances.append(instance)
-		print(f"[autoscaler] initial num hot before testing: {len(new_hot_instances)}")
+		due_tokens = [instance_info_map[instance["id"]]["mtoken"] for instance in due]
+		keys = [("probe", instance["id"]) for instance in due]
+		results = await self.engine.call_many(keys, PROBE_DEADLINE, self.probe_hot_instance, due, due_tokens)
 		new_hot_instances_tested = []
-		new_hot_tokens = [instance_info_map[instance["id"]]["mtoken"] for instance in new_hot_instances]
-		with ThreadPoolExecutor(MAX_CONCURRENCY) as e:
-			for instance, result in zip(new_hot_instances, e.map(self.test_hot_instance, new_hot_instances, new_hot_tokens)):
-				if result:
+		self.lock.acquire()
+		for instance, (done, result) in zip(due, results):
+			if done and result[0] is not None: #an instance that wasn't probed is due again on the next tick, without backing off
+				hot, latency = result
+				self.probes.record(instance["id"], hot, latency)
+				if hot:
 					new_hot_instances_tested.append(instance)
-
-		print(f"[autoscaler] num hot after testing: {len(new_hot_instances_tested)}")
-		next_hot_instances = [i for i in running_instances if ((i in hot_instances) or (i in new_hot_instances_tested))] #gets rid of old hot instances that are no longer running
-
-		# if len(self.hot_instances) != 0:
-		# 	with ThreadPoolExecutor(len(self.hot_instances)) as e:
-		# 		# e.map(self.update_tokens_per_second, self.hot_instances)
-		# 		e.map(self.zero_ready_log, self.hot_instances)
-
-		for instance in next_hot_instances:
-			instance["mtoken"] = instance_info_map[instance["id"]]["mtoken"]
+		self.lock.release()
+		num_late = len([done for done, _ in results if not done])
+
+		print(f"[autoscaler] probed {len(due)} of {len(unreported)} unreported instances, num hot after testing: {len(new_hot_instances_tested)}, num reported hot: {len(reported_hot_ids)}, num probes still running: {num_late}")
+		new_hot_ids = set(instance["id"] for instance in new_hot_instances_tested) | reported_hot_ids
+		for id in new_hot_ids:
+			self.mark_model_loaded(id, time.time())
+		#instances without a benchmark verdict yet still have no model_loaded, and are benchmarked before they go hot
+		first_loaded_ids = set(id for id in new_hot_ids if instance_info_map[id]["model_loaded"] is None)
+		for id in first_loaded_ids:
+			self.benchmarking[id] = None
+		new_hot_ids = (new_hot_ids - first_loaded_ids) | self.update_benchmarks(running_instances, instance_info_map)
+		unloaded_ids = set(id for id, hb in heartbeats.items() if not hb["model_loaded"]) #servers can report that their model went away
+		#hot status is keyed on id, so it survives changes to other fields, and old hot instances that are no longer running are dropped
+		next_hot_instances = {}
+		hot_list = []
+		hot_perf = {}
+		for id, i in sorted(running_instances.items()):
+			if ((id in hot_instances) or (id in new_hot_ids)) and id not in unloaded_ids:
+				next_hot_instances[id] = dict(i, mtoken=instance_info_map[id]["mtoken"])
+				if id in heartbeats:
+					next_hot_instances[id]["tokens/s"] = heartbeats[id]["tps"]
+					next_hot_instances[id]["queue_depth"] = heartbeats[id]["queue_depth"]
+				hot_list.append(hot_projection(i, instance_info_map[id]["mtoken"]))
+				hot_perf[id] = {"tokens/s" : next_hot_instances[id].get("tokens/s"), "expected_tps" : self.perf.predicted_tps(i)}
 
 		self.lock.acquire()
 		self.hot_instances = next_hot_instances
+		self.hot_perf = hot_perf
+		self.hot_state.publish({"hot_instances" : hot_list})
+		self.status_state.publish(self.status())
 		self.lock.release()
+		self.engine.prune(lambda key: key[0] != "probe" or key[1] in running_instances)
+		TICK_SECONDS.labels("update_hot_instances").observe(time.time() - t1)
 
-	def manage_instances(self):
+	async def manage_instances(self):
+		#decides on a copy of the state taken under the lock, then hands the actions to the executor without waiting for them,
+		#so the lock is never held while the Vast API is called
+		t1 = time.time()
 		self.lock.acquire()
+		snapshot = self.metrics_snapshot()
+		running_instances = list(self.running_instances.values())
+		cold_instances = list(self.cold_instances.values())
+		instance_load = self.instance_load
+		instances = self.instances
+		rejected_instance_ids = set(id for id in self.rejected_instance_ids if id in instances)
+		self.lock.release()
 
-		# print("[autoscaler] dealing with bad instances")
-		# self.act_on_instances(self.destroy_instance, len(self.bad_instance_ids), self.bad_instance_ids)
-		# self.bad_instance_ids = []
-
-		if self.num_busy > self.strat.avg_num_busy:
-			num_hot_busy = self.num_busy
-		else:
-			num_hot_busy = update_rolling_average(self.strat.avg_num_busy, self.num_busy, TIME_INTERVAL_SECONDS, 0.01)
-		self.strat.avg_num_busy = num_hot_busy
-
-		num_hot = self.num_hot
-		num_model_loading = len(self.running_instances) - num_hot
-		num_loading = len(self.loading_instances) + num_model_loading
-
-		num_cold = len(self.cold_instances) + num_loading
-		num_tot = num_hot + num_cold
-
-		hot_busy_ratio = (num_hot_busy + 1) / (num_hot + 0.05)
-		hot_ratio = (num_hot + 1) / (num_tot + 0.1)
-
-		num_hot_rolling = update_rolling_average(self.strat.avg_num_hot, num_hot, TIME_INTERVAL_SECONDS, 0.01)
-		self.strat.avg_num_hot = num_hot_rolling
-		hot_ratio_rolling = (num_hot_rolling + 1) / (num_tot + 0.1)
+		decision = self.strat.decide(snapshot)
 
-		print(f"[autoscaler] internal lists: len(self.running_instances): {len(self.running_instances)}, len(self.hot_instances): {len(self.hot_instances)}")
-		print("[autoscaler] managing instances: hot_busy_ratio: {}, hot_ratio: {}, hot_ratio_rolling: {}, num_hot: {}, num_busy: {}, num_cold_ready: {}, num_loading: {}, num_total: {}".format(hot_busy_ratio, hot_ratio, hot_ratio_rolling, num_hot, num_hot_busy, len(self.cold_instances), num_loading, num_tot))
+		print(f"[autoscaler] internal lists: len(self.running_instances): {len(running_instances)}, len(self.hot_instances): {len(self.hot_instances)}")
+		print("[autoscaler] managing instances: num_hot: {}, num_busy: {}, num_in_flight: {}, queue_depth: {}, token_rate: {}, num_cold_ready: {}, num_loading: {}, decision: {}".format(snapshot["num_hot"], snapshot["num_busy"], snapshot["num_in_flight"], snapshot["queue_depth"], snapshot["token_rate"], snapshot["num_cold"], len(snapshot["loading_time_to_hot"]), decision))
 
 		if self.manage:
-			#stop and start instances
-			if hot_busy_ratio < self.strat.target_hot_busy_ratio_lower:
-				print("[autoscaler] hot busy ratio too low!")
-				count = num_hot - int((hot_busy_ratio / self.strat.target_hot_busy_ratio_lower) * max(num_hot, 1))
-				#maybe I can filter for idle here
-				running_instances = self.running_instances[::-1]
-				stop_thread = Thread(target=self.act_on_instances, args=(self.stop_instance, count, running_instances))
-				stop_thread.start()
-				stop_thread.join()
-
-			elif hot_busy_ratio >= self.strat.target_hot_busy_ratio_upper:
-				print("[autoscaler] hot busy ratio too high!")
-				count = int((hot_busy_ratio / self.strat.target_hot_busy_ratio_upper) * max(num_hot, 1)) - num_hot
-				start_thread = Thread(target=self.act_on_instances, args=(self.start_instance, count, self.cold_instances))
-				start_thread.start()
-				start_thread.join()
-
-			#create and destroy instances
-			if hot_ratio > self.strat.target_hot_ratio:
-				print("[autoscaler] hot ratio too high!")
-				count = int((hot_ratio / self.strat.target_hot_ratio) * max(num_tot, 1)) - num_tot
-				create_thread = Thread(target=self.act_on_instances, args=(self.create_instance, count, self.get_asks(budget=True)))
-				create_thread.start()
-				create_thread.join()
-
-			elif hot_ratio_rolling < self.strat.target_hot_ratio:
-				print("[autoscaler] hot ratio too low!")
-				count = num_tot - int((hot_ratio_rolling / self.strat.target_hot_ratio) * max(num_tot, 1))
-				cold_instances = self.cold_instances[::-1]
-				destroy_thread = Thread(target=self.act_on_instances, args=(self.destroy_instance, count, cold_instances))
-				destroy_thread.start()
-				destroy_thread.join()
+			#rejected instances are destroyed, including ones rejected before a restart. Only one action per instance is ever on its way.
+			for id in rejected_instance_ids:
+				self.actions.submit(self.destroy_instance, id, instances[id])
+			ask_list = None
+			if decision["create"] > 0:
+				done, ask_list = await self.engine.call(("get_asks",), API_DEADLINE, self.get_asks, True)
+			self.queue_decision(decision, running_instances, cold_instances, instance_load, ask_list)
+
+		TICK_SECONDS.labels("manage_instances").observe(time.time() - t1)
 
-		self.lock.release()
 	############################### vastai API Helper Functions ##########################################################
 
 	def get_asks(self, budget=True):
-		ask_list = []
-		config = self.instance_config[self.model]["get"]
-		gpu_configs = config["gpu"]
-		disk_args =  f"disk_space >= {config['disk_space']}"
-		order = "dph" if budget else "dlperf_per_dphtotal"
-		for gpu_config in gpu_configs:
-			gpu_args = ""
-			if "gpu_name" in gpu_config.keys():
-				gpu_args += f"gpu_name = {gpu_config['gpu_name']} "
-			if "num_gpus" in gpu_config.keys():
-				gpu_args += f"num_gpus = {gpu_config['num_gpus']} "
-			if "gpu_ram" in gpu_config.keys():
-				gpu_args += f"gpu_ram >= {gpu_config['gpu_ram']} "
-
-			full_args = f"'{gpu_args}{disk_args}' -o '{order}'"
-			print(full_args)
-			result = subprocess.run(["vastai search offers " + full_args + " --raw"], shell=True, capture_output=True)
-			listed_instances = result.stdout.decode('utf-8')
-			if listed_instances and listed_instances[0] == '[':
-				ask_list += json.loads(listed_instances)
-
-		return ask_list
+		#deduplicated offers from the background-refreshed cache, cheapest predicted cost per token first
+		return sorted(self.offers.get(budget), key=self.perf.cost_per_1k_tokens)
 
 	def create_instances(self, num_instances):
-		ask_list = self.get_asks()
-		for instance in ask_list:
-			instance["model"] = self.model
-		self.act_on_instances(self.create_instance, num_instances, ask_list)
+		ask_list = [dict(ask, model=self.model) for ask in self.get_asks()]
+		self.engine.run(self.act_on_instances(self.create_instance, num_instances, ask_list))
 
 	def start_instances(self, num_instances):
-		self.act_on_instances(self.start_instance, num_instances, self.cold_instances)
+		self.engine.run(self.act_on_instances(self.start_instance, num_instances, sorted(self.cold_instances.values(), key=self.perf.cost_per_1k_tokens)))
 
-	def act_on_instances(self, action, num_instances, instance_list):
+	async def act_on_instances(self, action, num_instances, instance_list):
 		num_instances = min(num_instances, MAX_ACTIONS)
 		print(f"[autoscaler] calling {action.__name__} on {num_instances} instances, len(instance_list): {len(instance_list)}")
 		if instance_list is None or len(instance_list) == 0:
@@ -425,10 +732,11 @@ class InstanceSet:
 			batch_idx = min(batch_idx, len(instance_list))
 			curr_instances = instance_list[:batch_idx]
 			instance_list = instance_list[batch_idx:]
-			with ThreadPoolExecutor(MAX_CONCURRENCY) as e:
-				for result in e.map(action, curr_instances):
-					if result:
-						num_acted += 1
+			keys = [(action.__name__, instance["id"]) for instance in curr_instances]
+			for done, result in await self.engine.call_many(keys, ACTION_DEADLINE, action, curr_instances):
+				if done and result:
+					num_acted += 1
+				SCALE_ACTIONS.labels(action.__name__, "ok" if done and result else ("failed" if done else "late")).inc()
 
 		print(f"[autoscaler] sucessfully called {action.__name__} on {num_acted} instances")
 
@@ -436,18 +744,13 @@ class InstanceSet:
 		instance_id = instance["id"]
 		if instance_id in self.ignore_instance_ids:
 			return
-		result = subprocess.run(["vastai", "start", "instance", str(instance_id), "--raw"], capture_output=True)
-		if "starting instance" in result.stdout.decode('utf-8'):
-			return True
-		else:
-			return False
+		return self.api.start_instance(instance_id)
 
 	def stop_instance(self, instance):
 		instance_id = instance["id"]
 		if instance_id in self.ignore_instance_ids:
 			return
-		result = subprocess.run(["vastai", "stop", "instance", str(instance_id), "--raw"], capture_output=True)
-		return True
+		return self.api.stop_instance(instance_id)
 
 	def create_instance(self, instance):
 		instance_id = instance["id"]
@@ -462,37 +765,33 @@ class InstanceSet:
 			onstart = f"{config['onstart']}_streaming.sh"
 		else:
 			onstart = f"{config['onstart']}.sh"
-		args = f" --onstart {onstart} --image {config['image']} --disk {config['disk']} --env '-e MASTER_TOKEN={mtoken} -e NUM_GPUS={num_gpus} {config['env']}'" # --ssh --direct
-		result = subprocess.run([f"vastai create instance {str(instance_id)}" + args + " --raw"], shell=True, capture_output=True)
-		print(result)
-		if result is not None and result.stdout.decode('utf-8') is not None:
-			try:
-				response = json.loads(result.stdout.decode('utf-8'))
-				if response["success"]:
-					new_id = response["new_contract"]
-					init_json = {"mtoken" : mtoken, "model_loaded" : None, "tps" : None}
-					self.instance_info_map[new_id] = init_json
-					with open(f"instance_info/{new_id}.json", "w") as f:
-						json.dump(init_json, f)
-					return new_id
-
-			except json.decoder.JSONDecodeError:
-				pass
+		with open(onstart, "r") as f:
+			onstart_cmd = f.read()
+		env = parse_env(f"-e MASTER_TOKEN={mtoken} -e NUM_GPUS={num_gpus} {config['env']}")
+		if AUTOSCALER_PUBLIC_ADDR is not None:
+			env["AUTOSCALER_ADDR"] = AUTOSCALER_PUBLIC_ADDR
+		new_id = self.api.create_instance(instance_id, config["image"], config["disk"], env, onstart_cmd=onstart_cmd)
+		print(f"[autoscaler] create instance from ask: {instance_id} returned new id: {new_id}")
+		self.offers.drop_offer(instance_id) #either it's rented now, or it just failed and shouldn't be retried right away
+		if new_id is not None:
+			info = {"mtoken" : mtoken, "model" : model, "model_loaded" : None, "tps" : None, "created_at" : time.time(), "benchmark" : None}
+			self.store.put(new_id, info)
+			self.instance_info_map[new_id] = info
+			return new_id
 
 	def destroy_instance(self, instance):
 		instance_id = instance["id"]
 		if instance_id in self.ignore_instance_ids:
 			return
-		result = subprocess.run(["vastai", "destroy", "instance", str(instance_id), "--raw"], capture_output=True)
-		return True
+		return self.api.destroy_instance(instance_id)
 
 	def destroy_all_instances(self):
-		all = self.running_instances + self.cold_instances + self.loading_instances
-		self.act_on_instances(self.destroy_instance, len(all), all)
+		all = list(self.running_instances.values()) + list(self.cold_instances.values()) + list(self.loading_instances.values())
+		self.engine.run(self.act_on_instances(self.destroy_instance, len(all), all))
 
 	def stop_all_instances(self):
-		all = self.running_instances + self.loading_instances
-		self.act_on_instances(self.stop_instance, len(all), all)
+		all = list(self.running_instances.values()) + list(self.loading_instances.values())
+		self.engine.run(self.act_on_instances(self.stop_instance, len(all), all))
 
 	def print_instance_ids(self, label, instances):
 		for instance in instances:
@@ -1,8 +1,12 @@
 import requests
 
+from autoscaler import InstanceSet
+
 class Client:
 	def __init__(self):
 		self.auto_server_addr = '127.0.0.1:8000'
+		self.session = requests.Session() #keeps the connection open between polls
+		self.hot_version = None #version of the hot set last returned
 
 	def setup_autoscaler(self, autoscaler_args):
 		URI = f'http://{self.auto_server_addr}/setup'
@@ -21,15 +25,51 @@ class Client:
 		else:
 			print("[as-client] autoscaler server shut-down failed")
 
-	def get_hot_instances(self):
+	def get_hot_instances(self, wait=0):
+		#returns None if the hot set hasn't changed since the last call. With wait, the server holds the request for up
+		#to wait seconds until it does change.
 		URI = f'http://{self.auto_server_addr}/hot'
-		response = requests.get(URI)
+		params = {"wait" : wait} if self.hot_version is None else {"since" : self.hot_version, "wait" : wait}
+		response = self.session.get(URI, params=params, timeout=wait + 10)
 		if response.status_code == 200:
-			return response.json()['hot_instances']
+			data = response.json()
+			self.hot_version = data["version"]
+			return data['hot_instances']
+		if response.status_code != 304:
+			print(f"[as-client] failed to get hot instances: {response.status_code}")
 
-	def report_hot_busy(self, num_hot, num_busy):
+	def report_hot_busy(self, num_hot, num_busy, num_in_flight=None, queue_depth=None, instance_load=None, request_rate=None, token_rate=None, capacity=None, instance_perf=None):
 		URI = f'http://{self.auto_server_addr}/report'
-		request_dict = {"num_hot" : num_hot, "num_busy" : num_busy}
-		response = requests.post(URI, json=request_dict)
+		request_dict = {"num_hot" : num_hot, "num_busy" : num_busy, "num_in_flight" : num_in_flight, "queue_depth" : queue_depth, "instance_load" : instance_load,
+			"request_rate" : request_rate, "token_rate" : token_rate, "capacity" : capacity, "instance_perf" : instance_perf}
+		response = self.session.post(URI, json=request_dict)
 		if response.status_code != 200:
-			print("[as-client] failed to report num_hot/busy")
\ No newline at end of file
+			print("[as-client] failed to report num_hot/busy")
+			return None
+		return response.json()["hot_perf"] #hot instance id -> reported and expected tokens/s, ids as strings
+
+#Same interface as Client, for running the autoscaler in the loadbalancer's own process (embedded mode): calls go straight
+#to the InstanceSet, and the hot set is handed over as the published snapshot itself rather than as json over loopback http.
+class LocalClient:
+	def __init__(self):
+		self.autoscaler = None
+		self.hot_version = None #version of the hot set last returned
+
+	def setup_autoscaler(self, autoscaler_args):
+		self.autoscaler = InstanceSet(**autoscaler_args)
+		print("[as-client] embedded autoscaler set-up succeeded")
+
+	def destroy_autoscaler(self):
+		self.autoscaler.deconstruct()
+		print("[as-client] embedded autoscaler shut-down succeeded")
+
+	def get_hot_instances(self, wait=0):
+		#returns None if the hot set hasn't changed since the last call, after waiting up to wait seconds for it to
+		snapshot = self.autoscaler.hot_state.wait(self.hot_version, wait)
+		if snapshot.matches(self.hot_version):
+			return None
+		self.hot_version = snapshot.version
+		return snapshot.fields["hot_instances"]
+
+	def report_hot_busy(self, num_hot, num_busy, num_in_flight=None, queue_depth=None, instance_load=None, request_rate=None, token_rate=None, capacity=None, instance_perf=None):
+		return self.autoscaler.report_hot_busy(num_hot, num_busy, num_in_flight, queue_depth, instance_load, request_rate, token_rate, capacity, instance_perf)
@@ -1,5 +1,6 @@
-from flask import Flask, request
-from autoscaler import InstanceSet
+from flask import Flask, request, Response
+from autoscaler import InstanceSet, handle_heartbeat
+from prom_metrics import REGISTRY, CONTENT_TYPE
 import logging
 
 app = Flask(__name__)
@@ -22,48 +23,53 @@ def destroy_autoscaler():
     autoscaler.deconstruct()
     return "Destroyed InstanceSet"
 
+def serve_snapshot(publisher):
+    #the latest published snapshot, taken without the autoscaler's lock. A client that passes the version it already has
+    #(since=version or If-None-Match) gets 304 if nothing changed, after waiting up to wait=seconds for a change
+    since = request.args.get("since", request.headers.get("If-None-Match"))
+    snapshot = publisher.wait(since, request.args.get("wait", 0, type=float))
+    if snapshot.matches(since):
+        return Response(status=304, headers={"ETag" : snapshot.etag})
+    return Response(snapshot.body, mimetype="application/json", headers={"ETag" : snapshot.etag})
+
 @app.route("/hot", methods=["GET"])
 def get_hot_instances():
     global autoscaler
-    autoscaler.lock.acquire()
-    hot_list = autoscaler.hot_instances
-    autoscaler.lock.release()
-    return {"hot_instances" : hot_list}
+    if autoscaler is None:
+        return "InstanceSet hasn't been initialized", 503
+    return serve_snapshot(autoscaler.hot_state)
 
 @app.route("/report",methods=['POST'])
 def report_hot_busy():
     global autoscaler
     data = request.json
-    autoscaler.lock.acquire()
-    autoscaler.num_hot = data["num_hot"]
-    autoscaler.num_busy = data["num_busy"]
-    autoscaler.lock.release()
-    return "Updated num_hot and num_busy"
+    hot_perf = autoscaler.report_hot_busy(data["num_hot"], data["num_busy"], data.get("num_in_flight"), data.get("queue_depth"), data.get("instance_load"), data.get("request_rate"), data.get("token_rate"), data.get("capacity"), data.get("instance_perf"))
+    return {"hot_perf" : hot_perf}
+
+@app.route("/heartbeat", methods=['POST'])
+def report_heartbeat():
+    global autoscaler
+    return handle_heartbeat(autoscaler, request.get_json(silent=True))
 
 @app.route('/metrics', methods=['GET'])
 def get_server_metrics():
+    #Prometheus text format, never waits on the autoscaler's lock
+    return Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
+
+@app.route('/probes', methods=['GET'])
+def get_probe_stats():
     global autoscaler
-    autoscaler.metrics.lock.acquire()
-    cost = autoscaler.metrics.total_cost
-    autoscaler.metrics.lock.release()
-    tps_dict = {}
-    # for hot_instance in autoscaler.hot_instances:
-    #     if "tokens/s" in hot_instance.keys():
-    #         tps_dict[get_address(hot_instance)] = hot_instance["tokens/s"]
-    #     else:
-    #         tps_dict[get_address(hot_instance)] = None
-    return {"total_cost" : cost, "reported_tps" : tps_dict}
+    return {"probes" : autoscaler.probe_stats(), "total_probes" : autoscaler.probes.total_probes, "total_probe_latency" : autoscaler.probes.total_latency}
 
 @app.route('/status', methods=['GET'])
 def get_server_status():
     global autoscaler
-    autoscaler.lock.acquire()
-    status = {"num_hot" : autoscaler.num_hot, "num_cold" : len(autoscaler.cold_instances), "num_image_loading" : len(autoscaler.loading_instances), "num_model_loading" : len(autoscaler.hot_instances) - autoscaler.num_hot}
-    autoscaler.lock.release()
-    return status
+    if autoscaler is None:
+        return "InstanceSet hasn't been initialized", 503
+    return serve_snapshot(autoscaler.status_state)
 
 if __name__ == '__main__':
-    app.run(threaded=False, port=8000) #think about how to support multi-threading safety
+    app.run(threaded=True, port=8000) #threaded so long polls on /hot and /status don't hold up other requests
 
 
 
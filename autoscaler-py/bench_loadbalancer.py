@@ -0,0 +1,69 @@
+import argparse
+import asyncio
+import time
+import aiohttp
+
+#Load test for a running load balancer (loadbalancer_server.py or loadbalancer_async_server.py): keeps a fixed number of
+#/connect calls in flight and reports the achieved requests/sec and latency percentiles.
+#With --num_bursts > 1 the requests are split into bursts separated by idle gaps, which is the pattern that drains
+#instances' auth token queues; every "no address returned" reply while instances are hot is a token stall.
+
+def percentile(sorted_values, p):
+	if len(sorted_values) == 0:
+		return 0.0
+	idx = min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))
+	return sorted_values[idx]
+
+async def worker(session, URI, num_requests, latencies, results):
+	for _ in range(num_requests):
+		t1 = time.perf_counter()
+		try:
+			async with session.get(URI, json={"num_tokens" : 100}) as response:
+				reply = await response.json()
+				ok = response.status == 200
+		except aiohttp.ClientError:
+			reply = None
+			ok = False
+		latencies.append(time.perf_counter() - t1)
+		if not ok:
+			results["errors"] += 1
+		elif reply["addr"] is None:
+			results["no_addr"] += 1
+		else:
+			results["ok"] += 1
+
+async def run_bench(addr, concurrency, num_requests, num_bursts=1, burst_interval=0.0):
+	URI = f"http://{addr}/connect"
+	latencies = []
+	results = {"ok" : 0, "no_addr" : 0, "errors" : 0}
+	per_worker = max(1, num_requests // (concurrency * num_bursts))
+	connector = aiohttp.TCPConnector(limit=concurrency)
+	async with aiohttp.ClientSession(connector=connector) as session:
+		t1 = time.perf_counter()
+		idle_time = 0.0
+		for burst in range(num_bursts):
+			if burst > 0:
+				await asyncio.sleep(burst_interval)
+				idle_time += burst_interval
+			await asyncio.gather(*[worker(session, URI, per_worker, latencies, results) for _ in range(concurrency)])
+		elapsed = time.perf_counter() - t1 - idle_time
+
+	latencies.sort()
+	print(f"concurrency: {concurrency}, requests: {len(latencies)}, elapsed: {elapsed:.2f}s")
+	print(f"requests per second: {len(latencies) / elapsed:.1f}")
+	print(f"p50 latency: {percentile(latencies, 50) * 1000:.2f}ms, p99 latency: {percentile(latencies, 99) * 1000:.2f}ms, max latency: {latencies[-1] * 1000:.2f}ms")
+	print(f"ok: {results['ok']}, no address returned: {results['no_addr']}, errors: {results['errors']}")
+	return results
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--addr", type=str, default="127.0.0.1:5000")
+	parser.add_argument("--concurrency", type=int, default=1000)
+	parser.add_argument("--num_requests", type=int, default=20000)
+	parser.add_argument("--num_bursts", type=int, default=1)
+	parser.add_argument("--burst_interval", type=float, default=5.0, help="idle seconds between bursts")
+	args = parser.parse_args()
+	asyncio.run(run_bench(args.addr, args.concurrency, args.num_requests, args.num_bursts, args.burst_interval))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,77 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from prompt_OOBA import send_vllm_request_auth, send_vllm_request_streaming_auth
+
+#a short, medium and long prompt, so prompt processing is part of what's measured
+BENCH_PROMPTS = [
+	"What is the capital of France?",
+	"Explain how a large language model turns a prompt into a reply, one step at a time, for someone who has never programmed.",
+	"Here is a story. " + " ".join(["A fox ran through the forest looking for food, and found a farm at the edge of the trees."] * 30) + " Summarize the story in three sentences.",
+]
+CONCURRENCY_LEVELS = [2, 4, 8, 16] #tried in order after the single-stream pass, until doubling the concurrency stops paying off
+SCALING_GAIN = 1.2 #a level only counts as sustainable if it served at least this much more than the one before
+REQUEST_TIMEOUT = 60
+REJECT_FRACTION = 0.5 #instances serving less than this fraction of the benchmarked norm for their gpus are rejected
+DEMOTE_FRACTION = 0.8 #and below this they still go hot, but are reported as demoted (routing weights come from what was measured)
+
+def send_bench_request(addr, token, prompt, streaming):
+	#returns (num_tokens or None on failure, seconds to the first token or None, latency)
+	t1 = time.time()
+	if streaming:
+		response = send_vllm_request_streaming_auth(addr, token, prompt, timeout=REQUEST_TIMEOUT)
+	else:
+		response = send_vllm_request_auth(addr, token, prompt, timeout=REQUEST_TIMEOUT)
+	latency = time.time() - t1
+	if response["reply"] is None or response["error"] is not None or not response["num_tokens"]:
+		return None, None, latency
+	return response["num_tokens"], response["first_msg_wait"], latency
+
+def run_level(executor, addr, token, streaming, concurrency):
+	#concurrency requests at once, cycling through the prompts. Returns (tokens/s across all of them, number that failed).
+	prompts = [BENCH_PROMPTS[i % len(BENCH_PROMPTS)] for i in range(concurrency)]
+	t1 = time.time()
+	results = list(executor.map(lambda prompt: send_bench_request(addr, token, prompt, streaming), prompts))
+	elapsed = time.time() - t1
+	num_tokens = sum(tokens for tokens, _, _ in results if tokens is not None)
+	return num_tokens / elapsed, len([tokens for tokens, _, _ in results if tokens is None])
+
+#Fixed workload run against a newly hot instance's model server: each prompt once on its own (tokens/s of a single
+#stream and time to first token), then concurrency 2, 4, 8 and 16 until the instance's total throughput stops growing.
+#The best total is its capacity, and the highest concurrency that still added throughput is its max sustainable
+#concurrency. Returns None if every single-stream request failed.
+def run_benchmark(addr, token, streaming):
+	single = [send_bench_request(addr, token, prompt, streaming) for prompt in BENCH_PROMPTS]
+	succeeded = [(tokens, ttft, latency) for tokens, ttft, latency in single if tokens is not None]
+	if len(succeeded) == 0:
+		return None
+	single_tps = sum(tokens for tokens, _, _ in succeeded) / sum(latency for _, _, latency in succeeded)
+	ttfts = [ttft for _, ttft, _ in succeeded if ttft is not None]
+	tps = single_tps
+	max_concurrency = 1
+	num_errors = len(single) - len(succeeded)
+	with ThreadPoolExecutor(CONCURRENCY_LEVELS[-1]) as executor:
+		for concurrency in CONCURRENCY_LEVELS:
+			level_tps, level_errors = run_level(executor, addr, token, streaming, concurrency)
+			num_errors += level_errors
+			if level_errors != 0:
+				break
+			if level_tps < tps * SCALING_GAIN:
+				tps = max(tps, level_tps)
+				break
+			tps = level_tps
+			max_concurrency = concurrency
+	return {"tps" : tps, "single_tps" : single_tps, "ttft" : sum(ttfts) / len(ttfts) if len(ttfts) != 0 else None,
+		"max_concurrency" : max_concurrency, "num_errors" : num_errors}
+
+def judge(result, norm_tps, measured=True):
+	#failed, rejected, demoted or passed, comparing the measured capacity to what instances with the same gpus manage.
+	#A norm that is only the prior (measured False) hasn't been calibrated against anything, so it can at most demote.
+	if result is None:
+		return "failed"
+	ratio = result["tps"] / norm_tps
+	if ratio < REJECT_FRACTION and measured:
+		return "rejected"
+	if ratio < DEMOTE_FRACTION:
+		return "demoted"
+	return "passed"
@@ -0,0 +1,428 @@
+import argparse
+import asyncio
+import json
+import random
+import secrets
+import time
+from threading import Lock
+from aiohttp import web, ClientSession, ClientTimeout, ClientError
+
+from throughput_model import prior_tps, GPU_SPEED
+from prompt_OOBA import MSG_END
+
+#Local stand-in for the parts of the Vast.ai cloud the autoscaler touches. FakeCloud is the control plane: it has the same
+#methods as VastClient, keeps a marketplace of offers, and moves instances through loading -> running -> model loaded (and
+#stopping -> exited) on its clock, with configurable latencies and failure rates. The server below exposes it as the Vast
+#REST API and also plays every instance's model server (/tokens, /auth and the websocket stream), so the autoscaler,
+#load balancer and sim can run against thousands of instances on one machine:
+#	python fake_vast.py --num_instances 1000 --autoscaler_addr 127.0.0.1:8000
+#	VAST_API_URL=http://127.0.0.1:8081/api/v0 python autoscaler_server.py
+
+DEFAULT_GPUS = [("RTX 3090", 1), ("RTX 4090", 1), ("RTX A6000", 1), ("A100 SXM4", 1), ("RTX 4090", 2), ("A100 SXM4", 2), ("RTX A6000", 4), ("RTX 4090", 8)]
+GPU_RAM = {"RTX 3090" : 24000, "RTX 4090" : 24000, "RTX A6000" : 48000, "A100 SXM4" : 80000}
+GPU_DPH = {"RTX 3090" : 0.2, "RTX 4090" : 0.35, "RTX A6000" : 0.45, "A100 SXM4" : 1.2} #per gpu
+BOOT_SECONDS = 120 #image pull and container start for a new instance
+START_SECONDS = 30 #container restart for a stopped instance
+STOP_SECONDS = 10
+LOAD_SECONDS = 300 #model download and load
+WARM_LOAD_SECONDS = 60 #model load from disk on an instance that has loaded it before
+SINGLE_STREAM_FRACTION = 0.25 #one request alone gets this fraction of an instance's throughput
+DEFAULT_NUM_TOKENS = 100
+MAX_TOKEN_BATCH = 10000
+HEARTBEAT_INTERVAL = 10
+MAX_CONCURRENT_HEARTBEATS = 100
+
+class FakeInstance:
+	def __init__(self, id, offer, env, now, boot_seconds, load_seconds, fail):
+		self.id = id
+		self.offer = offer
+		self.env = env
+		self.mtoken = env.get("MASTER_TOKEN")
+		self.intended_status = "running"
+		self.boot_done = now + boot_seconds
+		self.model_ready = self.boot_done + load_seconds
+		self.stop_done = None
+		self.model_on_disk = False
+		self.fail = fail
+		self.tps = None #set by FakeCloud
+		self.active = 0 #requests being served
+
+	def actual_status(self, now):
+		if self.intended_status == "running":
+			return "loading" if now < self.boot_done else "running"
+		return "stopping" if now < self.stop_done else "exited"
+
+	def model_loaded(self, now):
+		return not self.fail and self.intended_status == "running" and now >= self.model_ready
+
+class FakeCloud:
+	def __init__(self, num_offers=1000, model="vllm-13", boot_seconds=BOOT_SECONDS, start_seconds=START_SECONDS, stop_seconds=STOP_SECONDS,
+			load_seconds=LOAD_SECONDS, warm_load_seconds=WARM_LOAD_SECONDS, create_failure_rate=0.0, boot_failure_rate=0.0,
+			public_ipaddr="127.0.0.1", model_ports=(7000,), gpus=DEFAULT_GPUS, seed=0, clock=time.time):
+		self.model = model
+		self.boot_seconds = boot_seconds
+		self.start_seconds = start_seconds
+		self.stop_seconds = stop_seconds
+		self.load_seconds = load_seconds
+		self.warm_load_seconds = warm_load_seconds
+		self.create_failure_rate = create_failure_rate
+		self.boot_failure_rate = boot_failure_rate
+		self.public_ipaddr = public_ipaddr
+		self.model_ports = list(model_ports)
+		self.clock = clock
+		self.random = random.Random(seed)
+
+		self.lock = Lock()
+		self.offers = {} #ask id -> offer
+		self.instances = {} #instance id -> FakeInstance
+		self.mtokens = {} #master token -> instance id
+		self.tokens = {} #unredeemed auth token -> instance id
+		self.next_id = 1000000
+		for _ in range(num_offers):
+			self.add_offer(*self.random.choice(gpus))
+
+	def jitter(self, seconds):
+		return seconds * self.random.uniform(0.5, 1.5)
+
+	def new_id(self):
+		self.next_id += 1
+		return self.next_id
+
+	def add_offer(self, gpu_name, num_gpus):
+		ask_id = self.new_id()
+		dph = round(GPU_DPH.get(gpu_name, 0.3) * num_gpus * self.random.uniform(0.7, 1.3), 3)
+		dlperf = GPU_SPEED.get(gpu_name, 1.0) * num_gpus * 10
+		self.offers[ask_id] = {"id" : ask_id, "ask_contract_id" : ask_id, "machine_id" : ask_id % 100000, "gpu_name" : gpu_name, "num_gpus" : num_gpus,
+			"gpu_ram" : GPU_RAM.get(gpu_name, 24000), "disk_space" : 500.0, "dph_base" : dph, "dph_total" : dph, "dlperf" : dlperf,
+			"dlperf_per_dphtotal" : dlperf / dph, "verified" : True, "external" : False, "rentable" : True, "rented" : False, "reliability2" : 0.99}
+		return ask_id
+
+	################################### control plane, same interface as VastClient ###################################
+	def show_instances(self, timeout=None):
+		now = self.clock()
+		with self.lock:
+			return [self.instance_dict(instance, now) for instance in self.instances.values()]
+
+	def instance_dict(self, instance, now):
+		port = str(self.model_ports[instance.id % len(self.model_ports)])
+		instance_dict = dict(instance.offer)
+		instance_dict.update({"id" : instance.id, "actual_status" : instance.actual_status(now), "intended_status" : instance.intended_status,
+			"status_msg" : "Error response from daemon: fake boot failure" if instance.fail and now >= instance.boot_done else None,
+			"public_ipaddr" : self.public_ipaddr, "ports" : {"5000/tcp" : [{"HostPort" : port}], "5005/tcp" : [{"HostPort" : port}]},
+			"ssh_host" : self.public_ipaddr, "ssh_port" : 1})
+		return instance_dict
+
+	def search_offers(self, query, timeout=None):
+		with self.lock:
+			offers = [dict(offer) for offer in self.offers.values() if offer_matches(offer, query)]
+		for field, direction in query.get("order", []):
+			offers.sort(key=lambda offer: offer.get(field) or 0, reverse=(direction == "desc"))
+		return offers
+
+	def create_instance(self, ask_id, image, disk, env, onstart_cmd=None, timeout=None):
+		now = self.clock()
+		with self.lock:
+			offer = self.offers.get(ask_id)
+			if offer is None or offer["rented"] or self.random.random() < self.create_failure_rate:
+				return None
+			offer["rented"] = True
+			id = self.new_id()
+			fail = self.random.random() < self.boot_failure_rate
+			instance = FakeInstance(id, dict(offer), dict(env), now, self.jitter(self.boot_seconds), self.jitter(self.load_seconds), fail)
+			instance.tps = prior_tps(offer, self.model) * self.random.uniform(0.7, 1.3)
+			self.instances[id] = instance
+			if instance.mtoken is not None:
+				self.mtokens[instance.mtoken] = id
+		return id
+
+	def start_instance(self, instance_id, timeout=None):
+		now = self.clock()
+		with self.lock:
+			instance = self.instances.get(instance_id)
+			if instance is None:
+				return False
+			if instance.intended_status != "running":
+				instance.intended_status = "running"
+				instance.boot_done = max(now, instance.stop_done) + self.jitter(self.start_seconds)
+				load_seconds = self.warm_load_seconds if instance.model_on_disk else self.load_seconds
+				instance.model_ready = instance.boot_done + self.jitter(load_seconds)
+		return True
+
+	def stop_instance(self, instance_id, timeout=None):
+		now = self.clock()
+		with self.lock:
+			instance = self.instances.get(instance_id)
+			if instance is None:
+				return False
+			if instance.intended_status == "running":
+				instance.model_on_disk = instance.model_on_disk or now >= instance.model_ready
+				instance.intended_status = "stopped"
+				instance.stop_done = now + self.jitter(self.stop_seconds)
+		return True
+
+	def destroy_instance(self, instance_id, timeout=None):
+		with self.lock:
+			instance = self.instances.pop(instance_id, None)
+			if instance is None:
+				return False
+			self.mtokens.pop(instance.mtoken, None)
+			if instance.offer["id"] in self.offers:
+				self.offers[instance.offer["id"]]["rented"] = False
+		return True
+
+	def add_instances(self, num_instances, loaded=True):
+		#instances that already exist when the cloud starts, returns id -> master token so they can be put in the InstanceStore
+		now = self.clock()
+		mtokens = {}
+		asks = [offer["id"] for offer in self.search_offers({"rented" : {"eq" : False}})[:num_instances]]
+		for ask_id in asks:
+			mtoken = secrets.token_hex(32)
+			id = self.create_instance(ask_id, None, None, {"MASTER_TOKEN" : mtoken})
+			if id is None:
+				continue
+			if loaded:
+				with self.lock:
+					self.instances[id].boot_done = now
+					self.instances[id].model_ready = now
+			mtokens[id] = mtoken
+		return mtokens
+
+	################################### model servers ###################################
+	def issue_tokens(self, mtoken, num_tokens):
+		now = self.clock()
+		with self.lock:
+			id = self.mtokens.get(mtoken)
+			if id is None or not self.instances[id].model_loaded(now):
+				return None
+			tokens = [secrets.token_hex(16) for _ in range(min(num_tokens, MAX_TOKEN_BATCH))]
+			for token in tokens:
+				self.tokens[token] = id
+		return tokens
+
+	def redeem_token(self, token):
+		#auth tokens are single use, the master token is always accepted (the autoscaler's test prompts use it)
+		now = self.clock()
+		with self.lock:
+			id = self.tokens.pop(token, None)
+			if id is None:
+				id = self.mtokens.get(token)
+			instance = self.instances.get(id)
+			if instance is None or not instance.model_loaded(now):
+				return None
+			return instance
+
+	def begin_request(self, instance, num_tokens):
+		#returns the seconds the request will take: an instance's throughput is shared by the requests it is serving
+		with self.lock:
+			instance.active += 1
+			request_tps = min(instance.tps * SINGLE_STREAM_FRACTION, instance.tps / instance.active)
+		return num_tokens / request_tps
+
+	def end_request(self, instance):
+		with self.lock:
+			instance.active -= 1
+
+	def heartbeats(self):
+		now = self.clock()
+		with self.lock:
+			return [(instance.env.get("AUTOSCALER_ADDR"), {"id" : instance.id, "mtoken" : instance.mtoken, "model_loaded" : instance.model_loaded(now),
+				"tps" : instance.tps if instance.model_loaded(now) else None, "queue_depth" : instance.active})
+				for instance in self.instances.values() if instance.actual_status(now) == "running" and not instance.fail]
+
+OPS = {"eq" : lambda a, b: a == b, "neq" : lambda a, b: a != b, "gt" : lambda a, b: a > b, "gte" : lambda a, b: a >= b,
+	"lt" : lambda a, b: a < b, "lte" : lambda a, b: a <= b, "in" : lambda a, b: a in b}
+
+def offer_matches(offer, query):
+	for field, conditions in query.items():
+		if not isinstance(conditions, dict) or field not in offer:
+			continue
+		for op, value in conditions.items():
+			if op in OPS and (offer[field] is None or not OPS[op](offer[field], value)):
+				return False
+	return True
+
+################################### server ###################################
+routes = web.RouteTableDef()
+
+def get_cloud(request):
+	return request.app["cloud"]
+
+async def api_delay(request):
+	#simulated control plane latency and errors, returns an error response or None
+	config = request.app["config"]
+	if config.api_latency > 0:
+		await asyncio.sleep(config.api_latency * random.uniform(0.5, 1.5))
+	if random.random() < config.api_error_rate:
+		return web.Response(status=503, text="fake api error")
+	return None
+
+@routes.get('/api/v0/instances/')
+async def show_instances(request):
+	error = await api_delay(request)
+	return error or web.json_response({"instances" : get_cloud(request).show_instances()})
+
+@routes.get('/api/v0/bundles/')
+async def search_offers(request):
+	error = await api_delay(request)
+	return error or web.json_response({"offers" : get_cloud(request).search_offers(json.loads(request.query.get("q", "{}")))})
+
+@routes.put('/api/v0/instances/{id}/')
+async def change_state(request):
+	error = await api_delay(request)
+	if error:
+		return error
+	cloud = get_cloud(request)
+	instance_id = int(request.match_info["id"])
+	state = (await request.json()).get("state")
+	success = cloud.start_instance(instance_id) if state == "running" else cloud.stop_instance(instance_id)
+	return web.json_response({"success" : success})
+
+@routes.delete('/api/v0/instances/{id}/')
+async def destroy_instance(request):
+	error = await api_delay(request)
+	return error or web.json_response({"success" : get_cloud(request).destroy_instance(int(request.match_info["id"]))})
+
+@routes.put('/api/v0/asks/{id}/')
+async def create_instance(request):
+	error = await api_delay(request)
+	if error:
+		return error
+	data = await request.json()
+	new_id = get_cloud(request).create_instance(int(request.match_info["id"]), data.get("image"), data.get("disk"), data.get("env", {}), data.get("onstart"))
+	if new_id is None:
+		return web.json_response({"success" : False, "error" : "no_such_ask"})
+	return web.json_response({"success" : True, "new_contract" : new_id})
+
+@routes.get('/tokens')
+async def get_tokens(request):
+	data = await request.json()
+	tokens = get_cloud(request).issue_tokens(data.get("mtoken"), data.get("num_tokens", DEFAULT_NUM_TOKENS))
+	if tokens is None:
+		return web.Response(status=401)
+	return web.json_response({"tokens" : tokens})
+
+def fake_response(num_tokens):
+	return " ".join("tok" for _ in range(num_tokens))
+
+@routes.post('/auth')
+async def generate(request):
+	data = await request.json()
+	cloud = get_cloud(request)
+	instance = cloud.redeem_token(data.get("token"))
+	if instance is None:
+		return web.json_response({"error" : "unauthorized", "response" : None, "num_tokens" : 0})
+	num_tokens = data["model"].get("max_new_tokens", DEFAULT_NUM_TOKENS)
+	try:
+		await asyncio.sleep(cloud.begin_request(instance, num_tokens))
+	finally:
+		cloud.end_request(instance)
+	return web.json_response({"error" : None, "response" : fake_response(num_tokens), "num_tokens" : num_tokens})
+
+async def receive_message(ws):
+	#messages end with a separate MSG_END frame, like the real model server expects
+	parts = []
+	async for msg in ws:
+		if msg.data == MSG_END:
+			break
+		parts.append(msg.data)
+	return "".join(parts)
+
+@routes.get('/')
+async def generate_streaming(request):
+	ws = web.WebSocketResponse()
+	await ws.prepare(request)
+	cloud = get_cloud(request)
+	instance = cloud.redeem_token(await receive_message(ws))
+	await receive_message(ws)
+	if instance is None:
+		await ws.close()
+		return ws
+	num_tokens = DEFAULT_NUM_TOKENS
+	try:
+		gap = cloud.begin_request(instance, num_tokens) / num_tokens
+		for _ in range(num_tokens):
+			await asyncio.sleep(gap)
+			await ws.send_str("tok ")
+	except ConnectionResetError:
+		pass
+	finally:
+		cloud.end_request(instance)
+	await ws.close()
+	return ws
+
+async def send_heartbeats(app):
+	#every running model server posts to the autoscaler it was created by, or to --autoscaler_addr
+	cloud = app["cloud"]
+	config = app["config"]
+	semaphore = asyncio.Semaphore(MAX_CONCURRENT_HEARTBEATS)
+	async with ClientSession(timeout=ClientTimeout(total=5)) as session:
+		async def post(addr, heartbeat):
+			async with semaphore:
+				try:
+					async with session.post(f"http://{addr}/heartbeat", json=heartbeat) as response:
+						await response.read()
+				except (ClientError, asyncio.TimeoutError):
+					pass
+		while True:
+			heartbeats = [(addr or config.autoscaler_addr, heartbeat) for addr, heartbeat in cloud.heartbeats()]
+			await asyncio.gather(*[post(addr, heartbeat) for addr, heartbeat in heartbeats if addr is not None])
+			await asyncio.sleep(config.heartbeat_interval)
+
+async def start_background(app):
+	app["heartbeats"] = asyncio.create_task(send_heartbeats(app))
+
+async def stop_background(app):
+	app["heartbeats"].cancel()
+
+def make_app(cloud, config):
+	app = web.Application()
+	app["cloud"] = cloud
+	app["config"] = config
+	app.add_routes(routes)
+	app.on_startup.append(start_background)
+	app.on_cleanup.append(stop_background)
+	return app
+
+async def serve(app, config):
+	runner = web.AppRunner(app, access_log=None)
+	await runner.setup()
+	for port in [config.port] + list(range(config.model_port, config.model_port + config.num_model_ports)):
+		await web.TCPSite(runner, "0.0.0.0", port).start()
+	print(f"[fake_vast] api on http://127.0.0.1:{config.port}/api/v0, model servers on ports {config.model_port}-{config.model_port + config.num_model_ports - 1}")
+	await asyncio.Event().wait()
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--port", type=int, default=8081)
+	parser.add_argument("--model_port", type=int, default=7000, help="first port the emulated model servers listen on")
+	parser.add_argument("--num_model_ports", type=int, default=16, help="instances are spread over this many ports, requests are routed by token")
+	parser.add_argument("--model", type=str, default="vllm-13")
+	parser.add_argument("--num_offers", type=int, default=1000)
+	parser.add_argument("--num_instances", type=int, default=0, help="hot instances that already exist, registered in --store")
+	parser.add_argument("--store", type=str, default="instance_info/instances.db")
+	parser.add_argument("--boot_seconds", type=float, default=BOOT_SECONDS)
+	parser.add_argument("--start_seconds", type=float, default=START_SECONDS)
+	parser.add_argument("--load_seconds", type=float, default=LOAD_SECONDS)
+	parser.add_argument("--warm_load_seconds", type=float, default=WARM_LOAD_SECONDS)
+	parser.add_argument("--create_failure_rate", type=float, default=0.0)
+	parser.add_argument("--boot_failure_rate", type=float, default=0.0)
+	parser.add_argument("--api_latency", type=float, default=0.0, help="mean seconds added to every control plane call")
+	parser.add_argument("--api_error_rate", type=float, default=0.0)
+	parser.add_argument("--autoscaler_addr", type=str, default=None, help="where instances without AUTOSCALER_ADDR post heartbeats")
+	parser.add_argument("--heartbeat_interval", type=float, default=HEARTBEAT_INTERVAL)
+	config = parser.parse_args()
+
+	cloud = FakeCloud(num_offers=config.num_offers, model=config.model, boot_seconds=config.boot_seconds, start_seconds=config.start_seconds,
+		load_seconds=config.load_seconds, warm_load_seconds=config.warm_load_seconds, create_failure_rate=config.create_failure_rate,
+		boot_failure_rate=config.boot_failure_rate, model_ports=range(config.model_port, config.model_port + config.num_model_ports))
+	if config.num_instances > 0:
+		from instance_store import InstanceStore
+		store = InstanceStore(config.store)
+		for id, mtoken in cloud.add_instances(config.num_instances).items():
+			store.put(id, {"mtoken" : mtoken, "model" : config.model, "model_loaded" : None, "tps" : None, "created_at" : time.time()})
+		store.close()
+		print(f"[fake_vast] registered {config.num_instances} instances in {config.store}")
+	asyncio.run(serve(make_app(cloud, config), config))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,75 @@
+import math
+
+BUCKETS_PER_DOUBLING = 8 #bucket bounds grow by 2 ** (1 / 8), so a reported percentile is within ~4.5% of the true value
+MIN_VALUE = 1e-4 #anything smaller lands in bucket 0
+PERCENTILES = [50, 90, 99, 99.9]
+
+#Histogram with logarithmically sized buckets: constant memory and O(1) record whatever the range of values, and
+#histograms merge by adding bucket counts, so each thread can keep its own and they're combined only when reported.
+class LogHistogram:
+	def __init__(self):
+		self.buckets = {} #bucket index -> count
+		self.count = 0
+		self.total = 0.0
+		self.min = float('inf')
+		self.max = 0.0
+
+	@staticmethod
+	def bucket(value):
+		if value <= MIN_VALUE:
+			return 0
+		return 1 + int(math.log2(value / MIN_VALUE) * BUCKETS_PER_DOUBLING)
+
+	@staticmethod
+	def bucket_value(index):
+		#geometric middle of the bucket
+		if index == 0:
+			return MIN_VALUE
+		return MIN_VALUE * 2 ** ((index - 0.5) / BUCKETS_PER_DOUBLING)
+
+	@staticmethod
+	def bucket_upper_bound(index):
+		return MIN_VALUE * 2 ** (index / BUCKETS_PER_DOUBLING)
+
+	def record(self, value):
+		index = self.bucket(value)
+		self.buckets[index] = self.buckets.get(index, 0) + 1
+		self.count += 1
+		self.total += value
+		self.min = min(self.min, value)
+		self.max = max(self.max, value)
+
+	def merge(self, other):
+		for index, count in other.buckets.items():
+			self.buckets[index] = self.buckets.get(index, 0) + count
+		self.count += other.count
+		self.total += other.total
+		self.min = min(self.min, other.min)
+		self.max = max(self.max, other.max)
+
+	def mean(self):
+		return self.total / self.count if self.count != 0 else 0.0
+
+	def percentile(self, p):
+		if self.count == 0:
+			return 0.0
+		rank = max(1, math.ceil(p / 100 * self.count))
+		seen = 0
+		for index in sorted(self.buckets):
+			seen += self.buckets[index]
+			if seen >= rank:
+				return min(self.max, max(self.min, self.bucket_value(index)))
+		return self.max
+
+	def summary(self):
+		summary = {"count" : self.count, "mean" : self.mean(), "min" : self.min if self.count != 0 else 0.0, "max" : self.max}
+		for p in PERCENTILES:
+			summary[f"p{p:g}"] = self.percentile(p)
+		return summary
+
+	def to_dict(self):
+		#summary plus the raw buckets as upper bound -> count, enough to compare runs or rebuild the histogram
+		return dict(self.summary(), buckets={f"{self.bucket_upper_bound(index):.6g}" : self.buckets[index] for index in sorted(self.buckets)})
+
+	def format(self, unit=""):
+		return ", ".join(f"{name}: {value}" if name == "count" else f"{name}: {value:.4g}{unit}" for name, value in self.summary().items())
@@ -0,0 +1,85 @@
+#Min-heap of (priority, key, value) entries that also tracks where each key sits, so an entry's priority can be
+#raised or lowered, or the entry removed, in O(log n) without rebuilding the heap. Ties are broken by key.
+class IndexedHeap:
+	def __init__(self):
+		self.heap = [] #list of [priority, key, value]
+		self.index = {} #key -> position in self.heap
+
+	def __len__(self):
+		return len(self.heap)
+
+	def __contains__(self, key):
+		return key in self.index
+
+	def keys(self):
+		return list(self.index.keys())
+
+	def get(self, key):
+		return self.heap[self.index[key]][2]
+
+	def priority(self, key):
+		return self.heap[self.index[key]][0]
+
+	def peek(self):
+		if len(self.heap) == 0:
+			return None
+		priority, key, value = self.heap[0]
+		return priority, key, value
+
+	def push(self, key, priority, value):
+		if key in self.index:
+			self.set_value(key, value)
+			self.update(key, priority)
+			return
+		self.heap.append([priority, key, value])
+		self.index[key] = len(self.heap) - 1
+		self.sift_up(len(self.heap) - 1)
+
+	def set_value(self, key, value):
+		self.heap[self.index[key]][2] = value
+
+	def update(self, key, priority):
+		i = self.index[key]
+		old_priority = self.heap[i][0]
+		self.heap[i][0] = priority
+		if priority < old_priority:
+			self.sift_up(i)
+		else:
+			self.sift_down(i)
+
+	def remove(self, key):
+		i = self.index.pop(key)
+		last = self.heap.pop()
+		if i < len(self.heap):
+			self.heap[i] = last
+			self.index[last[1]] = i
+			self.sift_up(i)
+			self.sift_down(self.index[last[1]])
+
+	def less(self, i, j):
+		return (self.heap[i][0], self.heap[i][1]) < (self.heap[j][0], self.heap[j][1])
+
+	def swap(self, i, j):
+		self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+		self.index[self.heap[i][1]] = i
+		self.index[self.heap[j][1]] = j
+
+	def sift_up(self, i):
+		while i > 0:
+			parent = (i - 1) // 2
+			if not self.less(i, parent):
+				break
+			self.swap(i, parent)
+			i = parent
+
+	def sift_down(self, i):
+		n = len(self.heap)
+		while True:
+			smallest = i
+			for child in (2 * i + 1, 2 * i + 2):
+				if child < n and self.less(child, smallest):
+					smallest = child
+			if smallest == i:
+				break
+			self.swap(i, smallest)
+			i = smallest
@@ -1,31 +1,110 @@
 import requests
-from queue import Queue
+from queue import Queue, Empty
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 import time
 
+from ratio_manager import update_rolling_average
+
+LOW_WATER_SECONDS = 10 #refill once the tokens on hand cover less than this many seconds of demand
+HIGH_WATER_SECONDS = 30 #and refill up to this many seconds of demand
+MIN_LOW_WATER = 20
+MIN_BATCH_SIZE = 50
+MAX_BATCH_SIZE = 2000
+RATE_DECAY = 0.1 #how quickly the consumption rate estimate forgets old demand
+REQUEST_TIMEOUT = 5
+MAX_CONCURRENT_REFILLS = 32
+
+#shared by every InstanceClient, so refills for different instances run concurrently off the request path
+refill_executor = ThreadPoolExecutor(MAX_CONCURRENT_REFILLS)
+
 class InstanceClient:
     def __init__(self, instance_id, instance_addr, mtoken):
         self.instance_id = instance_id
         self.instance_addr = instance_addr
         self.mtoken = mtoken
         self.token_queue = Queue()
-        self.monitor_token_queue()
 
-    def monitor_token_queue(self):
-        print(f"[instance_client] monitoring token queue with size : {self.token_queue.qsize()}")
-        if self.token_queue.qsize() < 100:
-            new_tokens = self.get_tokens()
+        self.lock = Lock()
+        self.refilling = False
+        self.num_consumed = 0 #since the last rate update
+        self.consumption_rate = 0.0 #tokens per second
+        self.last_rate_update = time.time()
+        self.num_stalls = 0 #times a token was wanted but none were on hand
+
+        self.request_refill()
+
+    def low_water(self):
+        return max(MIN_LOW_WATER, self.consumption_rate * LOW_WATER_SECONDS)
+
+    def high_water(self):
+        return max(2 * MIN_LOW_WATER, self.consumption_rate * HIGH_WATER_SECONDS)
+
+    def batch_size(self):
+        return int(min(max(self.high_water() - self.token_queue.qsize(), MIN_BATCH_SIZE), MAX_BATCH_SIZE))
+
+    def take_token(self):
+        #never blocks, returns None when the queue is empty and a refill is already on its way
+        try:
+            token = self.token_queue.get_nowait()
+        except Empty:
+            self.lock.acquire()
+            self.num_stalls += 1
+            self.lock.release()
+            self.request_refill()
+            return None
+        self.lock.acquire()
+        self.num_consumed += 1
+        self.lock.release()
+        if self.token_queue.qsize() < self.low_water():
+            self.request_refill()
+        return token
+
+    def update_consumption_rate(self):
+        self.lock.acquire()
+        now = time.time()
+        elapsed = now - self.last_rate_update
+        if elapsed > 0:
+            self.consumption_rate = update_rolling_average(self.consumption_rate, self.num_consumed / elapsed, elapsed, RATE_DECAY)
+            self.num_consumed = 0
+            self.last_rate_update = now
+        self.lock.release()
+
+    def request_refill(self):
+        self.lock.acquire()
+        if self.refilling:
+            self.lock.release()
+            return
+        self.refilling = True
+        self.lock.release()
+        refill_executor.submit(self.refill)
+
+    def refill(self):
+        try:
+            self.update_consumption_rate()
+            new_tokens = self.get_tokens(self.batch_size())
             for t in new_tokens:
                 self.token_queue.put(t)
-            print(f"[instance_client] new tokens returned, now token queue with size : {self.token_queue.qsize()}")
+        finally:
+            self.lock.acquire()
+            self.refilling = False
+            self.lock.release()
 
-    def get_tokens(self):
-        # print(f"[instance_client] getting tokens for instance: {self.instance_id}")
+    def monitor_token_queue(self):
+        self.update_consumption_rate()
+        if self.token_queue.qsize() < self.low_water():
+            self.request_refill()
+        print(f"[instance_client] instance {self.instance_id} token queue size: {self.token_queue.qsize()}, consumption rate: {self.consumption_rate:.2f}/s, stalls: {self.num_stalls}")
+
+    def get_tokens(self, num_tokens):
         URI = f'http://{self.instance_addr}/tokens'
-        request_dict = {"mtoken" : self.mtoken}
-        t1 = time.time()
-        response = requests.get(URI, json=request_dict)
-        t2 = time.time()
-        # print(f"[instance_client] got tokens in {t2 - t1} and status code is {response.status_code}")
+        request_dict = {"mtoken" : self.mtoken, "num_tokens" : num_tokens}
+        try:
+            response = requests.get(URI, json=request_dict, timeout=REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            print(f"[instance_client] failed to get tokens for instance: {self.instance_id}: {e}")
+            return []
         if response.status_code == 200:
             return response.json()["tokens"]
-
+        print(f"[instance_client] getting tokens for instance: {self.instance_id} returned status code {response.status_code}")
+        return []
@@ -0,0 +1,155 @@
+import os
+import json
+import glob
+import time
+import sqlite3
+from threading import Lock
+
+INSTANCE_STORE_PATH = "instance_info/instances.db"
+LEGACY_INSTANCE_DIR = "instance_info"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+	id INTEGER PRIMARY KEY,
+	mtoken TEXT NOT NULL,
+	model TEXT,
+	model_loaded REAL,
+	tps REAL,
+	created_at REAL,
+	benchmark TEXT
+);
+CREATE TABLE IF NOT EXISTS machine_history (
+	machine_id INTEGER NOT NULL,
+	instance_id INTEGER NOT NULL,
+	tps REAL,
+	time_to_hot REAL,
+	updated_at REAL,
+	ttft REAL,
+	model TEXT,
+	gpu_name TEXT,
+	num_gpus INTEGER,
+	max_concurrency INTEGER,
+	bench_tps REAL,
+	PRIMARY KEY (machine_id, instance_id)
+);
+"""
+INSTANCE_FIELDS = ["mtoken", "model", "model_loaded", "tps", "created_at", "benchmark"] #benchmark is the instance's verdict, see benchmark.py
+#tps is whatever was measured last (heartbeats, the loadbalancer's capacity estimate), bench_tps is only ever the capacity benchmark.py measured
+MACHINE_FIELDS = ["tps", "time_to_hot", "ttft", "model", "gpu_name", "num_gpus", "max_concurrency", "bench_tps"]
+#not in databases made by older versions
+ADDED_COLUMNS = {
+	"instances" : {"benchmark" : "TEXT"},
+	"machine_history" : {"ttft" : "REAL", "model" : "TEXT", "gpu_name" : "TEXT", "num_gpus" : "INTEGER", "max_concurrency" : "INTEGER", "bench_tps" : "REAL"},
+}
+
+#Instance metadata (master tokens and load state) plus per-machine performance history in one SQLite database.
+#WAL mode lets the autoscaler and scripts like create_instances.py read and write it at the same time.
+class InstanceStore:
+	def __init__(self, path=INSTANCE_STORE_PATH):
+		os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+		self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+		self.conn.row_factory = sqlite3.Row
+		self.lock = Lock()
+		with self.lock, self.conn:
+			self.conn.execute("PRAGMA journal_mode=WAL")
+			self.conn.execute("PRAGMA synchronous=NORMAL")
+			self.conn.executescript(SCHEMA)
+			for table, added in ADDED_COLUMNS.items():
+				columns = set(row["name"] for row in self.conn.execute(f"PRAGMA table_info({table})"))
+				for column, type in added.items():
+					if column not in columns:
+						self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {type}")
+		if path != ":memory:": #in-memory stores (the discrete-event sim's) start empty
+			self.import_legacy_json(os.path.dirname(path) or LEGACY_INSTANCE_DIR)
+
+	def import_legacy_json(self, dirpath):
+		#one-time migration of the old instance_info/{id}.json files
+		with self.lock:
+			if self.conn.execute("SELECT COUNT(*) FROM instances").fetchone()[0] != 0:
+				return
+		rows = []
+		for filepath in glob.glob(os.path.join(dirpath, "*.json")):
+			name = os.path.splitext(os.path.basename(filepath))[0]
+			if not name.isdigit():
+				continue
+			with open(filepath, "r") as f:
+				try:
+					instance_log = json.load(f)
+				except json.decoder.JSONDecodeError:
+					continue
+			if "mtoken" in instance_log.keys():
+				rows.append((int(name), instance_log["mtoken"], instance_log.get("model"), instance_log.get("model_loaded"), instance_log.get("tps"), None))
+		if len(rows) != 0:
+			with self.lock, self.conn:
+				self.conn.executemany("INSERT OR IGNORE INTO instances (id, mtoken, model, model_loaded, tps, created_at) VALUES (?, ?, ?, ?, ?, ?)", rows)
+			print(f"[instance_store] imported {len(rows)} legacy instance files")
+
+	def row_to_info(self, row):
+		return {field : row[field] for field in INSTANCE_FIELDS}
+
+	def load_all(self):
+		with self.lock:
+			rows = self.conn.execute("SELECT * FROM instances").fetchall()
+		return {row["id"] : self.row_to_info(row) for row in rows}
+
+	def get_many(self, instance_ids):
+		instance_ids = list(instance_ids)
+		infos = {}
+		for i in range(0, len(instance_ids), 500): #stays under sqlite's bound parameter limit
+			batch = instance_ids[i:i + 500]
+			with self.lock:
+				rows = self.conn.execute(f"SELECT * FROM instances WHERE id IN ({','.join('?' * len(batch))})", batch).fetchall()
+			for row in rows:
+				infos[row["id"]] = self.row_to_info(row)
+		return infos
+
+	def put(self, instance_id, info):
+		values = [info.get(field) for field in INSTANCE_FIELDS]
+		with self.lock, self.conn:
+			self.conn.execute(f"INSERT OR REPLACE INTO instances (id, {', '.join(INSTANCE_FIELDS)}) VALUES ({', '.join('?' * (len(INSTANCE_FIELDS) + 1))})", [instance_id] + values)
+
+	def update(self, instance_id, **fields):
+		fields = {field : value for field, value in fields.items() if field in INSTANCE_FIELDS}
+		if len(fields) == 0:
+			return
+		assignments = ", ".join(f"{field} = ?" for field in fields.keys())
+		with self.lock, self.conn:
+			self.conn.execute(f"UPDATE instances SET {assignments} WHERE id = ?", list(fields.values()) + [instance_id])
+
+	def record_machines(self, rows):
+		#each row is a dict with machine_id, instance_id and any of MACHINE_FIELDS. Keeps the latest non-null value of
+		#each field for that instance on that machine.
+		updated_at = time.time()
+		values = [[row["machine_id"], row["instance_id"]] + [row.get(field) for field in MACHINE_FIELDS] + [updated_at] for row in rows]
+		assignments = ", ".join(f"{field} = COALESCE(excluded.{field}, {field})" for field in MACHINE_FIELDS)
+		with self.lock, self.conn:
+			self.conn.executemany(f"""INSERT INTO machine_history (machine_id, instance_id, {', '.join(MACHINE_FIELDS)}, updated_at)
+				VALUES ({', '.join('?' * (len(MACHINE_FIELDS) + 3))})
+				ON CONFLICT (machine_id, instance_id) DO UPDATE SET {assignments}, updated_at = excluded.updated_at""", values)
+
+	def load_machine_stats(self, machine_ids=None, model=None):
+		#averages over every instance we've had on each machine. With model, only that model's measurements (and ones
+		#recorded before the model was, which can't be told apart) are used.
+		query = """SELECT machine_id, AVG(tps) AS tps, AVG(ttft) AS ttft, AVG(time_to_hot) AS time_to_hot, COUNT(*) AS num_samples,
+			MAX(gpu_name) AS gpu_name, MAX(num_gpus) AS num_gpus, AVG(max_concurrency) AS max_concurrency, AVG(bench_tps) AS bench_tps FROM machine_history"""
+		conditions = []
+		params = []
+		if machine_ids is not None:
+			machine_ids = list(machine_ids)
+			if len(machine_ids) == 0:
+				return {}
+			conditions.append(f"machine_id IN ({','.join('?' * len(machine_ids))})")
+			params += machine_ids
+		if model is not None:
+			conditions.append("(model = ? OR model IS NULL)")
+			params.append(model)
+		if len(conditions) != 0:
+			query += " WHERE " + " AND ".join(conditions)
+		query += " GROUP BY machine_id"
+		with self.lock:
+			rows = self.conn.execute(query, params).fetchall()
+		return {row["machine_id"] : {field : row[field] for field in ["tps", "ttft", "time_to_hot", "num_samples", "gpu_name", "num_gpus", "max_concurrency", "bench_tps"]} for row in rows}
+
+	def close(self):
+		with self.lock:
+			self.conn.close()
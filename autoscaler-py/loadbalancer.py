@@ -1,17 +1,40 @@
-from collections import defaultdict
 from threading import Thread, Lock, Event
-from concurrent.futures import ThreadPoolExecutor, wait
-from queue import PriorityQueue
+from itertools import count
 import time
 
 from autoscaler_client import Client
 from instance_client import InstanceClient
 from autoscaler import get_model_address
+from indexed_heap import IndexedHeap
+from throughput_model import ThroughputModel
+from prom_metrics import REGISTRY, FAST_BUCKETS
 
 TIME_INTERVAL_SECONDS = 5
-FULL_LOAD_THRESHOLD = 2.5
-DEFAULT_TPS = 35.0
-MAX_CONCURRENCY = 100
+FULL_LOAD_THRESHOLD = 2.5 #seconds of queued work at which an instance counts as busy
+LEASE_TIMEOUT = 120 #leases that are never released stop counting as in flight after this many seconds
+LEASE_OVERDUE_FACTOR = 3.0 #and their work comes off the queue once they've taken this many times longer than expected
+UNMEASURED_LATENCY_FACTOR = 4.0 #until requests on an instance have completed, one is expected to take this many times its share of capacity
+HOT_WAIT_SECONDS = 30 #how long each long poll for changes to the hot set waits
+
+CONNECT_SECONDS = REGISTRY.histogram("lb_connect_seconds", "Time to pick instances and auth tokens for /connect and /connect_batch, including waiting for the lock", ["op"], buckets=FAST_BUCKETS)
+CONNECT = CONNECT_SECONDS.labels("connect")
+CONNECT_BATCH = CONNECT_SECONDS.labels("connect_batch")
+LEASES = REGISTRY.counter("lb_leases_total", "Leases asked for, by whether an instance with an auth token on hand was found", ["outcome"])
+LEASED = LEASES.labels("leased")
+NO_ADDR = LEASES.labels("no_addr")
+RELEASES = REGISTRY.counter("lb_releases_total", "Lease releases, by whether the lease was still known", ["outcome"])
+RELEASED = RELEASES.labels("released")
+UNKNOWN_RELEASE = RELEASES.labels("unknown")
+EXPIRED_LEASES = REGISTRY.counter("lb_expired_leases_total", "Leases dropped after LEASE_TIMEOUT without being released")
+TICK_SECONDS = REGISTRY.histogram("lb_tick_seconds", "Loadbalancer tick, from estimating load to reporting it", buckets=FAST_BUCKETS + (0.25, 0.5, 1.0, 2.5, 5.0))
+OVERDUE_LEASES = REGISTRY.counter("lb_overdue_leases_total", "Unreleased leases whose work was taken off their instance's queue because they were overdue")
+OUTSTANDING_LEASES = REGISTRY.gauge("lb_outstanding_leases", "Leases handed out and not yet released")
+TOKEN_QUEUE_DEPTH = REGISTRY.gauge("lb_token_queue_depth", "Auth tokens on hand for each hot instance", ["instance"])
+TOKEN_CONSUMPTION_RATE = REGISTRY.gauge("lb_token_consumption_rate", "Auth tokens used per second by each hot instance", ["instance"])
+TOKEN_STALLS = REGISTRY.counter("lb_token_stalls_total", "Times a hot instance was skipped because it had no auth token on hand", ["instance"])
+QUEUE_DURATION = REGISTRY.gauge("lb_queue_duration_seconds", "Seconds of each hot instance's capacity taken up by its unreleased leases", ["instance"])
+IN_FLIGHT = REGISTRY.gauge("lb_in_flight", "Unreleased leases on each hot instance", ["instance"])
+INSTANCE_TPS = REGISTRY.gauge("lb_instance_tokens_per_second", "Estimated tokens/s each hot instance can serve", ["instance"])
 
 def get_address_auth(instance):
 	addr = instance["public_ipaddr"] + ":" + instance["ports"]["5000/tcp"][0]["HostPort"]
@@ -19,99 +42,309 @@ def get_address_auth(instance):
 	return addr
 
 class LoadBalancer:
-	def __init__(self, autoscaler_args):
-		self.client = Client()
+	#client, instance_client and clock default to the real autoscaler server, auth servers and wall clock. The discrete-event
+	#sim passes in its own and calls update_hot_queue/tick_duration itself instead of starting the background threads.
+	def __init__(self, autoscaler_args, client=None, instance_client=InstanceClient, clock=time.time, background=True):
+		self.client = client if client is not None else Client()
+		self.instance_client = instance_client
+		self.clock = clock
 
-		self.old_hot_ids = [] #need a better system to delay busy classification of new instances
-		self.hot_queue = PriorityQueue()
+		self.old_hot_ids = set() #need a better system to delay busy classification of new instances
+		self.hot_queue = IndexedHeap() #instance id -> hot instance, ordered by queue duration
 		self.num_hot = 0
-		self.queue_duration = defaultdict(int)
 		self.instance_clients = {}
+		self.throughput = ThroughputModel(model=autoscaler_args.get("model"), clock=clock)
+
+		#every address handed out is a lease that is charged to its instance until the client releases it
+		self.leases = {} #lease id -> (instance id, queue cost, num_tokens, time leased), in the order they were leased
+		self.lease_due = IndexedHeap() #lease id -> when its work should be done, for leases whose cost is still queued
+		self.in_flight = {} #instance id -> number of unreleased leases
+		self.lease_ids = count()
+		self.num_requested = 0 #leases asked for since the last tick, including ones that couldn't be filled
+		self.tokens_requested = 0
+		self.last_tick = clock()
 
 		self.lock = Lock()
 		self.exit_event = Event()
 
 		self.streaming = autoscaler_args["streaming"]
 
+		self.register_metrics()
 		self.client.setup_autoscaler(autoscaler_args=autoscaler_args)
 		self.update_hot_queue()
-		self.bt = Thread(target=self.tick_background, args=(self.exit_event, ))
-		self.bt.start()
+		self.bt = None
+		self.hot_thread = None
+		if background:
+			self.bt = Thread(target=self.tick_background, args=(self.exit_event, ))
+			self.bt.start()
+			self.hot_thread = Thread(target=self.watch_hot_instances, args=(self.exit_event, ))
+			self.hot_thread.start()
 
-	def update_hot_queue(self):
-		hot_instances = self.client.get_hot_instances()
+	def register_metrics(self):
+		#computed when /metrics is scraped, so keeping them costs nothing on the request path
+		def per_instance(fn):
+			def read():
+				self.lock.acquire()
+				values = {(str(id),) : fn(id) for id in self.hot_queue.keys()}
+				self.lock.release()
+				return values
+			return read
+		OUTSTANDING_LEASES.set_function(lambda: len(self.leases))
+		TOKEN_QUEUE_DEPTH.set_function(per_instance(lambda id: self.instance_clients[id].token_queue.qsize()))
+		TOKEN_CONSUMPTION_RATE.set_function(per_instance(lambda id: self.instance_clients[id].consumption_rate))
+		TOKEN_STALLS.set_function(per_instance(lambda id: self.instance_clients[id].num_stalls))
+		QUEUE_DURATION.set_function(per_instance(lambda id: self.hot_queue.priority(id)))
+		IN_FLIGHT.set_function(per_instance(lambda id: self.in_flight.get(id, 0)))
+		INSTANCE_TPS.set_function(per_instance(self.throughput.tps))
+
+	def update_hot_queue(self, wait=0):
+		#returns False if the hot set hasn't changed since the last update (or couldn't be fetched)
+		hot_instances = self.client.get_hot_instances(wait=wait)
+		if hot_instances is None:
+			return False
+		hot_ids = set(hot_instance["id"] for hot_instance in hot_instances)
 		self.lock.acquire()
-		queue_duration = self.queue_duration
+		removed_ids = [id for id in self.hot_queue.keys() if id not in hot_ids]
 		self.lock.release()
+		self.apply_hot_updates(hot_instances, removed_ids)
+		return True
 
-		hot_queue = PriorityQueue()
-		hot_ids = []
-		num_hot = 0
-		for hot_instance in hot_instances:
-			id = hot_instance["id"]
-			if id in self.old_hot_ids:
-				num_hot += 1
-			else:
-				self.instance_clients[id] = InstanceClient(hot_instance["id"], get_address_auth(hot_instance), hot_instance["mtoken"])
+	def watch_hot_instances(self, event):
+		#long polls the autoscaler, so changes to the hot set are applied as soon as they're published rather than on the next tick
+		while not event.is_set():
+			t1 = time.time()
+			try:
+				changed = self.update_hot_queue(wait=HOT_WAIT_SECONDS)
+			except Exception as e:
+				print(f"[loadbalancer] polling for hot instances failed: {e}")
+				changed = False
+			if not changed and time.time() - t1 < HOT_WAIT_SECONDS: #the autoscaler didn't hold the poll, so don't spin on it
+				event.wait(TIME_INTERVAL_SECONDS)
 
-			hot_queue.put((queue_duration[id], id, hot_instance))
-			hot_ids.append(id)
+	def apply_hot_updates(self, updated_instances, removed_ids):
+		#incremental update of the hot set: new instances start with an empty queue, existing ones keep their queue duration
+		new_clients = {}
+		for hot_instance in updated_instances:
+			id = hot_instance["id"]
+			if id not in self.instance_clients:
+				new_clients[id] = self.instance_client(id, get_address_auth(hot_instance), hot_instance["mtoken"])
+			self.throughput.observe_instance(hot_instance)
 
 		self.lock.acquire()
-		self.hot_queue = hot_queue
-		self.old_hot_ids = hot_ids
-		self.num_hot = num_hot
+		self.instance_clients.update(new_clients)
+		for hot_instance in updated_instances:
+			if hot_instance["id"] in self.hot_queue:
+				self.hot_queue.set_value(hot_instance["id"], hot_instance)
+			else:
+				self.hot_queue.push(hot_instance["id"], 0, hot_instance)
+		for id in removed_ids:
+			if id in self.hot_queue:
+				self.hot_queue.remove(id)
+			self.in_flight.pop(id, None)
+			self.instance_clients.pop(id, None)
+			self.throughput.forget(id)
+		self.drop_leases(removed_ids)
 		self.lock.release()
 
 	#needs to keep track of how many tokens it has per GPU
 	def monitor_instance_clients(self):
-		with ThreadPoolExecutor(MAX_CONCURRENCY) as e:
-			futures = [e.submit(c.monitor_token_queue) for c in self.instance_clients.values()]
-			wait(futures) #not sure if we need to wait here
+		self.lock.acquire()
+		instance_clients = list(self.instance_clients.values())
+		self.lock.release()
+		for c in instance_clients: #refills run in the background on the instance clients' shared pool
+			c.monitor_token_queue()
+
+	#call below with lock LOCKED
+	def drop_leases(self, instance_ids):
+		#leases on instances that are no longer hot are forgotten, so that if the same id comes back (stopped then started
+		#again) a late release or expiry of one can't take work off its new queue. Releasing them later returns False.
+		if len(instance_ids) == 0:
+			return
+		instance_ids = set(instance_ids)
+		for lease_id in [lease_id for lease_id, lease in self.leases.items() if lease[0] in instance_ids]:
+			del self.leases[lease_id]
+			if lease_id in self.lease_due:
+				self.lease_due.remove(lease_id)
+
+	#call below with lock LOCKED
+	def retire_overdue_leases(self):
+		#fallback for clients that never post /release (e.g. ones that only call /connect): once a lease is well past when
+		#its instance should have finished it, its work is taken off the queue, so it doesn't hold the instance busy until
+		#LEASE_TIMEOUT. It still counts as in flight until it's released or expires.
+		now = self.clock()
+		num_overdue = 0
+		while len(self.lease_due) > 0 and self.lease_due.peek()[0] <= now:
+			_, lease_id, _ = self.lease_due.peek()
+			self.lease_due.remove(lease_id)
+			id, cost, num_tokens, leased_at = self.leases[lease_id]
+			self.leases[lease_id] = (id, 0, num_tokens, leased_at)
+			if id in self.hot_queue:
+				self.hot_queue.update(id, max(0, self.hot_queue.priority(id) - cost))
+			num_overdue += 1
+		if num_overdue != 0:
+			OVERDUE_LEASES.inc(num_overdue)
+
+	#call below with lock LOCKED
+	def expire_leases(self):
+		cutoff = self.clock() - LEASE_TIMEOUT
+		expired = []
+		for lease_id, (_, _, _, leased_at) in self.leases.items():
+			if leased_at > cutoff:
+				break
+			expired.append(lease_id)
+		for lease_id in expired:
+			self.end_lease(lease_id)
+		if len(expired) != 0:
+			EXPIRED_LEASES.inc(len(expired))
+			print(f"[loadbalancer] expired {len(expired)} leases that were never released")
 
 	def tick_duration(self):
 		self.lock.acquire()
+		#instances only count towards num_hot, and their load towards num_busy, once they've been hot for a whole tick
+		hot_ids = set(self.hot_queue.keys())
+		counted_ids = hot_ids & self.old_hot_ids
+		self.old_hot_ids = hot_ids
+		self.num_hot = num_hot = len(counted_ids)
 
 		tot_duration = 0
-		num_hot = 0
+		tot_capacity = 0
+		num_in_flight = 0
 
-		for hot_id in list(self.old_hot_ids):
-			prev_queue_duration = self.queue_duration[hot_id]
-			curr_queue_duration = max(0, prev_queue_duration - TIME_INTERVAL_SECONDS)
-			self.queue_duration[hot_id] = curr_queue_duration
-			tot_duration += curr_queue_duration
+		#queue durations are the outstanding work of unreleased leases, so they shrink when leases end or are overdue
+		self.expire_leases()
+		self.retire_overdue_leases()
+		#instances that had at least a full interval of work queued were busy the whole time, so what they completed measures their capacity
+		saturated_ids = set(id for id in self.hot_queue.keys() if self.hot_queue.priority(id) >= TIME_INTERVAL_SECONDS)
+		self.throughput.tick(saturated_ids, TIME_INTERVAL_SECONDS)
+		instance_load = {}
+		for hot_id in counted_ids:
+			#queue durations are already in seconds of each instance's own capacity, weighting by capacity makes the average
+			#the fraction of the fleet's total throughput that is tied up
+			capacity = self.throughput.tps(hot_id)
+			tot_duration += self.hot_queue.priority(hot_id) * capacity
+			tot_capacity += capacity
+			instance_load[hot_id] = self.in_flight.get(hot_id, 0)
+			num_in_flight += instance_load[hot_id]
 
-		num_soon_hot = self.hot_queue.qsize()
-		avg_duration = tot_duration / num_soon_hot if num_soon_hot != 0 else 0
+		queue_depth = int(tot_duration) #tokens of leased work not yet released
+		avg_duration = tot_duration / tot_capacity if tot_capacity != 0 else 0
 		busy_level = avg_duration / FULL_LOAD_THRESHOLD
-		num_busy = int(busy_level * num_hot)
+		num_busy = min(num_hot, int(busy_level * num_hot))
 
-		self.client.report_hot_busy(num_hot=self.num_hot, num_busy=num_busy)
+		now = self.clock()
+		elapsed = max(now - self.last_tick, 1e-3)
+		request_rate = self.num_requested / elapsed
+		token_rate = self.tokens_requested / elapsed
+		self.num_requested = 0
+		self.tokens_requested = 0
+		self.last_tick = now
 		self.lock.release()
 
+		hot_perf = self.client.report_hot_busy(num_hot=num_hot, num_busy=num_busy, num_in_flight=num_in_flight, queue_depth=queue_depth, instance_load=instance_load,
+			request_rate=request_rate, token_rate=token_rate, capacity=tot_capacity, instance_perf=self.throughput.measurements(instance_load.keys()))
+		if hot_perf is not None:
+			self.throughput.observe_perf(hot_perf)
+
 	def tick_background(self, event):
 		while not event.is_set():
-			self.update_hot_queue()
+			t1 = time.perf_counter()
 			self.tick_duration()
 			self.monitor_instance_clients()
+			TICK_SECONDS.observe(time.perf_counter() - t1)
 			time.sleep(TIME_INTERVAL_SECONDS)
 
+	#call below with lock LOCKED
+	def lease_next(self, num_tokens):
+		#picks the least loaded hot instance that has an auth token on hand and charges it for num_tokens.
+		#Instances that are out of tokens are skipped (their refill is already requested), so this never waits.
+		lease = (None, None, None)
+		starved = []
+		while len(self.hot_queue) > 0:
+			(work_time, id, hot_server) = self.hot_queue.peek()
+			token = self.instance_clients[id].take_token()
+			if token is not None:
+				cost = self.throughput.cost(id, num_tokens)
+				lease_id = str(next(self.lease_ids))
+				now = self.clock()
+				self.leases[lease_id] = (id, cost, num_tokens, now)
+				#a request takes at least as long as requests on the instance have been taking, and at least as long as the
+				#instance needs to get through the work queued ahead of it plus its own
+				latency = self.throughput.expected_latency(id, num_tokens)
+				latency = latency if latency is not None else UNMEASURED_LATENCY_FACTOR * cost
+				self.lease_due.push(lease_id, now + LEASE_OVERDUE_FACTOR * max(work_time + cost, latency), None)
+				self.in_flight[id] = self.in_flight.get(id, 0) + 1
+				self.hot_queue.update(id, work_time + cost)
+				lease = (get_model_address(hot_server, self.streaming), token, lease_id)
+				LEASED.inc()
+				break
+			starved.append((id, work_time, hot_server))
+			self.hot_queue.remove(id)
+		for (id, work_time, hot_server) in starved:
+			self.hot_queue.push(id, work_time, hot_server)
+		if lease[0] is None:
+			NO_ADDR.inc()
+		return lease
+
 	def get_next_addr(self, num_tokens):
-		addr = None
-		token = None
-		if not(self.hot_queue.empty()):
-			(work_time, _, hot_server) = self.hot_queue.get()
-			addr = get_model_address(hot_server, self.streaming)
-			token_queue = self.instance_clients[hot_server["id"]].token_queue
-			token = token_queue.get()
-			tps = DEFAULT_TPS
-			self.queue_duration[hot_server["id"]] += ((1 / tps) * num_tokens)
-			self.hot_queue.put((self.queue_duration[hot_server["id"]], hot_server["id"], hot_server))
-		return addr, token
+		#returns (addr, token, lease id), or (None, None, None) only if no hot instance has an auth token on hand
+		t1 = time.perf_counter()
+		self.lock.acquire()
+		self.num_requested += 1
+		self.tokens_requested += num_tokens
+		lease = self.lease_next(num_tokens)
+		self.lock.release()
+		CONNECT.observe(time.perf_counter() - t1)
+		return lease
+
+	def get_next_addrs(self, num_tokens_list):
+		#one lease per entry of num_tokens_list, each charged to whichever instance is least loaded at that point,
+		#so a batch is spread across hot instances. Leases that can't be filled right now are left out.
+		t1 = time.perf_counter()
+		leases = []
+		self.lock.acquire()
+		self.num_requested += len(num_tokens_list)
+		self.tokens_requested += sum(num_tokens_list)
+		for num_tokens in num_tokens_list:
+			lease = self.lease_next(num_tokens)
+			if lease[0] is None:
+				break
+			leases.append(lease)
+		self.lock.release()
+		CONNECT_BATCH.observe(time.perf_counter() - t1)
+		return leases
+
+	#call below with lock LOCKED
+	def end_lease(self, lease_id):
+		id, cost, _, _ = self.leases.pop(lease_id)
+		if lease_id in self.lease_due:
+			self.lease_due.remove(lease_id)
+		if id in self.hot_queue:
+			self.hot_queue.update(id, max(0, self.hot_queue.priority(id) - cost))
+		if id in self.in_flight:
+			self.in_flight[id] -= 1
+		return id
+
+	def release(self, lease_id, num_tokens=None, latency=None, first_token=None):
+		#called once the request made with a lease has finished. Successful requests also report how many tokens they got
+		#back and how long it took (and streaming ones how long the first token took), which feeds the instance's throughput
+		#estimate. Returns False for unknown or expired leases.
+		self.lock.acquire()
+		if lease_id not in self.leases:
+			self.lock.release()
+			UNKNOWN_RELEASE.inc()
+			return False
+		id = self.end_lease(lease_id)
+		self.lock.release()
+		RELEASED.inc()
+		if num_tokens is not None and latency is not None:
+			self.throughput.record_completion(id, num_tokens, latency, first_token)
+		return True
 
 	def deconstruct(self, kill_servers=False):
 		print("[loadbalancer] deconstructing")
-		self.client.destroy_autoscaler()
 		self.exit_event.set()
-		self.bt.join()
+		self.client.destroy_autoscaler() #which also ends the hot set long poll
+		if self.bt is not None:
+			self.bt.join()
+			self.hot_thread.join()
 
@@ -0,0 +1,111 @@
+from aiohttp import web
+from loadbalancer import LoadBalancer
+from autoscaler_client import Client, LocalClient
+from autoscaler import handle_heartbeat
+from prom_metrics import REGISTRY
+import argparse
+import asyncio
+
+#Same routes as loadbalancer_server.py, served from an asyncio event loop so many /connect calls can be in flight at once.
+#/connect only touches in-memory state, so it never blocks the event loop.
+#With --embedded the autoscaler runs in this process too, and /heartbeat and /status are served here instead of by autoscaler_server.py.
+
+routes = web.RouteTableDef()
+
+lb = None
+embedded = False
+
+def embedded_autoscaler():
+    if lb is None or not isinstance(lb.client, LocalClient):
+        return None
+    return lb.client.autoscaler
+
+@routes.post('/setup')
+async def setup_lb(request):
+    global lb
+    args = (await request.json())["args"]
+    client = LocalClient() if embedded else Client()
+    lb = await asyncio.get_running_loop().run_in_executor(None, lambda: LoadBalancer(args, client=client))
+    return web.Response(text="Started Load Balancer and Autoscaler Session")
+
+@routes.post('/destroy')
+async def destroy_lb(request):
+    global lb
+    if lb is not None:
+        data = await request.json()
+        curr_lb = lb
+        lb = None
+        await asyncio.get_running_loop().run_in_executor(None, lambda: curr_lb.deconstruct(kill_servers=data["kill_servers"]))
+        return web.Response(text="Stopped Load Balancer and Autoscaler Session")
+    else:
+        return web.Response(text="Load Balancer hasn't been initialized")
+
+@routes.get('/connect')
+async def get_connection(request):
+    data = await request.json()
+    if lb is None:
+        return web.json_response({"addr" : None, "token" : None, "lease" : None})
+    addr, token, lease_id = lb.get_next_addr(data["num_tokens"])
+    return web.json_response({"addr" : addr, "token" : token, "lease" : lease_id})
+
+@routes.get('/connect_batch')
+async def get_connections(request):
+    data = await request.json()
+    if lb is None:
+        return web.json_response({"leases" : []})
+    num_tokens = data["num_tokens"]
+    if not isinstance(num_tokens, list):
+        num_tokens = [num_tokens] * data.get("num_leases", 1)
+    leases = lb.get_next_addrs(num_tokens)
+    return web.json_response({"leases" : [{"addr" : addr, "token" : token, "lease" : lease_id} for addr, token, lease_id in leases]})
+
+@routes.post('/release')
+async def release_lease(request):
+    data = await request.json()
+    if lb is None:
+        return web.json_response({"released" : False})
+    return web.json_response({"released" : lb.release(data["lease"], data.get("num_tokens"), data.get("latency"), data.get("first_token"))})
+
+@routes.post('/heartbeat')
+async def report_heartbeat(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    #records to the instance store, so it's run off the event loop
+    text, status = await asyncio.get_running_loop().run_in_executor(None, handle_heartbeat, embedded_autoscaler(), data)
+    return web.Response(text=text, status=status)
+
+@routes.get('/status')
+async def get_status(request):
+    autoscaler = embedded_autoscaler()
+    if autoscaler is None:
+        return web.Response(text="InstanceSet hasn't been initialized", status=503)
+    since = request.query.get("since", request.headers.get("If-None-Match"))
+    wait = float(request.query.get("wait", 0))
+    if wait > 0: #long polls wait off the event loop
+        snapshot = await asyncio.get_running_loop().run_in_executor(None, autoscaler.status_state.wait, since, wait)
+    else:
+        snapshot = autoscaler.status_state.wait(since, 0)
+    if snapshot.matches(since):
+        return web.Response(status=304, headers={"ETag" : snapshot.etag})
+    return web.Response(text=snapshot.body, content_type="application/json", headers={"ETag" : snapshot.etag})
+
+@routes.get('/metrics')
+async def get_metrics(request):
+    #rendered off the event loop, the per-instance gauges take the loadbalancer's lock. Includes the autoscaler's metrics when embedded.
+    text = await asyncio.get_running_loop().run_in_executor(None, REGISTRY.render)
+    return web.Response(text=text, content_type="text/plain")
+
+def make_app():
+    app = web.Application()
+    app.add_routes(routes)
+    return app
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--embedded", action="store_true", help="run the autoscaler in this process instead of talking to autoscaler_server.py")
+    args = parser.parse_args()
+    embedded = args.embedded
+    web.run_app(make_app(), port=args.port, access_log=None)
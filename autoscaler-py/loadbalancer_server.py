@@ -1,5 +1,9 @@
-from flask import Flask, request
+from flask import Flask, request, Response
 from loadbalancer import LoadBalancer
+from autoscaler_client import Client, LocalClient
+from autoscaler import handle_heartbeat
+from prom_metrics import REGISTRY, CONTENT_TYPE
+import argparse
 import logging
 
 app = Flask(__name__)
@@ -8,12 +12,18 @@ log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 
 lb = None
+embedded = False #the autoscaler runs in this process, and /heartbeat and /status are served here instead of by autoscaler_server.py
+
+def embedded_autoscaler():
+    if lb is None or not isinstance(lb.client, LocalClient):
+        return None
+    return lb.client.autoscaler
 
 @app.route('/setup', methods=['POST'])
 def setup_lb():
     global lb
     args = request.json["args"]
-    lb = LoadBalancer(args)
+    lb = LoadBalancer(args, client=LocalClient() if embedded else Client())
     return "Started Load Balancer and Autoscaler Session"
 
 @app.route('/destroy', methods=['POST'])
@@ -31,9 +41,49 @@ def destroy_lb():
 def get_connection():
     global lb
     data = request.json
-    addr, token = lb.get_next_addr(data["num_tokens"])
-    return {"addr" : addr, "token": token}
+    addr, token, lease_id = lb.get_next_addr(data["num_tokens"])
+    return {"addr" : addr, "token": token, "lease" : lease_id}
+
+@app.route('/connect_batch', methods=['GET'])
+def get_connections():
+    global lb
+    data = request.json
+    num_tokens = data["num_tokens"]
+    if not isinstance(num_tokens, list):
+        num_tokens = [num_tokens] * data.get("num_leases", 1)
+    leases = lb.get_next_addrs(num_tokens)
+    return {"leases" : [{"addr" : addr, "token" : token, "lease" : lease_id} for addr, token, lease_id in leases]}
+
+@app.route('/release', methods=['POST'])
+def release_lease():
+    global lb
+    data = request.json
+    if lb is None or not lb.release(data["lease"], data.get("num_tokens"), data.get("latency"), data.get("first_token")):
+        return {"released" : False}
+    return {"released" : True}
+
+@app.route('/heartbeat', methods=['POST'])
+def report_heartbeat():
+    return handle_heartbeat(embedded_autoscaler(), request.get_json(silent=True))
+
+@app.route('/status', methods=['GET'])
+def get_status():
+    autoscaler = embedded_autoscaler()
+    if autoscaler is None:
+        return "InstanceSet hasn't been initialized", 503
+    since = request.args.get("since", request.headers.get("If-None-Match"))
+    snapshot = autoscaler.status_state.wait(since, 0) #no long polling, this server handles one request at a time
+    if snapshot.matches(since):
+        return Response(status=304, headers={"ETag" : snapshot.etag})
+    return Response(snapshot.body, mimetype="application/json", headers={"ETag" : snapshot.etag})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--embedded", action="store_true", help="run the autoscaler in this process instead of talking to autoscaler_server.py")
+    embedded = parser.parse_args().embedded
     app.run(threaded=False, port=5000) #double check multi-threading safety
 
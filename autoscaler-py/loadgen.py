@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import random
+import resource
+import time
+import aiohttp
+
+from histogram import LogHistogram
+from prompt_OOBA import MSG_END
+from sim import PROMPTS, NUM_TOKENS
+
+#Open-loop load generator for the load balancer and model servers. Unlike sim.py, which holds a thread per request, every
+#simulated request here is a coroutine: /connect, then the prompt over http (/auth) or the websocket stream, then /release.
+#Arrivals are scheduled independently of how fast requests finish, so the offered load is exactly what was asked for:
+#	poisson: arrivals at --rate per second, optionally ramping to --ramp_to over --ramp_seconds
+#	trace: arrival times (seconds from the start, one per line) read from --trace
+#	users: --num_users users that each send a request, wait for it, then think for an exponential --think_time
+#The report separates offered load from what was served, and shows how late arrivals were dispatched, which stays near
+#zero as long as this process keeps up.
+
+REPORT_INTERVAL = 10
+
+class LoadStats:
+	def __init__(self, duration):
+		self.duration = duration #seconds arrivals are offered for
+		self.num_offered = 0
+		self.num_started = 0 #got an address
+		self.num_successful = 0
+		self.num_no_addr = 0
+		self.num_errors = 0
+		self.num_in_flight = 0
+		self.max_in_flight = 0
+		self.total_tokens = 0
+		#histograms rather than lists, so a long run's memory and report time stay constant
+		self.latencies = LogHistogram()
+		self.first_msg_waits = LogHistogram()
+		self.dispatch_lag = LogHistogram() #how late each arrival was started compared to its schedule
+
+	def report(self, elapsed):
+		offered_seconds = max(min(elapsed, self.duration), 1e-9)
+		print(f"[loadgen] {elapsed:.0f}s: offered {self.num_offered} ({self.num_offered / offered_seconds:.1f}/s), got address {self.num_started}, no address {self.num_no_addr}, "
+			f"successful {self.num_successful} ({self.num_successful / offered_seconds:.1f}/s), errors {self.num_errors}, in flight {self.num_in_flight} (max {self.max_in_flight})")
+		print(f"[loadgen] latency p50 {self.latencies.percentile(50):.2f}s p99 {self.latencies.percentile(99):.2f}s, tokens/s {self.total_tokens / max(elapsed, 1e-9):.1f}, "
+			f"dispatch lag p50 {self.dispatch_lag.percentile(50) * 1000:.1f}ms p99 {self.dispatch_lag.percentile(99) * 1000:.1f}ms")
+		if self.first_msg_waits.count != 0:
+			print(f"[loadgen] first message wait p50 {self.first_msg_waits.percentile(50):.2f}s p99 {self.first_msg_waits.percentile(99):.2f}s")
+
+class LoadGenerator:
+	def __init__(self, lb_addr, streaming, num_tokens=NUM_TOKENS, timeout=120, seed=None):
+		self.lb_addr = lb_addr
+		self.streaming = streaming
+		self.num_tokens = num_tokens
+		self.timeout = timeout
+		self.random = random.Random(seed)
+		self.stats = None
+		self.session = None
+
+	async def connect(self):
+		async with self.session.get(f"http://{self.lb_addr}/connect", json={"num_tokens" : self.num_tokens}) as response:
+			if response.status != 200:
+				return None
+			lease = await response.json()
+			return lease if lease["addr"] is not None else None
+
+	async def release(self, lease, num_tokens=None, latency=None, first_token=None):
+		try:
+			async with self.session.post(f"http://{self.lb_addr}/release", json={"lease" : lease["lease"], "num_tokens" : num_tokens, "latency" : latency, "first_token" : first_token}) as response:
+				await response.read()
+		except (aiohttp.ClientError, asyncio.TimeoutError):
+			pass
+
+	async def send_prompt(self, lease, prompt):
+		#returns (num_tokens, first message wait), num_tokens is None on failure
+		if not self.streaming:
+			request_dict = {"token" : lease["token"], "model" : {"prompt" : prompt, "max_new_tokens" : self.num_tokens}}
+			async with self.session.post(f"http://{lease['addr']}/auth", json=request_dict) as response:
+				if response.status != 200:
+					return None, None
+				reply = await response.json()
+				return (reply["num_tokens"] if reply["error"] is None else None), None
+		num_tokens = 0
+		first_msg_wait = None
+		async with self.session.ws_connect(f"ws://{lease['addr']}/") as ws:
+			for message in [lease["token"], MSG_END, prompt, MSG_END]:
+				await ws.send_str(message)
+			t1 = time.time()
+			async for msg in ws:
+				if msg.type != aiohttp.WSMsgType.TEXT:
+					break
+				if first_msg_wait is None:
+					first_msg_wait = time.time() - t1
+				num_tokens += 1
+		return (num_tokens if num_tokens != 0 else None), first_msg_wait
+
+	async def request(self, scheduled_time):
+		stats = self.stats
+		stats.num_offered += 1
+		stats.dispatch_lag.record(max(0.0, time.time() - scheduled_time))
+		stats.num_in_flight += 1
+		stats.max_in_flight = max(stats.max_in_flight, stats.num_in_flight)
+		try:
+			lease = await self.connect()
+			if lease is None:
+				stats.num_no_addr += 1
+				return
+			stats.num_started += 1
+			t1 = time.time()
+			try:
+				num_tokens, first_msg_wait = await self.send_prompt(lease, self.random.choice(PROMPTS))
+			except (aiohttp.ClientError, asyncio.TimeoutError):
+				num_tokens, first_msg_wait = None, None
+			latency = time.time() - t1
+			if num_tokens is None:
+				stats.num_errors += 1
+				await self.release(lease)
+				return
+			stats.num_successful += 1
+			stats.total_tokens += num_tokens
+			stats.latencies.record(latency)
+			if first_msg_wait is not None:
+				stats.first_msg_waits.record(first_msg_wait)
+			await self.release(lease, num_tokens, latency, first_msg_wait)
+		except (aiohttp.ClientError, asyncio.TimeoutError):
+			stats.num_errors += 1
+		finally:
+			stats.num_in_flight -= 1
+
+	def poisson_arrivals(self, rate, duration, ramp_to=None, ramp_seconds=0):
+		#offsets from the start, with the rate changing linearly from rate to ramp_to over ramp_seconds
+		t = 0.0
+		while True:
+			curr_rate = rate
+			if ramp_to is not None and ramp_seconds > 0:
+				curr_rate = rate + (ramp_to - rate) * min(1.0, t / ramp_seconds)
+			t += self.random.expovariate(max(curr_rate, 1e-9))
+			if t >= duration:
+				return
+			yield t
+
+	async def run_arrivals(self, arrivals):
+		start = time.time()
+		tasks = set()
+		for offset in arrivals:
+			delay = start + offset - time.time()
+			if delay > 0:
+				await asyncio.sleep(delay)
+			task = asyncio.create_task(self.request(start + offset))
+			tasks.add(task)
+			task.add_done_callback(tasks.discard)
+		if len(tasks) != 0:
+			await asyncio.wait(tasks)
+
+	async def run_user(self, think_time, end_time):
+		#users think before their first request too, so they don't all start at once
+		while True:
+			await asyncio.sleep(min(self.random.expovariate(1 / think_time), max(0.0, end_time - time.time())))
+			if time.time() >= end_time:
+				return
+			await self.request(time.time())
+
+	async def report_background(self, start):
+		while True:
+			await asyncio.sleep(REPORT_INTERVAL)
+			self.stats.report(time.time() - start)
+
+	async def run(self, mode, duration, rate=1.0, ramp_to=None, ramp_seconds=0, trace=None, num_users=0, think_time=30.0, max_connections=0):
+		start = time.time()
+		self.stats = LoadStats(duration)
+		connector = aiohttp.TCPConnector(limit=max_connections)
+		async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+			self.session = session
+			reporter = asyncio.create_task(self.report_background(start))
+			if mode == "poisson":
+				await self.run_arrivals(self.poisson_arrivals(rate, duration, ramp_to, ramp_seconds))
+			elif mode == "trace":
+				with open(trace, "r") as f:
+					offsets = sorted(float(line) for line in f if line.strip() != "")
+				await self.run_arrivals(offset for offset in offsets if offset < duration)
+			elif mode == "users":
+				await asyncio.gather(*[self.run_user(think_time, start + duration) for _ in range(num_users)])
+			reporter.cancel()
+		print("[loadgen] done")
+		self.stats.report(time.time() - start)
+		return self.stats
+
+def raise_open_file_limit():
+	soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+	if soft_limit < hard_limit:
+		resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+	print(f"[loadgen] open file limit: {resource.getrlimit(resource.RLIMIT_NOFILE)[0]}")
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--lb_addr", type=str, default="127.0.0.1:5000")
+	parser.add_argument("--mode", type=str, default="poisson", choices=["poisson", "trace", "users"])
+	parser.add_argument("--duration", type=float, default=60.0, help="seconds")
+	parser.add_argument("--rate", type=float, default=10.0, help="poisson arrivals per second")
+	parser.add_argument("--ramp_to", type=float, default=None, help="poisson rate reached at the end of the ramp")
+	parser.add_argument("--ramp_seconds", type=float, default=0.0)
+	parser.add_argument("--trace", type=str, default=None, help="file of arrival offsets in seconds, one per line")
+	parser.add_argument("--num_users", type=int, default=1000)
+	parser.add_argument("--think_time", type=float, default=30.0, help="mean seconds a user waits between requests")
+	parser.add_argument("--streaming", action="store_true")
+	parser.add_argument("--num_tokens", type=int, default=NUM_TOKENS)
+	parser.add_argument("--max_connections", type=int, default=0, help="0 means no limit")
+	parser.add_argument("--seed", type=int, default=None)
+	args = parser.parse_args()
+	raise_open_file_limit()
+	generator = LoadGenerator(args.lb_addr, args.streaming, num_tokens=args.num_tokens, seed=args.seed)
+	asyncio.run(generator.run(args.mode, args.duration, rate=args.rate, ramp_to=args.ramp_to, ramp_seconds=args.ramp_seconds, trace=args.trace,
+		num_users=args.num_users, think_time=args.think_time, max_connections=args.max_connections))
+
+if __name__ == "__main__":
+	main()
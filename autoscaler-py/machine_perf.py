@@ -0,0 +1,77 @@
+import math
+from threading import Lock
+
+from throughput_model import prior_tps
+
+MIN_GPU_SAMPLES = 3 #measured machines of a gpu config needed before their average replaces the built-in prior for it
+MEASURED_FIELDS = ["tps", "ttft", "time_to_hot", "max_concurrency", "bench_tps"]
+
+#Per-machine performance database: the tokens/s, time to first token and time to hot measured on every machine we've
+#rented, kept in the instance store so it outlives the autoscaler. Predicts how fast an instance or an offer will be,
+#from its machine's own history if we've had it before, then from other machines with the same gpus, then from the
+#gpu prior in throughput_model.py, so offers and instances can all be ranked by what their tokens will cost.
+class MachinePerf:
+	def __init__(self, store, model=None):
+		self.store = store
+		self.model = model
+		self.lock = Lock()
+		self.stats = store.load_machine_stats(model=model) #machine id -> averages, see InstanceStore.load_machine_stats
+		self.gpu_tps = {} #(gpu name, num gpus) -> average tps of the machines measured with that config
+		self.gpu_bench_tps = {} #and the average benchmarked capacity of the machines benchmarked with it
+		self.update_gpu_tps()
+
+	def update_gpu_tps(self):
+		self.gpu_tps = self.gpu_averages("tps")
+		self.gpu_bench_tps = self.gpu_averages("bench_tps")
+
+	def gpu_averages(self, field):
+		samples = {}
+		for stats in self.stats.values():
+			if stats[field] is not None and stats["gpu_name"] is not None:
+				samples.setdefault((stats["gpu_name"], stats["num_gpus"]), []).append(stats[field])
+		return {config : sum(values) / len(values) for config, values in samples.items() if len(values) >= MIN_GPU_SAMPLES}
+
+	def record(self, instance, **measured):
+		self.record_many([(instance, measured)])
+
+	def record_many(self, measurements):
+		#measurements are (instance, dict with any of MEASURED_FIELDS), other keys and None values are ignored
+		if len(measurements) == 0:
+			return
+		rows = [dict({field : measured.get(field) for field in MEASURED_FIELDS}, machine_id=instance["machine_id"], instance_id=instance["id"],
+			model=self.model, gpu_name=instance.get("gpu_name"), num_gpus=instance.get("num_gpus")) for instance, measured in measurements]
+		self.store.record_machines(rows)
+		updated = self.store.load_machine_stats(set(row["machine_id"] for row in rows), model=self.model)
+		with self.lock:
+			self.stats = {**self.stats, **updated} #replaced rather than updated, so it can be read without the lock
+			self.update_gpu_tps()
+
+	def time_to_hot(self, machine_id):
+		stats = self.stats.get(machine_id)
+		return stats["time_to_hot"] if stats is not None else None
+
+	def gpu_norm(self, instance):
+		#(tps, measured): the benchmarked capacity of machines with the same gpus, or the uncalibrated prior (measured False)
+		#until enough of them have been benchmarked
+		bench_tps = self.gpu_bench_tps.get((instance.get("gpu_name"), instance.get("num_gpus")))
+		if bench_tps is not None:
+			return bench_tps, True
+		return prior_tps(instance, self.model), False
+
+	def predicted_tps(self, instance):
+		stats = self.stats.get(instance.get("machine_id"))
+		if stats is not None and stats["tps"]:
+			return stats["tps"]
+		if stats is not None and stats["bench_tps"]:
+			return stats["bench_tps"]
+		gpu_tps = self.gpu_tps.get((instance.get("gpu_name"), instance.get("num_gpus")))
+		if gpu_tps is not None:
+			return gpu_tps
+		return prior_tps(instance, self.model)
+
+	def cost_per_1k_tokens(self, instance):
+		#dollars per hour over thousands of tokens per hour, for instances (show instances) and offers (search offers) alike
+		dph = instance.get("dph_total")
+		if dph is None:
+			return math.inf
+		return dph / (self.predicted_tps(instance) * 3.6)
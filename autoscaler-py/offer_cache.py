@@ -0,0 +1,108 @@
+import time
+from threading import Thread, Lock, Event
+from concurrent.futures import ThreadPoolExecutor
+
+from vast_api import build_offer_query
+
+OFFER_TTL = 60 #seconds before a cached offer list is refreshed in the background
+REFRESH_INTERVAL = 5
+FAILED_OFFER_COOLDOWN = 10 * 60
+ORDERS = {True : "dph", False : "dlperf_per_dphtotal"} #budget -> ranking
+
+def rank_key(order):
+	if order == "dph":
+		return lambda offer: offer["dph_total"] if offer.get("dph_total") is not None else float("inf")
+	return lambda offer: -offer[order] if offer.get(order) is not None else 0.0
+
+#Keeps the marketplace offers for one model's gpu configs in memory. The per-config searches run concurrently and are
+#merged into one ranked, deduplicated list. With background (for an autoscaler that manages instances) the rankings in
+#prewarm are fetched as soon as the cache is made and every ranking asked for is refreshed in the background, so scaling
+#up never waits on a search. Without it a ranking is searched for when it's asked for and missing or stale.
+class OfferCache:
+	def __init__(self, api, get_config, ttl=OFFER_TTL, failed_offer_cooldown=FAILED_OFFER_COOLDOWN, background=True, prewarm=(True, )):
+		self.api = api
+		self.gpu_configs = get_config["gpu"]
+		self.disk_space = get_config["disk_space"]
+		self.ttl = ttl
+		self.failed_offer_cooldown = failed_offer_cooldown
+
+		self.offers = {} #order -> (time fetched, ranked offer list)
+		self.orders = set(ORDERS[bool(budget)] for budget in prewarm) #rankings kept fresh in the background
+		self.dropped_offers = {} #ask id -> time it was dropped
+		self.lock = Lock()
+		self.executor = ThreadPoolExecutor(max(len(self.gpu_configs), 1))
+
+		self.exit_event = Event()
+		self.bt = None
+		if background:
+			self.bt = Thread(target=self.refresh_background, args=(self.exit_event, ), daemon=True)
+			self.bt.start()
+
+	def search(self, order):
+		queries = [build_offer_query(gpu_config, self.disk_space, order) for gpu_config in self.gpu_configs]
+		merged = {}
+		num_failed = 0
+		for offers in self.executor.map(self.api.search_offers, queries):
+			if offers is None:
+				num_failed += 1
+				continue
+			for offer in offers:
+				merged.setdefault(offer["id"], offer)
+		if num_failed == len(queries):
+			return None
+		return sorted(merged.values(), key=rank_key(order))
+
+	def refresh(self, order):
+		offers = self.search(order)
+		if offers is None:
+			return None
+		self.lock.acquire()
+		self.offers[order] = (time.time(), offers)
+		self.lock.release()
+		return offers
+
+	def refresh_stale(self):
+		self.lock.acquire()
+		#rankings never fetched (or whose fetch failed) count as stale, which pre-warms them on the first pass
+		stale_orders = [order for order in self.orders if order not in self.offers or time.time() - self.offers[order][0] >= self.ttl]
+		self.lock.release()
+		for order in stale_orders:
+			self.refresh(order)
+
+	def refresh_background(self, event):
+		while not event.is_set():
+			self.refresh_stale()
+			event.wait(REFRESH_INTERVAL)
+
+	def get(self, budget=True):
+		order = ORDERS[bool(budget)]
+		self.lock.acquire()
+		self.orders.add(order)
+		entry = self.offers.get(order)
+		self.lock.release()
+		#with the background refresh only a request that beats the pre-warm waits on the marketplace
+		if entry is None or (self.bt is None and time.time() - entry[0] >= self.ttl):
+			offers = self.refresh(order)
+			if offers is not None:
+				entry = (time.time(), offers)
+		if entry is None:
+			return []
+		offers = entry[1] #stale offers beat none if the search failed
+
+		cutoff = time.time() - self.failed_offer_cooldown
+		self.lock.acquire()
+		self.dropped_offers = {id : t for id, t in self.dropped_offers.items() if t >= cutoff}
+		dropped_offers = self.dropped_offers
+		self.lock.release()
+		return [offer for offer in offers if offer["id"] not in dropped_offers]
+
+	def drop_offer(self, ask_id): #after a create on this offer fails, or after we've rented it
+		self.lock.acquire()
+		self.dropped_offers[ask_id] = time.time()
+		self.lock.release()
+
+	def stop(self):
+		self.exit_event.set()
+		if self.bt is not None:
+			self.bt.join()
+		self.executor.shutdown(wait=False)
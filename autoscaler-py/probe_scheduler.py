@@ -0,0 +1,78 @@
+import time
+
+#rough time from an instance reaching "running" to its model being loaded, used until we have measurements
+EXPECTED_LOAD_SECONDS = {"vllm-13" : 15 * 60, "vllm-70" : 60 * 60, "dev" : 10 * 60}
+DEFAULT_LOAD_SECONDS = 30 * 60
+WARM_LOAD_SECONDS = 3 * 60 #instances that have loaded the model before only need to read it back from disk
+MIN_PROBE_INTERVAL = 5
+MAX_PROBE_INTERVAL = 10 * 60
+LOAD_FRACTION = 0.25 #while loading, wait this fraction of the expected time remaining before probing again
+OVERDUE_BACKOFF = 1.5 #once past the expected load time, grow the interval by this much after every failed probe
+
+class ProbeHistory:
+	def __init__(self, now, expected_load_seconds, running_since=None):
+		self.running_since = running_since if running_since is not None else now
+		self.expected_load_seconds = expected_load_seconds
+		self.next_probe_time = now
+		self.num_probes = 0
+		self.num_overdue_probes = 0
+		self.total_latency = 0.0
+		self.max_latency = 0.0
+		self.last_latency = None
+
+#Decides when each running-but-not-hot instance is worth probing again. Instances that are clearly still downloading
+#are probed rarely, probes get more frequent as the expected time-to-hot approaches, and back off exponentially past it.
+class ProbeScheduler:
+	def __init__(self, expected_load_seconds=DEFAULT_LOAD_SECONDS, clock=time.time):
+		self.expected_load_seconds = expected_load_seconds
+		self.clock = clock
+		self.histories = {}
+		self.total_probes = 0 #across every instance, including ones that have since gone hot
+		self.total_latency = 0.0
+
+	def get_history(self, instance_id, expected_load_seconds=None, running_since=None):
+		#running_since is when the instance started running, if it was before the scheduler first saw it
+		if instance_id not in self.histories:
+			expected_load_seconds = expected_load_seconds if expected_load_seconds is not None else self.expected_load_seconds
+			self.histories[instance_id] = ProbeHistory(self.clock(), expected_load_seconds, running_since)
+		return self.histories[instance_id]
+
+	def due(self, instance_id, expected_load_seconds=None, running_since=None):
+		return self.clock() >= self.get_history(instance_id, expected_load_seconds, running_since).next_probe_time
+
+	def next_interval(self, history, now):
+		remaining = history.running_since + history.expected_load_seconds - now
+		if remaining > 0:
+			interval = remaining * LOAD_FRACTION
+		else:
+			interval = MIN_PROBE_INTERVAL * (OVERDUE_BACKOFF ** history.num_overdue_probes)
+			history.num_overdue_probes += 1
+		return min(max(interval, MIN_PROBE_INTERVAL), MAX_PROBE_INTERVAL)
+
+	def record(self, instance_id, success, latency):
+		now = self.clock()
+		history = self.get_history(instance_id)
+		history.num_probes += 1
+		history.last_latency = latency
+		history.total_latency += latency
+		history.max_latency = max(history.max_latency, latency)
+		self.total_probes += 1
+		self.total_latency += latency
+		if success:
+			history.next_probe_time = now
+		else:
+			history.next_probe_time = now + self.next_interval(history, now)
+
+	def prune(self, instance_ids): #keeps only the histories of the given instances
+		for instance_id in list(self.histories.keys()):
+			if instance_id not in instance_ids:
+				del self.histories[instance_id]
+
+	def stats(self):
+		now = self.clock()
+		stats = {}
+		for instance_id, history in self.histories.items():
+			avg_latency = history.total_latency / history.num_probes if history.num_probes != 0 else 0.0
+			stats[instance_id] = {"num_probes" : history.num_probes, "avg_latency" : avg_latency, "max_latency" : history.max_latency, "last_latency" : history.last_latency,
+				"running_for" : now - history.running_since, "expected_load_seconds" : history.expected_load_seconds, "next_probe_in" : max(0, history.next_probe_time - now)}
+		return stats
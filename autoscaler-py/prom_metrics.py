@@ -0,0 +1,169 @@
+import bisect
+import math
+from threading import Lock
+
+#Minimal Prometheus-style metrics, served as text from the autoscaler's and loadbalancer's /metrics routes.
+#Components declare their metrics once at module level and update them in place: an update is one uncontended lock
+#and a few adds, and anything that is cheaper to read than to keep up to date (queue sizes, instance counts) is a
+#function that only runs when /metrics is scraped.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+FAST_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01, 0.025, 0.05, 0.1) #in-memory operations
+
+def format_value(value):
+	if value == math.inf:
+		return "+Inf"
+	if isinstance(value, int):
+		return str(value)
+	return repr(float(value))
+
+def format_labels(names, values, extra=None):
+	pairs = list(zip(names, values))
+	if extra is not None:
+		pairs.append(extra)
+	if len(pairs) == 0:
+		return ""
+	escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in pairs)
+	return "{" + ",".join(f"{name}=\"{value}\"" for (name, _), value in zip(pairs, escaped)) + "}"
+
+class CounterValue:
+	def __init__(self):
+		self.value = 0
+		self.lock = Lock()
+
+	def inc(self, amount=1):
+		with self.lock:
+			self.value += amount
+
+	def samples(self, name, labelnames, labelvalues):
+		yield f"{name}{format_labels(labelnames, labelvalues)} {format_value(self.value)}"
+
+class GaugeValue(CounterValue):
+	def set(self, value):
+		self.value = value
+
+	def dec(self, amount=1):
+		self.inc(-amount)
+
+class HistogramValue:
+	def __init__(self, buckets):
+		self.bounds = buckets
+		self.counts = [0] * (len(buckets) + 1) #the last one is +Inf
+		self.sum = 0.0
+		self.lock = Lock()
+
+	def observe(self, value):
+		index = bisect.bisect_left(self.bounds, value)
+		with self.lock:
+			self.counts[index] += 1
+			self.sum += value
+
+	def samples(self, name, labelnames, labelvalues):
+		with self.lock:
+			counts = list(self.counts)
+			total = self.sum
+		cumulative = 0
+		for bound, count in zip(list(self.bounds) + [math.inf], counts):
+			cumulative += count
+			yield f"{name}_bucket{format_labels(labelnames, labelvalues, ('le', format_value(bound)))} {cumulative}"
+		yield f"{name}_sum{format_labels(labelnames, labelvalues)} {format_value(total)}"
+		yield f"{name}_count{format_labels(labelnames, labelvalues)} {cumulative}"
+
+VALUE_TYPES = {"counter" : CounterValue, "gauge" : GaugeValue}
+
+#A named metric with fixed label names. labels(...) returns the value for one combination of labels (hold on to it on
+#hot paths), and a metric without labels can be updated directly.
+class Metric:
+	def __init__(self, name, help, type, labelnames=(), buckets=LATENCY_BUCKETS):
+		self.name = name
+		self.help = help
+		self.type = type
+		self.labelnames = tuple(labelnames)
+		self.buckets = tuple(buckets)
+		self.values = {}
+		self.lock = Lock()
+		self.function = None
+
+	def make_value(self):
+		if self.type == "histogram":
+			return HistogramValue(self.buckets)
+		return VALUE_TYPES[self.type]()
+
+	def labels(self, *labelvalues):
+		labelvalues = tuple(str(value) for value in labelvalues)
+		value = self.values.get(labelvalues)
+		if value is None:
+			with self.lock:
+				value = self.values.setdefault(labelvalues, self.make_value())
+		return value
+
+	def inc(self, amount=1):
+		self.labels().inc(amount)
+
+	def set(self, value):
+		self.labels().set(value)
+
+	def observe(self, value):
+		self.labels().observe(value)
+
+	def set_function(self, function):
+		#function() is called at scrape time and returns a number, or a dict of label values tuple -> number. None removes it.
+		self.function = function
+
+	def samples(self):
+		function = self.function
+		if function is not None:
+			try:
+				result = function()
+			except Exception as e:
+				print(f"[metrics] reading {self.name} failed: {e}")
+				return
+			if not isinstance(result, dict):
+				result = {() : result}
+			for labelvalues, value in result.items():
+				if value is not None:
+					yield f"{self.name}{format_labels(self.labelnames, labelvalues)} {format_value(value)}"
+			return
+		for labelvalues, value in list(self.values.items()):
+			yield from value.samples(self.name, self.labelnames, labelvalues)
+
+class Registry:
+	def __init__(self):
+		self.metrics = {}
+		self.lock = Lock()
+
+	def register(self, name, help, type, labelnames=(), buckets=LATENCY_BUCKETS):
+		#registering the same name again returns the existing metric, so modules can be reloaded and components recreated
+		with self.lock:
+			metric = self.metrics.get(name)
+			if metric is None:
+				metric = Metric(name, help, type, labelnames, buckets)
+				self.metrics[name] = metric
+			return metric
+
+	def counter(self, name, help, labelnames=()):
+		return self.register(name, help, "counter", labelnames)
+
+	def gauge(self, name, help, labelnames=()):
+		return self.register(name, help, "gauge", labelnames)
+
+	def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+		return self.register(name, help, "histogram", labelnames, buckets)
+
+	def render(self):
+		#Prometheus text exposition format. Metrics this process never updated (e.g. the autoscaler's, imported by the
+		#loadbalancer for its helpers) are left out.
+		with self.lock:
+			metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+		lines = []
+		for metric in metrics:
+			samples = list(metric.samples())
+			if len(samples) == 0:
+				continue
+			lines.append(f"# HELP {metric.name} {metric.help}")
+			lines.append(f"# TYPE {metric.name} {metric.type}")
+			lines.extend(samples)
+		return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
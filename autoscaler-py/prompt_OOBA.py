@@ -2,8 +2,10 @@ import requests
 import json
 import time
 from websockets.sync.client import connect
+from websockets.exceptions import WebSocketException, ConnectionClosedOK
 
 MSG_END = "$$$"
+TEST_TIMEOUT = 30
 
 ooba_dict = {
 	'auto_max_new_tokens': False,
@@ -43,15 +45,18 @@ ooba_dict = {
 	}
 
 
-def send_vllm_request_auth(gpu_server_addr, id_token, text_prompt):
+def send_vllm_request_auth(gpu_server_addr, id_token, text_prompt, timeout=None, max_new_tokens=None):
+	#max_new_tokens should match the num_tokens the lease was charged for at the balancer, None leaves it to the server
 	URI = f'http://{gpu_server_addr}/auth'
 	model_dict = {"prompt" : text_prompt}
+	if max_new_tokens is not None:
+		model_dict["max_new_tokens"] = max_new_tokens
 	request_dict = {"token" : id_token, "model" : model_dict}
 	text_result = None
 	error = None
 	num_tokens = None
 	try:
-		response = requests.post(URI, json=request_dict)
+		response = requests.post(URI, json=request_dict, timeout=timeout)
 		if response.status_code == 200:
 			try:
 				reply = response.json()
@@ -66,41 +71,63 @@ def send_vllm_request_auth(gpu_server_addr, id_token, text_prompt):
 			error = f"status code: {response.status_code}"
 	except requests.exceptions.ConnectionError as e:
 		error = f"connection error: {e}"
+	except requests.exceptions.Timeout as e:
+		error = f"timeout: {e}"
 
-	return {"reply" : text_result, "error": error, "num_tokens" : num_tokens, "first_msg_wait" : None}
+	return {"reply" : text_result, "error": error, "num_tokens" : num_tokens, "first_msg_wait" : None, "token_gaps" : None}
 
-def send_vllm_request_streaming_auth(gpu_server_addr, id_token, text_prompt):
+def send_vllm_request_streaming_auth(gpu_server_addr, id_token, text_prompt, timeout=None):
+	#the model server sends one message per generated token. timeout bounds the whole request, None waits for as long as the server keeps going
 	response = ""
-	first_msg_wait = 0.0
-	first = True
-	with connect(f"ws://{gpu_server_addr}/") as websocket:
-		websocket.send(id_token)
-		websocket.send(MSG_END)
+	error = None
+	first_msg_wait = None
+	num_tokens = 0
+	token_gaps = [] #seconds between consecutive tokens
+	deadline = time.time() + timeout if timeout is not None else None
+	try:
+		with connect(f"ws://{gpu_server_addr}/", open_timeout=timeout if timeout is not None else 10) as websocket: #10 is websockets' default
+			websocket.send(id_token)
+			websocket.send(MSG_END)
 
-		websocket.send(text_prompt)
-		websocket.send(MSG_END)
+			websocket.send(text_prompt)
+			websocket.send(MSG_END)
 
-		t1 = time.time()
-		for message in websocket:
-			if first:
+			t1 = time.time()
+			last_msg_time = t1
+			while True:
+				try:
+					message = websocket.recv(timeout=max(0, deadline - time.time()) if deadline is not None else None)
+				except ConnectionClosedOK:
+					break
 				t2 = time.time()
-				first_msg_wait = t2 - t1
-				first = False
-			response += message
-	return {"reply" : response, "error" : None, "num_tokens" : 50, "first_msg_wait" : first_msg_wait}
+				if first_msg_wait is None:
+					first_msg_wait = t2 - t1
+				else:
+					token_gaps.append(t2 - last_msg_time)
+				last_msg_time = t2
+				num_tokens += 1
+				response += message
+	except TimeoutError:
+		error = f"timeout after {timeout}s"
+	except (WebSocketException, OSError) as e:
+		error = f"websocket error: {e}"
+	if num_tokens == 0:
+		return {"reply" : None, "error" : error or "no response", "num_tokens" : None, "first_msg_wait" : None, "token_gaps" : None}
+	return {"reply" : response, "error" : error, "num_tokens" : num_tokens, "first_msg_wait" : first_msg_wait, "token_gaps" : token_gaps}
 
 
-def send_vllm_request_streaming_test_auth(gpu_server_addr, mtoken):
+def send_vllm_request_streaming_test_auth(gpu_server_addr, mtoken, timeout=TEST_TIMEOUT):
 	response = ""
+	deadline = time.time() + timeout
 	try:
-		with connect(f"ws://{gpu_server_addr}/") as websocket:
+		with connect(f"ws://{gpu_server_addr}/", open_timeout=timeout if timeout is not None else 10) as websocket: #10 is websockets' default
 			websocket.send(mtoken)
 			websocket.send(MSG_END)
 			websocket.send("Hello?")
 			websocket.send(MSG_END)
-			for message in websocket:
-				response += message
-	except TimeoutError:
+			while True:
+				response += websocket.recv(timeout=max(0, deadline - time.time()))
+	except (TimeoutError, WebSocketException, OSError):
 		pass
 	
 	# print(response)
@@ -3,14 +3,17 @@ import time
 from threading import Thread, Lock, Event
 from queue import Queue
 from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
+from itertools import zip_longest
 import resource
 import os
+import argparse
 import psutil
 
 from sim_client import Client
 
 MAX_CONCURRENCY = 100
 JOIN_TIMEOUT = 5
+NUM_TOKENS = 100
 
 PROMPTS = [ "Yesterday I woke up and I saw that my dog was missing. This made me think that ",
 			"I have been thinking a lot about the question of what the best movie of all time is. There are a lot of different ways to approach this question, but for me the most important factor is how exciting it is. With that in mind, I would say the best movie is: ",
@@ -30,8 +33,9 @@ class User:
 		self.lock = Lock()
 
 class Sim:
-	def __init__(self, num_iters, base_num_users, base_rate, etime, streaming, model, manage):
+	def __init__(self, num_iters, base_num_users, base_rate, etime, streaming, model, manage, strategy="simple", metrics_json=None):
 		self.users = []
+		self.metrics_json = metrics_json
 
 		self.num_iters = num_iters
 		self.num_users = base_num_users
@@ -39,7 +43,7 @@ class Sim:
 		self.etime = etime
 
 		self.streaming = streaming
-		self.client = Client(streaming=streaming, model=model, manage=manage)
+		self.client = Client(streaming=streaming, model=model, manage=manage, strategy=strategy)
 		self.req_num = 0
 		self.proc = psutil.Process(os.getpid())
 
@@ -56,27 +60,33 @@ class Sim:
 			users.append(User(id=i, rate=self.base_rate, prompt=up))
 		self.users = users
 
-	def send_chat(self, user):
+	def start_chat(self, user):
+		#decides whether this user sends a prompt this round, and if so marks them as waiting
 		user.lock.acquire()
 		prob = user.rate * self.etime
+		chat = None
 		if (not(user.waiting) and random.random() <= prob):
-			request_str = f"{user.id}-{user.ended_chats}"
-			prompt = user.prompt
+			chat = (user, user.prompt, f"{user.id}-{user.ended_chats}")
 			user.started_chats += 1
 			user.waiting = True
-			user.lock.release()
-			self.client.send_prompt(prompt, id=request_str)
-			user.lock.acquire()
-			user.ended_chats += 1
-			user.waiting = False
+		user.lock.release()
+		return chat
+
+	def send_chat(self, user, prompt, request_str, lease):
+		self.client.send_prompt(prompt, id=request_str, num_tokens=NUM_TOKENS, lease=lease)
+		user.lock.acquire()
+		user.ended_chats += 1
+		user.waiting = False
 		user.lock.release()
 
 	def update_loop(self, i):
 		print(f"[sim] updating i = {i} and num fds is: {self.proc.num_fds()}")
+		chats = [chat for chat in map(self.start_chat, self.users) if chat is not None]
+		leases = self.client.get_connections([NUM_TOKENS] * len(chats)) #one balancer call for the whole round
 		with ThreadPoolExecutor(MAX_CONCURRENCY) as e:
 			futures = []
-			for user in self.users:
-				future = e.submit(self.send_chat, user)
+			for (user, prompt, request_str), lease in zip_longest(chats, leases[:len(chats)]):
+				future = e.submit(self.send_chat, user, prompt, request_str, lease)
 				futures.append(future)
 
 			while len(futures) > 0:
@@ -134,11 +144,31 @@ class Sim:
 		print("session done")
 		self.client.metrics.session_end_time = time.time()
 		self.client.metrics.print_metrics()
+		if self.metrics_json is not None:
+			self.client.metrics.export_json(self.metrics_json)
 		self.client.deconstruct()
 		self.client.shutdown_lb()
 
 def main():
-	sim = Sim(num_iters=50, base_num_users=50, base_rate=1.0 * (15 / 60), etime=2.0, streaming=True, model="vllm-13", manage=False)
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--virtual", action="store_true", help="run a discrete-event simulation on a virtual clock against fake instances (sim_des.py)")
+	parser.add_argument("--hours", type=float, default=24.0, help="simulated hours, virtual mode only")
+	parser.add_argument("--seed", type=int, default=None)
+	parser.add_argument("--num_users", type=int, default=50)
+	parser.add_argument("--strategy", type=str, default="simple")
+	parser.add_argument("--num_instances", type=int, default=10, help="hot instances at the start, virtual mode only")
+	parser.add_argument("--log_file", type=str, default=None, help="where component logs go in virtual mode")
+	parser.add_argument("--metrics_json", type=str, default=None, help="also write the client metrics, with full latency histograms, to this file")
+	args = parser.parse_args()
+	if args.virtual:
+		from sim_des import VirtualSim
+		sim = VirtualSim(num_users=args.num_users, base_rate=1.0 * (15 / 60), num_tokens=NUM_TOKENS, model="vllm-13", strategy=args.strategy, manage=True,
+			num_instances=args.num_instances, seed=args.seed if args.seed is not None else 0)
+		sim.run(args.hours * 3600, log_file=args.log_file)
+		return
+	if args.seed is not None:
+		random.seed(args.seed)
+	sim = Sim(num_iters=50, base_num_users=args.num_users, base_rate=1.0 * (15 / 60), etime=2.0, streaming=True, model="vllm-13", manage=False, strategy=args.strategy, metrics_json=args.metrics_json)
 	sim.run()
 
 if __name__ == "__main__":
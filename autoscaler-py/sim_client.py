@@ -1,74 +1,102 @@
 import time
-from threading import Lock
+from threading import Lock, local
 import requests
 from collections import defaultdict
+from itertools import count
 import subprocess
 import json
 import os
 
 from autoscaler import get_curr_instances, get_model_address
 from prompt_OOBA import send_vllm_request_auth, send_vllm_request_streaming_auth
+from histogram import LogHistogram
 
 WAIT_INTERVAL = 5
 
+NUM_SHARDS = 16
+
+#Written only by the threads that were handed it, so its lock is practically never contended; merged when metrics are reported
+class MetricShard:
+	def __init__(self):
+		self.lock = Lock()
+		self.counters = defaultdict(int)
+		self.instance_counters = defaultdict(lambda: defaultdict(int))
+		self.histograms = defaultdict(LogHistogram)
+		self.instance_histograms = defaultdict(lambda: defaultdict(LogHistogram))
+
+	def merge(self, other):
+		for name, value in other.counters.items():
+			self.counters[name] += value
+		for instance, counters in other.instance_counters.items():
+			for name, value in counters.items():
+				self.instance_counters[instance][name] += value
+		for name, histogram in other.histograms.items():
+			self.histograms[name].merge(histogram)
+		for instance, histograms in other.instance_histograms.items():
+			for name, histogram in histograms.items():
+				self.instance_histograms[instance][name].merge(histogram)
+
+#Request threads record into one of NUM_SHARDS shards instead of sharing one set of totals. Latency, first message wait,
+#the gap between streamed tokens and tokens/s go into log-bucketed histograms, overall and per instance.
 class ClientMetrics:
 	def __init__(self, streaming):
 
 		self.streaming = streaming
 
-		self.num_serverless_server_started = 0
-		self.num_serverless_server_finished = 0
-
-		self.num_requests_started = 0
-		self.num_requests_finished = 0
-		self.num_requests_successful = 0
-		self.total_tokens_generated = 0
-
 		self.total_cost = 0.0
 
-		self.total_request_time = 0.0 #elapsed time across all successful requests
 		self.session_start_time = 0.0
+		self.session_end_time = None
 
-		self.min_request_latency = float('inf')
-		self.max_request_latency = 0.0
-
-		self.total_first_msg_wait = 0.0
-		self.min_first_msg_wait = float('inf')
-		self.max_first_msg_wait = 0.0
-
-		default_value = {"num_requests_started": 0, "num_requests_finished": 0, "num_requests_successful" : 0, "total_tokens_generated" : 0, "total_request_time": 0.0, "reported_tps": 0.0}
-		self.machine_stats_dict = defaultdict(lambda: default_value.copy())
+		self.shards = [MetricShard() for _ in range(NUM_SHARDS)]
+		self.next_shard = count()
+		self.local = local()
 
 		self.lock = Lock()
 
-	#call below with lock LOCKED
-	def get_time_elapsed(self):
-		ret = self.session_end_time - self.session_start_time
-		return ret
-
-	def get_request_throughput(self):
-		ret = self.num_requests_successful / self.get_time_elapsed()
-		return ret
+	def shard(self):
+		shard = getattr(self.local, "shard", None)
+		if shard is None:
+			shard = self.shards[next(self.next_shard) % NUM_SHARDS]
+			self.local.shard = shard
+		return shard
+
+	def count(self, name, value=1, instance=None):
+		shard = self.shard()
+		with shard.lock:
+			shard.counters[name] += value
+			if instance is not None:
+				shard.instance_counters[instance][name] += value
+
+	def observe(self, name, values, instance=None):
+		shard = self.shard()
+		with shard.lock:
+			for value in values:
+				shard.histograms[name].record(value)
+				if instance is not None:
+					shard.instance_histograms[instance][name].record(value)
+
+	def merged(self):
+		merged = MetricShard()
+		for shard in self.shards:
+			with shard.lock:
+				merged.merge(shard)
+		return merged
 
-	def get_tokens_throughput(self):
-		ret = self.total_tokens_generated / self.get_time_elapsed()
+	def get_time_elapsed(self):
+		end_time = self.session_end_time if self.session_end_time is not None else time.time()
+		ret = end_time - self.session_start_time
 		return ret
 
-	def get_average_latency(self):
-		if self.num_requests_successful != 0:
-			ret = self.total_request_time / self.num_requests_successful
-		else:
-			ret = 0.0
+	def get_request_throughput(self, merged):
+		ret = merged.counters["num_requests_successful"] / self.get_time_elapsed()
 		return ret
 
-	def get_average_first_msg_wait(self):
-		if self.num_requests_successful != 0:
-			ret = self.total_first_msg_wait / self.num_requests_successful
-		else:
-			ret = 0.0
+	def get_tokens_throughput(self, merged):
+		ret = merged.counters["total_tokens_generated"] / self.get_time_elapsed()
 		return ret
 
-	def calculate_costs(self):
+	def calculate_costs(self, merged):
 		instances = None
 		for _ in range(5):
 			instances = get_curr_instances()
@@ -81,7 +109,7 @@ class ClientMetrics:
 		for instance in instances:
 			if "ports" not in instance.keys():
 				continue
-			if get_model_address(instance, self.streaming) in self.machine_stats_dict.keys():
+			if get_model_address(instance, self.streaming) in merged.instance_counters.keys():
 				dph += instance["dph_base"]
 		self.total_cost = (self.get_time_elapsed() / (60 * 60)) * dph
 
@@ -89,67 +117,85 @@ class ClientMetrics:
 		ret = self.total_cost
 		return ret
 
-	def get_cost_per_token(self): #cost per kilo-token
-		if self.total_tokens_generated != 0:
-			ret = self.get_total_cost() / (self.total_tokens_generated / 1000)
+	def get_cost_per_token(self, merged): #cost per kilo-token
+		if merged.counters["total_tokens_generated"] != 0:
+			ret = self.get_total_cost() / (merged.counters["total_tokens_generated"] / 1000)
 		else:
 			ret = 0.0
 		return ret
 
-	def print_instance_metrics(self, instance_ip):
+	def histogram_names(self):
+		return ["latency", "first_msg_wait", "token_gap", "tokens/s"] if self.streaming else ["latency", "tokens/s"]
+
+	def print_histograms(self, histograms):
+		for name in self.histogram_names():
+			if name in histograms:
+				print("{}: {}".format(name, histograms[name].format(unit="" if name == "tokens/s" else "s")))
+
+	def print_instance_metrics(self, instance_ip, merged):
 		print("instance ip: {} metrics".format(instance_ip))
-		metric_dict = self.machine_stats_dict[instance_ip]
+		metric_dict = merged.instance_counters[instance_ip]
 		for metric, value in metric_dict.items():
 			print(f"{metric}: {value}")
 		real_tps = 0 if metric_dict["total_request_time"] == 0 else metric_dict["total_tokens_generated"] / metric_dict["total_request_time"]
 		print("real_tps: {}".format(real_tps))
+		self.print_histograms(merged.instance_histograms[instance_ip])
 
 	def print_metrics(self):
-		print(f"printing metrics and lock is locked: {self.lock.locked()}")
-		# print("waiting_for_lock")
-		# self.lock.acquire()
-		# print("got_lock")
-		self.calculate_costs()
+		merged = self.merged()
+		self.calculate_costs(merged)
+		counters = merged.counters
 		print("overall metrics:")
 		print("-----------------------------------------------------")
-		print("number of serverless server requests started: {}".format(self.num_serverless_server_started))
-		print("number of serverless server requests finished: {}".format(self.num_serverless_server_finished))
-		print("number of gpu server requests started: {}".format(self.num_requests_started))
-		print("number of gpu server requests finished: {}".format(self.num_requests_finished))
-		print("number of gpu server requests successful: {}".format(self.num_requests_successful))
-		rel_ratio = (self.num_requests_successful / self.num_requests_started) if self.num_requests_started != 0 else 0.0
+		print("number of serverless server requests started: {}".format(counters["num_serverless_server_started"]))
+		print("number of serverless server requests finished: {}".format(counters["num_serverless_server_finished"]))
+		print("number of gpu server requests started: {}".format(counters["num_requests_started"]))
+		print("number of gpu server requests finished: {}".format(counters["num_requests_finished"]))
+		print("number of gpu server requests successful: {}".format(counters["num_requests_successful"]))
+		rel_ratio = (counters["num_requests_successful"] / counters["num_requests_started"]) if counters["num_requests_started"] != 0 else 0.0
 		print(f"reliability ratio: {rel_ratio}")
 
-		print("number of tokens generated: {}".format(self.total_tokens_generated))
+		print("number of tokens generated: {}".format(counters["total_tokens_generated"]))
 		print("total time elapsed: {}".format(self.get_time_elapsed()))
 
-		print("number of requests per second: {}".format(self.get_request_throughput()))
-		print("number of tokens per second: {}".format(self.get_tokens_throughput()))
-
-		print("average request latency: {}".format(self.get_average_latency()))
-		print("min request latency: {}".format(self.min_request_latency))
-		print("max request latency: {}".format(self.max_request_latency))
+		print("number of requests per second: {}".format(self.get_request_throughput(merged)))
+		print("number of tokens per second: {}".format(self.get_tokens_throughput(merged)))
 
-		if self.streaming:
-			print("avg first msg wait: {}".format(self.get_average_first_msg_wait()))
-			print("min first msg wait: {}".format(self.min_first_msg_wait))
-			print("max first msg wait: {}".format(self.max_first_msg_wait))
+		self.print_histograms(merged.histograms)
 
 		print("total cost in dollars: {}".format(self.get_total_cost()))
-		print("total cost per 1000 tokens: {}".format(self.get_cost_per_token()))
+		print("total cost per 1000 tokens: {}".format(self.get_cost_per_token(merged)))
 		print("-----------------------------------------------------")
 
-		for ip in self.machine_stats_dict.keys():
+		for ip in merged.instance_counters.keys():
 			print("-----------------------------------------------------")
-			self.print_instance_metrics(ip)
-
-		# self.lock.release()
+			self.print_instance_metrics(ip, merged)
+
+	def export_json(self, path):
+		#everything print_metrics shows, with full histograms, for comparing runs
+		merged = self.merged()
+		metrics = {
+			"streaming" : self.streaming,
+			"time_elapsed" : self.get_time_elapsed(),
+			"request_throughput" : self.get_request_throughput(merged),
+			"tokens_throughput" : self.get_tokens_throughput(merged),
+			"total_cost" : self.get_total_cost(),
+			"cost_per_1000_tokens" : self.get_cost_per_token(merged),
+			"counters" : dict(merged.counters),
+			"histograms" : {name : histogram.to_dict() for name, histogram in merged.histograms.items()},
+			"instances" : {instance : {"counters" : dict(merged.instance_counters[instance]),
+				"histograms" : {name : histogram.to_dict() for name, histogram in merged.instance_histograms[instance].items()}} for instance in merged.instance_counters.keys()},
+		}
+		with open(path, "w") as f:
+			json.dump(metrics, f, indent=1)
+		print(f"[client] metrics written to {path}")
 
 class Client:
-	def __init__(self, streaming, model, manage):
+	def __init__(self, streaming, model, manage, strategy="simple"):
 		self.streaming = streaming
 		self.model = model
 		self.manage = manage
+		self.strategy = strategy
 		self.metrics = ClientMetrics(streaming=streaming)
 		self.lb_server_addr = '127.0.0.1:5000'
 		self.auto_server_addr = '127.0.0.1:8000'
@@ -160,7 +206,7 @@ class Client:
 
 	def setup_lb(self):
 		URI = f'http://{self.lb_server_addr}/setup'
-		autoscaler_args = {"streaming" : self.streaming, "manage" : self.manage, "model" : self.model}
+		autoscaler_args = {"streaming" : self.streaming, "manage" : self.manage, "model" : self.model, "strategy" : self.strategy}
 		request_dict = {"args" : autoscaler_args}
 		response = requests.post(URI, json=request_dict)
 		if response.status_code == 200:
@@ -179,58 +225,76 @@ class Client:
 
 
 	def update_metrics_started(self, gpu_addr):
-		# self.metrics.lock.acquire()
-		self.metrics.num_requests_started += 1
-		self.metrics.machine_stats_dict[gpu_addr]['num_requests_started'] += 1
-		# self.metrics.lock.release()
-
-	def update_metrics(self, gpu_addr, success, num_tokens, time_elapsed, first_msg_wait=None):
-		# self.metrics.lock.acquire()
-		machine_entry = self.metrics.machine_stats_dict[gpu_addr]
-		self.metrics.num_requests_finished += 1
-		machine_entry['num_requests_finished'] += 1
+		self.metrics.count("num_requests_started", instance=gpu_addr)
+
+	def update_metrics(self, gpu_addr, success, num_tokens, time_elapsed, first_msg_wait=None, token_gaps=None):
+		metrics = self.metrics
+		metrics.count("num_requests_finished", instance=gpu_addr)
 		if success:
-			self.metrics.num_requests_successful += 1
-			machine_entry["num_requests_successful"] += 1
-			self.metrics.total_request_time += time_elapsed
-			machine_entry['total_request_time'] += time_elapsed
-			self.metrics.min_request_latency = min(self.metrics.min_request_latency, time_elapsed)
-			self.metrics.max_request_latency = max(self.metrics.max_request_latency, time_elapsed)
-			self.metrics.total_tokens_generated += num_tokens
-			machine_entry["total_tokens_generated"] += num_tokens
-
-			if first_msg_wait:
-				self.metrics.min_first_msg_wait = min(self.metrics.min_first_msg_wait, first_msg_wait)
-				self.metrics.max_first_msg_wait = max(self.metrics.max_first_msg_wait, first_msg_wait)
-				self.metrics.total_first_msg_wait += first_msg_wait
-
-		# self.metrics.lock.release()
-
-	def send_prompt(self, text_prompt, id, num_tokens=100):
+			metrics.count("num_requests_successful", instance=gpu_addr)
+			metrics.count("total_request_time", time_elapsed, instance=gpu_addr)
+			metrics.count("total_tokens_generated", num_tokens, instance=gpu_addr)
+			metrics.observe("latency", [time_elapsed], instance=gpu_addr)
+			if time_elapsed > 0:
+				metrics.observe("tokens/s", [num_tokens / time_elapsed], instance=gpu_addr)
+			if first_msg_wait is not None:
+				metrics.observe("first_msg_wait", [first_msg_wait], instance=gpu_addr)
+			if token_gaps:
+				metrics.observe("token_gap", token_gaps, instance=gpu_addr)
+
+	def get_connection(self, num_tokens):
 		request_dict = {"num_tokens" : num_tokens}
 		URI = f'http://{self.lb_server_addr}/connect'
-		# self.metrics.lock.acquire()
-		self.metrics.num_serverless_server_started += 1
-		# self.metrics.lock.release()
+		self.metrics.count("num_serverless_server_started")
 		response = requests.get(URI, json=request_dict)
-		# self.metrics.lock.acquire()
-		self.metrics.num_serverless_server_finished += 1
-		# self.metrics.lock.release()
-
+		self.metrics.count("num_serverless_server_finished")
 		if response.status_code == 200 and response.json()["addr"] is not None:
-			gpu_addr = response.json()["addr"]
-			id_token = response.json()["token"]
+			return response.json()["addr"], response.json()["token"], response.json()["lease"]
+		return None
+
+	def get_connections(self, num_tokens_list):
+		#one /connect_batch round trip for many prompts, returns up to len(num_tokens_list) (addr, token, lease id) leases
+		if len(num_tokens_list) == 0:
+			return []
+		request_dict = {"num_tokens" : num_tokens_list}
+		URI = f'http://{self.lb_server_addr}/connect_batch'
+		self.metrics.count("num_serverless_server_started")
+		response = requests.get(URI, json=request_dict)
+		self.metrics.count("num_serverless_server_finished")
+		if response.status_code == 200:
+			return [(lease["addr"], lease["token"], lease["lease"]) for lease in response.json()["leases"]]
+		return []
+
+	def release(self, lease_id, num_tokens=None, time_elapsed=None, first_token=None):
+		#tells the load balancer the request is done, and for successful ones how fast the instance really was
+		request_dict = {"lease" : lease_id, "num_tokens" : num_tokens, "latency" : time_elapsed, "first_token" : first_token}
+		URI = f'http://{self.lb_server_addr}/release'
+		try:
+			requests.post(URI, json=request_dict, timeout=5)
+		except requests.exceptions.RequestException:
+			pass
+
+	def send_prompt(self, text_prompt, id, num_tokens=100, lease=None):
+		if lease is None:
+			lease = self.get_connection(num_tokens)
+
+		if lease is not None:
+			gpu_addr, id_token, lease_id = lease
 			self.update_metrics_started(gpu_addr)
 			start_time = time.time()
 			if self.streaming:
 				gpu_response = send_vllm_request_streaming_auth(gpu_addr, id_token, text_prompt)
 			else:
-				gpu_response = send_vllm_request_auth(gpu_addr, id_token, text_prompt)
+				gpu_response = send_vllm_request_auth(gpu_addr, id_token, text_prompt, max_new_tokens=num_tokens)
 
 			end_time = time.time()
 			time_elapsed = end_time - start_time
-			success = (gpu_response["reply"] is not None)
-			self.update_metrics(gpu_addr, success, gpu_response["num_tokens"], time_elapsed, gpu_response["first_msg_wait"])
+			success = gpu_response["reply"] is not None and gpu_response["error"] is None #streams can fail after part of a reply
+			self.update_metrics(gpu_addr, success, gpu_response["num_tokens"], time_elapsed, gpu_response["first_msg_wait"], gpu_response["token_gaps"])
+			if success:
+				self.release(lease_id, gpu_response["num_tokens"], time_elapsed, gpu_response["first_msg_wait"])
+			else:
+				self.release(lease_id)
 			if not success:
 				self.error_lock.acquire()
 				os.write(self.error_fd, f"{gpu_response['error']}\n".encode("utf-8"))
@@ -0,0 +1,269 @@
+import heapq
+import random
+import math
+import json
+import time
+import os
+import contextlib
+from itertools import count
+
+from autoscaler import InstanceSetBase, TIME_INTERVAL_SECONDS, INSTANCE_CONFIG_NAME, PERF_RECORD_SECONDS, classify_instance
+from action_executor import ActionExecutor, ACTION_RATE
+from loadbalancer import LoadBalancer, TIME_INTERVAL_SECONDS as LB_INTERVAL_SECONDS
+from probe_scheduler import ProbeScheduler, EXPECTED_LOAD_SECONDS, DEFAULT_LOAD_SECONDS
+from fake_vast import FakeCloud
+from offer_cache import OFFER_TTL
+from instance_store import InstanceStore
+from machine_perf import MachinePerf
+from vast_api import build_offer_query
+
+#Discrete-event version of sim.py. Users, the LoadBalancer's queue policy, the autoscaler's strategy and the instances'
+#boot and serve times all run on one virtual clock, so days of traffic take seconds and a seed reproduces a run exactly.
+#Instances come from FakeCloud, the LoadBalancer is the real class (driven by hand instead of by its background thread),
+#and scaling decisions come from the real strategies in strategy.py fed by the metrics_snapshot InstanceSet uses, and are
+#turned into actions by its queue_decision and carried out by a real ActionExecutor on the virtual clock.
+
+DAY_SECONDS = 24 * 60 * 60
+
+class VirtualClock:
+	def __init__(self, start=0.0):
+		self.now = start
+		self.events = [] #(time, seq, fn, args)
+		self.seq = count()
+
+	def __call__(self):
+		return self.now
+
+	def schedule(self, delay, fn, *args):
+		heapq.heappush(self.events, (self.now + delay, next(self.seq), fn, args))
+
+	def run_until(self, end_time):
+		while len(self.events) > 0 and self.events[0][0] <= end_time:
+			t, _, fn, args = heapq.heappop(self.events)
+			self.now = t
+			fn(*args)
+		self.now = end_time
+
+class SimTokens:
+	#stands in for InstanceClient: auth tokens are never the bottleneck here, and each one names its instance
+	def __init__(self, instance_id, instance_addr, mtoken):
+		self.instance_id = instance_id
+
+	def take_token(self):
+		return self.instance_id
+
+	def monitor_token_queue(self):
+		pass
+
+#What the LoadBalancer sees as the autoscaler server, and what the strategy sees as the InstanceSet. Hot means the model
+#server is up, as a heartbeat would report. Everything from the snapshot the strategy decides on to the actions queued
+#for its decision comes from InstanceSetBase, only talking to the cloud is the sim's own.
+class SimInstanceSet(InstanceSetBase):
+	def __init__(self, cloud, clock, model, strategy, manage):
+		probes = ProbeScheduler(expected_load_seconds=EXPECTED_LOAD_SECONDS.get(model, DEFAULT_LOAD_SECONDS), clock=clock)
+		super().__init__(model, manage, {}, MachinePerf(InstanceStore(":memory:"), model), ActionExecutor(None, clock=clock), probes)
+		self.cloud = cloud
+		self.clock = clock
+		with open(INSTANCE_CONFIG_NAME, "r") as f:
+			self.get_config = json.load(f)[model]["get"]
+		self.perf_recorded_at = clock()
+		self.asks = []
+		self.asks_time = None
+		self.update_instance_info()
+		self.strat = self.make_strategy(strategy)
+
+	#autoscaler_client.Client interface for the LoadBalancer
+	def setup_autoscaler(self, autoscaler_args):
+		pass
+
+	def destroy_autoscaler(self):
+		pass
+
+	def get_hot_instances(self, wait=0):
+		return list(self.hot_instances.values())
+
+	def report_hot_busy(self, num_hot, num_busy, **load):
+		self.num_hot = num_hot
+		self.num_busy = num_busy
+		self.report_load(load.get("num_in_flight"), load.get("queue_depth"), load.get("instance_load"), load.get("request_rate"), load.get("token_rate"), load.get("capacity"), load.get("instance_perf"))
+		return self.hot_perf
+
+	def update_instance_info(self):
+		now = self.clock()
+		self.instances = {instance["id"] : instance for instance in self.cloud.show_instances()}
+		self.actions.reconcile(self.instances)
+		self.running_instances, self.loading_instances, self.cold_instances, hot_instances, hot_perf = {}, {}, {}, {}, {}
+		for id, instance in self.instances.items():
+			if id not in self.instance_info_map:
+				self.instance_info_map[id] = {"model_loaded" : None}
+			state = classify_instance(instance)
+			if state == "running":
+				self.running_instances[id] = instance
+				self.running_since.setdefault(id, now)
+				fake = self.cloud.instances[id]
+				if fake.model_loaded(now):
+					if self.instance_info_map[id]["model_loaded"] is None: #the tokens/s its first heartbeat (or benchmark) would report
+						self.perf.record(instance, tps=fake.tps)
+					hot_instances[id] = dict(instance, mtoken=fake.mtoken)
+					hot_perf[id] = {"tokens/s" : None, "expected_tps" : self.perf.predicted_tps(instance)}
+					self.instance_info_map[id]["model_loaded"] = now
+			elif state == "loading":
+				self.loading_instances[id] = instance
+			elif state == "cold":
+				self.cold_instances[id] = instance
+		self.running_since = {id : t for id, t in self.running_since.items() if id in self.running_instances}
+		self.hot_instances = hot_instances
+		self.hot_perf = hot_perf
+		if now - self.perf_recorded_at >= PERF_RECORD_SECONDS:
+			self.perf.record_many([(self.instances[id], perf) for id, perf in self.instance_perf.items() if id in self.instances])
+			self.perf_recorded_at = now
+
+	def get_asks(self):
+		#searched again every OFFER_TTL, like OfferCache
+		now = self.clock()
+		if self.asks_time is None or now - self.asks_time > OFFER_TTL:
+			asks = {}
+			for gpu_config in self.get_config["gpu"]:
+				for offer in self.cloud.search_offers(build_offer_query(gpu_config, self.get_config["disk_space"], "dlperf_per_dphtotal")):
+					asks[offer["id"]] = offer
+			self.asks = list(asks.values())
+			self.asks_time = now
+		return sorted(self.asks, key=self.perf.cost_per_1k_tokens)
+
+	def manage_instances(self):
+		now = self.clock()
+		decision = self.strat.decide(self.metrics_snapshot(now))
+		if self.manage:
+			ask_list = self.get_asks() if decision["create"] > 0 else None
+			self.queue_decision(decision, list(self.running_instances.values()), list(self.cold_instances.values()), self.instance_load, ask_list)
+			self.actions.run_due() #submitting wakes the real executor right away
+		return decision
+
+	#the scale actions queue_decision queues, named like InstanceSet's so cancel_queued and the rate limit treat them the same
+	def start_instance(self, instance):
+		return self.cloud.start_instance(instance["id"])
+
+	def stop_instance(self, instance):
+		return self.cloud.stop_instance(instance["id"])
+
+	def destroy_instance(self, instance):
+		return self.cloud.destroy_instance(instance["id"])
+
+	def create_instance(self, ask):
+		self.asks = [offer for offer in self.asks if offer["id"] != ask["id"]] #like OfferCache.drop_offer
+		return self.cloud.create_instance(ask["id"], None, None, {"MASTER_TOKEN" : f"sim-{ask['id']}"})
+
+class SimMetrics:
+	def __init__(self):
+		self.num_requests_started = 0
+		self.num_requests_successful = 0
+		self.num_no_addr = 0
+		self.num_failed = 0
+		self.total_tokens_generated = 0
+		self.latencies = []
+		self.total_cost = 0.0
+		self.hot_seconds = 0.0
+		self.max_num_hot = 0
+
+	def percentile(self, p):
+		if len(self.latencies) == 0:
+			return 0.0
+		latencies = sorted(self.latencies)
+		return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+	def print_metrics(self, sim_seconds, wall_seconds):
+		print("virtual sim metrics:")
+		print("-----------------------------------------------------")
+		print(f"simulated time: {sim_seconds / 3600:.1f} hours in {wall_seconds:.1f}s of wall time")
+		print(f"number of requests started: {self.num_requests_started}")
+		print(f"number of requests successful: {self.num_requests_successful}")
+		print(f"number of requests without an address: {self.num_no_addr}")
+		print(f"number of requests lost to instances going away: {self.num_failed}")
+		print(f"number of tokens generated: {self.total_tokens_generated}")
+		print(f"p50 latency: {self.percentile(50):.2f}s, p99 latency: {self.percentile(99):.2f}s")
+		print(f"average num hot: {self.hot_seconds / max(sim_seconds, 1):.1f}, max num hot: {self.max_num_hot}")
+		print(f"total cost in dollars: {self.total_cost:.2f}")
+		cost_per_token = self.total_cost / (self.total_tokens_generated / 1000) if self.total_tokens_generated != 0 else 0.0
+		print(f"total cost per 1000 tokens: {cost_per_token:.5f}")
+		print("-----------------------------------------------------")
+
+class VirtualSim:
+	def __init__(self, num_users=50, base_rate=15 / 60, num_tokens=100, model="vllm-13", strategy="simple", manage=True, num_instances=10,
+			num_offers=1000, diurnal_amplitude=0.5, seed=0, cloud_args=None):
+		self.clock = VirtualClock()
+		self.random = random.Random(seed)
+		self.num_users = num_users
+		self.base_rate = base_rate #requests per second per idle user
+		self.num_tokens = num_tokens
+		self.diurnal_amplitude = diurnal_amplitude
+		self.metrics = SimMetrics()
+
+		self.cloud = FakeCloud(num_offers=num_offers, model=model, seed=seed, clock=self.clock, **(cloud_args or {}))
+		self.cloud.add_instances(num_instances)
+		self.instance_set = SimInstanceSet(self.cloud, self.clock, model, strategy, manage)
+		self.lb = LoadBalancer({"streaming" : False, "model" : model}, client=self.instance_set, instance_client=SimTokens, clock=self.clock, background=False)
+
+	def rate(self):
+		#per-user request rate, following a daily cycle
+		return self.base_rate * (1 + self.diurnal_amplitude * math.sin(2 * math.pi * self.clock() / DAY_SECONDS))
+
+	def think(self, user):
+		self.clock.schedule(self.random.expovariate(max(self.rate(), 1e-9)), self.send_request, user)
+
+	def send_request(self, user):
+		self.metrics.num_requests_started += 1
+		addr, instance_id, lease_id = self.lb.get_next_addr(self.num_tokens)
+		instance = self.cloud.instances.get(instance_id) if addr is not None else None
+		if instance is None or not instance.model_loaded(self.clock()):
+			if addr is None:
+				self.metrics.num_no_addr += 1
+			else:
+				self.metrics.num_failed += 1
+				self.lb.release(lease_id)
+			self.think(user)
+			return
+		latency = self.cloud.begin_request(instance, self.num_tokens)
+		self.clock.schedule(latency, self.finish_request, user, instance, lease_id, latency)
+
+	def finish_request(self, user, instance, lease_id, latency):
+		self.cloud.end_request(instance)
+		if instance.id in self.cloud.instances and instance.model_loaded(self.clock()):
+			self.metrics.num_requests_successful += 1
+			self.metrics.total_tokens_generated += self.num_tokens
+			self.metrics.latencies.append(latency)
+			self.lb.release(lease_id, self.num_tokens, latency)
+		else:
+			self.metrics.num_failed += 1
+			self.lb.release(lease_id)
+		self.think(user)
+
+	def autoscaler_tick(self):
+		self.instance_set.update_instance_info()
+		self.instance_set.manage_instances()
+		dph = sum(instance["dph_total"] for instance in self.instance_set.instances.values() if instance["actual_status"] in ("running", "loading"))
+		self.metrics.total_cost += dph * TIME_INTERVAL_SECONDS / 3600
+		self.metrics.hot_seconds += len(self.instance_set.hot_instances) * TIME_INTERVAL_SECONDS
+		self.metrics.max_num_hot = max(self.metrics.max_num_hot, len(self.instance_set.hot_instances))
+		self.clock.schedule(TIME_INTERVAL_SECONDS, self.autoscaler_tick)
+
+	def actions_tick(self):
+		#the real executor also starts whatever the rate limit allows every 1 / ACTION_RATE seconds while actions are queued
+		self.instance_set.actions.run_due()
+		self.clock.schedule(1 / ACTION_RATE, self.actions_tick)
+
+	def lb_tick(self):
+		self.lb.update_hot_queue()
+		self.lb.tick_duration()
+		self.clock.schedule(LB_INTERVAL_SECONDS, self.lb_tick)
+
+	def run(self, sim_seconds, log_file=None):
+		t1 = time.time()
+		for user in range(self.num_users):
+			self.think(user)
+		self.clock.schedule(0, self.autoscaler_tick)
+		self.clock.schedule(0, self.lb_tick)
+		self.clock.schedule(0, self.actions_tick)
+		with open(log_file or os.devnull, "w") as log, contextlib.redirect_stdout(log): #component logs go to log_file
+			self.clock.run_until(sim_seconds)
+		self.metrics.print_metrics(sim_seconds, time.time() - t1)
+		return self.metrics
@@ -0,0 +1,132 @@
+import os
+import subprocess
+import tempfile
+import time
+from threading import Lock, BoundedSemaphore
+
+from prom_metrics import REGISTRY
+
+SSH_KEY_FILE = os.environ.get("VAST_SSH_KEY") #None means ssh picks its default keys
+SSH_USER = "root"
+CONNECT_TIMEOUT = 5
+COMMAND_TIMEOUT = 10
+IDLE_TIMEOUT = 300
+MAX_CONCURRENCY = 64
+
+COMMAND_SECONDS = REGISTRY.histogram("ssh_command_seconds", "ssh commands run through the pool, including waiting for a slot and opening the master connection", ["outcome"])
+MASTER_OPENS = REGISTRY.counter("ssh_master_opens_total", "Master connections opened", ["outcome"])
+
+class SSHSession:
+	def __init__(self, host, port, control_path):
+		self.host = host
+		self.port = port
+		self.control_path = control_path
+		self.last_used = time.time()
+		self.lock = Lock() #held while the master connection is being opened
+
+#Keeps one multiplexed OpenSSH master connection per (ssh_host, ssh_port), so a probe only opens a new channel on an
+#already authenticated connection instead of paying for a new process handshake and key exchange every time
+class SSHPool:
+	def __init__(self, key_file=SSH_KEY_FILE, user=SSH_USER, connect_timeout=CONNECT_TIMEOUT, command_timeout=COMMAND_TIMEOUT, idle_timeout=IDLE_TIMEOUT, max_concurrency=MAX_CONCURRENCY):
+		self.key_file = key_file
+		self.user = user
+		self.connect_timeout = connect_timeout
+		self.command_timeout = command_timeout
+		self.idle_timeout = idle_timeout
+
+		self.control_dir = tempfile.mkdtemp(prefix="vast-ssh-")
+		self.sessions = {}
+		self.lock = Lock()
+		self.semaphore = BoundedSemaphore(max_concurrency)
+
+	def get_session(self, host, port):
+		key = (host, int(port))
+		self.lock.acquire()
+		session = self.sessions.get(key)
+		if session is None:
+			control_path = os.path.join(self.control_dir, f"{host}-{port}")
+			session = SSHSession(host, int(port), control_path)
+			self.sessions[key] = session
+		session.last_used = time.time()
+		self.lock.release()
+		return session
+
+	def ssh_args(self, session, *options):
+		args = ["ssh", "-p", str(session.port), "-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null", "-o", "LogLevel=ERROR", "-o", "BatchMode=yes"]
+		args += ["-o", f"ConnectTimeout={self.connect_timeout}", "-o", f"ControlPath={session.control_path}"]
+		if self.key_file is not None:
+			args += ["-i", self.key_file]
+		for option in options:
+			args += ["-o", option]
+		return args
+
+	def open_master(self, session):
+		#-f backgrounds the master once it is authenticated, and its output goes to DEVNULL so nothing waits on its pipes
+		args = self.ssh_args(session, "ControlMaster=yes", f"ControlPersist={self.idle_timeout}") + ["-N", "-f", f"{self.user}@{session.host}"]
+		try:
+			result = subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=self.connect_timeout + 1)
+		except subprocess.TimeoutExpired:
+			return False
+		return result.returncode == 0
+
+	def run(self, host, port, command, timeout=None):
+		#returns the command's stdout, or None if the host could not be reached in time
+		return self.try_run(host, port, command, timeout)[1]
+
+	def try_run(self, host, port, command, timeout=None):
+		#returns (whether the command was sent to the host, its stdout or None). It isn't sent when no slot in the pool frees
+		#up in time, which says nothing about the host.
+		t1 = time.time()
+		out, outcome = self.run_command(host, port, command, timeout)
+		COMMAND_SECONDS.labels(outcome).observe(time.time() - t1)
+		return outcome != "busy", out
+
+	def run_command(self, host, port, command, timeout):
+		timeout = timeout if timeout is not None else self.command_timeout
+		if not self.semaphore.acquire(timeout=timeout):
+			return None, "busy"
+		try:
+			session = self.get_session(host, port)
+			with session.lock:
+				if not os.path.exists(session.control_path):
+					opened = self.open_master(session)
+					MASTER_OPENS.labels("ok" if opened else "failed").inc()
+					if not opened:
+						return None, "unreachable"
+			args = self.ssh_args(session, "ControlMaster=no") + [f"{self.user}@{session.host}", command]
+			try:
+				result = subprocess.run(args, stdin=subprocess.DEVNULL, capture_output=True, timeout=timeout)
+			except subprocess.TimeoutExpired:
+				return None, "timeout"
+			if result.returncode == 255: #ssh itself failed, so the master is likely gone
+				self.close_session(session)
+				return None, "failed"
+			return result.stdout.decode('utf-8'), "ok"
+		finally:
+			self.semaphore.release()
+
+	def close_session(self, session):
+		self.lock.acquire()
+		if self.sessions.get((session.host, session.port)) is session:
+			del self.sessions[(session.host, session.port)]
+		self.lock.release()
+		if os.path.exists(session.control_path):
+			try:
+				subprocess.run(self.ssh_args(session) + ["-O", "exit", f"{self.user}@{session.host}"], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=self.connect_timeout)
+			except subprocess.TimeoutExpired:
+				pass
+
+	def evict_idle(self):
+		cutoff = time.time() - self.idle_timeout
+		self.lock.acquire()
+		idle_sessions = [session for session in self.sessions.values() if session.last_used < cutoff]
+		self.lock.release()
+		for session in idle_sessions:
+			self.close_session(session)
+
+	def close(self):
+		self.lock.acquire()
+		sessions = list(self.sessions.values())
+		self.lock.release()
+		for session in sessions:
+			self.close_session(session)
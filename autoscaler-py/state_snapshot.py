@@ -0,0 +1,65 @@
+import json
+import time
+from threading import Condition
+
+HOT_PORTS = ["5000/tcp", "5005/tcp"] #auth server and streaming model server
+MAX_WAIT_SECONDS = 60
+
+#what the loadbalancer needs to know about a hot instance, instead of every field the Vast API returns for it. Only fields
+#that stay put while the instance is hot, so the snapshot's version changes with the hot set rather than with every
+#heartbeat; tokens/s goes to the loadbalancer with each /report instead.
+def hot_projection(instance, mtoken):
+	return {
+		"id" : instance["id"],
+		"public_ipaddr" : instance["public_ipaddr"],
+		"ports" : {port : instance["ports"][port] for port in HOT_PORTS if port in (instance.get("ports") or {})},
+		"mtoken" : mtoken,
+		"gpu_name" : instance.get("gpu_name"),
+		"num_gpus" : instance.get("num_gpus"),
+	}
+
+class Snapshot:
+	def __init__(self, version, fields, data, body):
+		self.version = version
+		self.fields = fields #what was published, for readers in the same process. Never modified once published.
+		self.data = data #the fields serialized without the version, to tell whether a new publish changes anything
+		self.body = body #the response body, serialized once when published
+		self.etag = f"\"{version}\""
+
+	def matches(self, since):
+		return since is not None and str(since).strip("W/\"") == str(self.version)
+
+#Holds the latest immutable snapshot of some state. Writers publish a new snapshot (only a change gets a new version)
+#and readers just take the current one, so serving it never waits on the autoscaler's lock. Versions start from the
+#current time in microseconds, so they keep going up when the autoscaler is set up again and a version a client kept
+#from before can't be mistaken for a new one.
+class SnapshotPublisher:
+	def __init__(self, fields):
+		self.condition = Condition()
+		version = time.time_ns() // 1000
+		data = json.dumps(fields)
+		self.current = Snapshot(version, fields, data, self.make_body(version, data))
+
+	@staticmethod
+	def make_body(version, data):
+		#data is a serialized, non-empty dict, so the version can be added without serializing it again
+		return f"{{\"version\": {version}, {data[1:]}"
+
+	def publish(self, fields):
+		data = json.dumps(fields)
+		with self.condition:
+			if data == self.current.data:
+				return self.current
+			version = self.current.version + 1
+			self.current = Snapshot(version, fields, data, self.make_body(version, data))
+			self.condition.notify_all()
+			return self.current
+
+	def wait(self, since, timeout):
+		#long poll: returns as soon as there's a snapshot other than version since, or the current one after timeout seconds
+		snapshot = self.current
+		if not snapshot.matches(since) or timeout <= 0:
+			return snapshot
+		with self.condition:
+			self.condition.wait_for(lambda: not self.current.matches(since), min(timeout, MAX_WAIT_SECONDS))
+			return self.current
@@ -0,0 +1,177 @@
+import math
+from abc import ABC, abstractmethod
+
+from ratio_manager import update_rolling_average
+from throughput_model import prior_tps
+
+#Autoscaling strategies. InstanceSet.manage_instances builds a metrics snapshot every tick (see InstanceSet.metrics_snapshot)
+#and asks its strategy how many instances to stop, start, create and destroy; which instances get acted on is up to InstanceSet.
+
+def no_action():
+	return {"stop" : 0, "start" : 0, "create" : 0, "destroy" : 0}
+
+class Strategy(ABC):
+	@abstractmethod
+	def decide(self, snapshot):
+		pass
+
+#Reactive rules on the ratio of busy to hot instances (start/stop) and of hot to all instances (create/destroy)
+class SimpleStrategy(Strategy):
+	def __init__(self, avg_num_hot=0):
+		self.start_num_hot = 10
+
+		self.target_hot_busy_ratio_upper = 0.9
+		self.target_hot_busy_ratio_lower = 0.6
+		self.target_hot_ratio = 0.3
+
+		self.avg_num_busy = 0
+		self.avg_num_hot = avg_num_hot
+
+		# self.price_limit = 0.3
+
+	def decide(self, snapshot):
+		decision = no_action()
+		interval = snapshot["interval"]
+		if snapshot["num_busy"] > self.avg_num_busy:
+			num_hot_busy = snapshot["num_busy"]
+		else:
+			num_hot_busy = update_rolling_average(self.avg_num_busy, snapshot["num_busy"], interval, 0.01)
+		self.avg_num_busy = num_hot_busy
+
+		num_hot = snapshot["num_hot"]
+		num_loading = snapshot["num_image_loading"] + snapshot["num_model_loading"]
+		num_cold = snapshot["num_cold"] + num_loading
+		num_tot = num_hot + num_cold
+
+		hot_busy_ratio = (num_hot_busy + 1) / (num_hot + 0.05)
+		hot_ratio = (num_hot + 1) / (num_tot + 0.1)
+
+		num_hot_rolling = update_rolling_average(self.avg_num_hot, num_hot, interval, 0.01)
+		self.avg_num_hot = num_hot_rolling
+		hot_ratio_rolling = (num_hot_rolling + 1) / (num_tot + 0.1)
+
+		print("[strategy] hot_busy_ratio: {}, hot_ratio: {}, hot_ratio_rolling: {}, num_busy: {}".format(hot_busy_ratio, hot_ratio, hot_ratio_rolling, num_hot_busy))
+
+		if hot_busy_ratio < self.target_hot_busy_ratio_lower:
+			print("[strategy] hot busy ratio too low!")
+			decision["stop"] = num_hot - int((hot_busy_ratio / self.target_hot_busy_ratio_lower) * max(num_hot, 1))
+		elif hot_busy_ratio >= self.target_hot_busy_ratio_upper:
+			print("[strategy] hot busy ratio too high!")
+			decision["start"] = int((hot_busy_ratio / self.target_hot_busy_ratio_upper) * max(num_hot, 1)) - num_hot
+
+		if hot_ratio > self.target_hot_ratio:
+			print("[strategy] hot ratio too high!")
+			decision["create"] = int((hot_ratio / self.target_hot_ratio) * max(num_tot, 1)) - num_tot
+		elif hot_ratio_rolling < self.target_hot_ratio:
+			print("[strategy] hot ratio too low!")
+			decision["destroy"] = num_tot - int((hot_ratio_rolling / self.target_hot_ratio) * max(num_tot, 1))
+
+		return decision
+
+#Holt-Winters style forecast of demand (tokens/s): a smoothed level and trend plus an additive offset for each slot of the day
+class DemandForecast:
+	def __init__(self, alpha=0.3, beta=0.05, gamma=0.1, slot_seconds=15 * 60, season_seconds=24 * 60 * 60):
+		self.alpha = alpha
+		self.beta = beta
+		self.gamma = gamma
+		self.slot_seconds = slot_seconds
+		self.num_slots = season_seconds // slot_seconds
+		self.season = [0.0] * self.num_slots
+		self.season_seen = [False] * self.num_slots
+		self.level = None
+		self.trend = 0.0 #change in demand per second
+		self.last_time = None
+
+	def slot(self, t):
+		return int(t // self.slot_seconds) % self.num_slots
+
+	def observe(self, t, demand):
+		if self.level is None:
+			self.level = demand
+			self.last_time = t
+			return
+		dt = t - self.last_time
+		if dt <= 0:
+			return
+		#alpha and beta are per 5s tick, rescaled so irregular ticks weigh the same per second
+		alpha = 1 - (1 - self.alpha) ** (dt / 5)
+		beta = 1 - (1 - self.beta) ** (dt / 5)
+		slot = self.slot(t)
+		deseasoned = demand - self.season[slot]
+		prev_level = self.level
+		self.level = alpha * deseasoned + (1 - alpha) * (self.level + self.trend * dt)
+		self.trend = beta * (self.level - prev_level) / dt + (1 - beta) * self.trend
+		if self.season_seen[slot]:
+			self.season[slot] += self.gamma * alpha * (demand - self.level - self.season[slot])
+		else:
+			self.season[slot] = 0.0
+			self.season_seen[slot] = True
+		self.last_time = t
+
+	def forecast(self, horizon):
+		if self.level is None:
+			return 0.0
+		t = self.last_time + horizon
+		return max(0.0, self.level + self.trend * horizon + self.season[self.slot(t)])
+
+	def peak(self, horizon, num_points=4):
+		#highest forecast between now and horizon
+		return max(self.forecast(horizon * i / num_points) for i in range(num_points + 1))
+
+#Plans capacity ahead of demand: forecasts demand at the time a cold instance started now (or a new one created now) would
+#become hot, and starts or creates enough instances that the fleet is ready for it, counting instances that are already on
+#their way. Instances are only stopped or destroyed when the forecast stays below what is left over the whole time it
+#would take to get them back.
+class ForecastStrategy(Strategy):
+	def __init__(self, target_utilization=0.7, min_hot=1, cold_reserve=0.2, stop_slack=1.25, destroy_slack=1.5, forecast=None, model=None):
+		self.target_utilization = target_utilization
+		self.min_hot = min_hot
+		self.cold_reserve = cold_reserve #fraction of the forecast fleet kept stopped, ready to start on surprises
+		self.stop_slack = stop_slack
+		self.destroy_slack = destroy_slack
+		self.forecast = forecast if forecast is not None else DemandForecast()
+		self.instance_tps = None #tokens/s one hot instance serves
+		self.model = model
+
+	def needed(self, demand):
+		return max(self.min_hot, math.ceil(demand / (self.instance_tps * self.target_utilization)))
+
+	def decide(self, snapshot):
+		decision = no_action()
+		now = snapshot["time"]
+		num_hot = snapshot["num_hot"]
+		self.forecast.observe(now, snapshot["token_rate"] or 0.0)
+		if num_hot > 0 and snapshot["capacity"]:
+			instance_tps = snapshot["capacity"] / num_hot
+			self.instance_tps = instance_tps if self.instance_tps is None else update_rolling_average(self.instance_tps, instance_tps, snapshot["interval"], 0.01)
+		elif self.instance_tps is None:
+			self.instance_tps = prior_tps({}, self.model) #an average gpu serving the model, until there is capacity to go on
+
+		cold_etas = sorted(snapshot["cold_time_to_hot"])
+		loading_etas = snapshot["loading_time_to_hot"]
+		start_horizon = cold_etas[len(cold_etas) // 2] if len(cold_etas) != 0 else snapshot["start_seconds"]
+		create_horizon = snapshot["create_seconds"]
+
+		need_start = self.needed(self.forecast.peak(start_horizon))
+		need_create = self.needed(self.forecast.peak(create_horizon))
+		reserve = math.ceil(self.cold_reserve * need_create)
+		num_cold = len(cold_etas)
+		num_loading = len(loading_etas)
+		ready_by_start = num_hot + sum(1 for eta in loading_etas if eta <= start_horizon)
+
+		print(f"[strategy] demand: {self.forecast.forecast(0):.1f} tok/s, forecast: {self.forecast.forecast(start_horizon):.1f} in {start_horizon:.0f}s, {self.forecast.forecast(create_horizon):.1f} in {create_horizon:.0f}s, instance tps: {self.instance_tps:.1f}, need: {need_start}/{need_create}, ready by then: {ready_by_start}/{num_hot + num_loading + num_cold}")
+
+		if need_start > ready_by_start:
+			decision["start"] = min(need_start - ready_by_start, num_cold)
+		elif num_hot > self.stop_slack * need_start:
+			decision["stop"] = num_hot - math.ceil(self.stop_slack * need_start)
+
+		num_total = num_hot + num_loading + num_cold
+		if need_create + reserve > num_total:
+			decision["create"] = need_create + reserve - num_total
+		elif num_total > self.destroy_slack * (need_create + reserve):
+			decision["destroy"] = min(num_cold - decision["start"], num_total - math.ceil(self.destroy_slack * (need_create + reserve)))
+
+		return decision
+
+STRATEGIES = {"simple" : SimpleStrategy, "forecast" : ForecastStrategy}
@@ -0,0 +1,94 @@
+from action_executor import ActionExecutor
+
+class FakeCloud:
+	def __init__(self, result=True):
+		self.result = result
+		self.calls = []
+
+	def start_instance(self, id):
+		self.calls.append(("start_instance", id))
+		return self.result
+
+	def stop_instance(self, id):
+		self.calls.append(("stop_instance", id))
+		return self.result
+
+def make_executor(**kwargs):
+	t = [0.0]
+	return ActionExecutor(None, clock=lambda: t[0], **kwargs), t
+
+def test_submit_dedupes_per_target():
+	actions, t = make_executor()
+	cloud = FakeCloud()
+	assert actions.submit(cloud.stop_instance, 1, 1)
+	assert not actions.submit(cloud.stop_instance, 1, 1)
+	assert not actions.submit(cloud.start_instance, 1, 1) #any kind of action on the same instance
+	assert actions.num_pending("stop_instance") == 1
+	actions.run_due()
+	assert cloud.calls == [("stop_instance", 1)]
+	assert not actions.submit(cloud.stop_instance, 1, 1) #still waiting to show up in the instance list
+
+def test_cancel_queued_only_drops_that_kind():
+	actions, t = make_executor()
+	cloud = FakeCloud()
+	actions.submit(cloud.stop_instance, 1, 1)
+	actions.submit(cloud.stop_instance, 2, 2)
+	actions.submit(cloud.start_instance, 3, 3)
+	assert actions.cancel_queued("stop_instance") == 2
+	assert not actions.pending(1) and not actions.pending(2)
+	assert actions.pending(3)
+	actions.run_due()
+	assert cloud.calls == [("start_instance", 3)]
+
+def test_cancel_queued_leaves_running_actions():
+	actions, t = make_executor()
+	cloud = FakeCloud()
+	actions.submit(cloud.stop_instance, 1, 1)
+	actions.run_due()
+	assert actions.cancel_queued("stop_instance") == 0
+	assert actions.pending(1)
+
+def test_rate_limit_allowance():
+	actions, t = make_executor(rate=0.5, burst=2)
+	cloud = FakeCloud()
+	for id in range(5):
+		actions.submit(cloud.stop_instance, id, id)
+	actions.submit(cloud.start_instance, 10, 10)
+	actions.run_due()
+	#a burst of each kind, and the kinds don't share an allowance
+	assert cloud.calls == [("stop_instance", 0), ("stop_instance", 1), ("start_instance", 10)]
+	t[0] = 1.0
+	actions.run_due()
+	assert len(cloud.calls) == 3
+	t[0] = 2.0
+	actions.run_due()
+	assert cloud.calls[3:] == [("stop_instance", 2)]
+	t[0] = 100.0
+	actions.run_due()
+	assert cloud.calls[4:] == [("stop_instance", 3), ("stop_instance", 4)] #the allowance is capped at the burst
+
+def test_failed_action_can_be_retried():
+	actions, t = make_executor()
+	cloud = FakeCloud(result=False)
+	actions.submit(cloud.stop_instance, 1, 1)
+	actions.run_due()
+	assert not actions.pending(1)
+	assert actions.submit(cloud.stop_instance, 1, 1)
+
+def test_reconcile_confirms_and_times_out():
+	actions, t = make_executor(confirm_seconds=120)
+	cloud = FakeCloud()
+	actions.submit(cloud.start_instance, 1, 1)
+	actions.submit(cloud.stop_instance, 2, 2)
+	actions.run_due()
+	instances = {1 : {"intended_status" : "running"}, 2 : {"intended_status" : "running"}}
+	t[0] = 10.0
+	actions.reconcile(instances)
+	assert not actions.pending(1)
+	assert actions.pending(2) #the stop hasn't shown up yet
+	t[0] = 120.0
+	actions.reconcile(instances)
+	assert actions.pending(2)
+	t[0] = 121.0
+	actions.reconcile(instances)
+	assert not actions.pending(2)
@@ -0,0 +1,95 @@
+import socket
+import time
+from threading import Lock
+
+import autoscaler
+from autoscaler import InstanceSet, handle_heartbeat
+
+class Probing:
+	streaming = False
+	check_server_hot = InstanceSet.check_server_hot
+	probe_hot_instance = InstanceSet.probe_hot_instance
+
+	def __init__(self, ssh):
+		self.ssh = ssh
+		self.tested = []
+
+	def test_hot_instance(self, instance, token):
+		self.tested.append(instance["id"])
+		return True
+
+class BusySSH:
+	def try_run(self, host, port, command, timeout=None):
+		return False, None
+
+class LoadedSSH:
+	def try_run(self, host, port, command, timeout=None):
+		return True, "loaded 40/40 blocks"
+
+class Recorder:
+	def __init__(self):
+		self.calls = []
+
+	def update(self, instance_id, **fields):
+		self.calls.append(("update", instance_id, fields))
+
+	def record_many(self, measurements):
+		self.calls.append(("record_many", measurements))
+
+class Heartbeats:
+	#just what report_heartbeat and record_reported_perf use of an InstanceSet
+	report_heartbeat = InstanceSet.report_heartbeat
+	record_reported_perf = InstanceSet.record_reported_perf
+
+	def __init__(self):
+		self.instance_info_map = {1 : {"mtoken" : "secret", "tps" : None}}
+		self.lock = Lock()
+		self.heartbeats = {}
+		self.heartbeat_tps = {}
+		self.instance_perf = {}
+		self.store = Recorder()
+		self.perf = Recorder()
+
+def test_test_prompt_gives_up_on_a_server_that_never_responds(monkeypatch):
+	server = socket.socket()
+	server.bind(("127.0.0.1", 0))
+	server.listen() #accepts connections but never reads or answers them
+	port = server.getsockname()[1]
+	instance = {"id" : 1, "public_ipaddr" : "127.0.0.1", "ports" : {"5000/tcp" : [{"HostPort" : str(port)}]}}
+	monkeypatch.setattr(autoscaler, "TEST_TIMEOUT", 0.5)
+	try:
+		t1 = time.time()
+		assert not InstanceSet.send_test_prompt(Probing(None), instance, "token")
+		assert time.time() - t1 < 5
+	finally:
+		server.close()
+
+def test_heartbeat_with_a_bad_master_token_is_unauthorized():
+	autoscaler = Heartbeats()
+	for mtoken in ["wrong", None, 5, ["secret"], {"mtoken" : "secret"}]:
+		assert handle_heartbeat(autoscaler, {"id" : 1, "mtoken" : mtoken}) == ("Unknown instance id or bad master token", 401)
+	assert handle_heartbeat(autoscaler, {"id" : 2, "mtoken" : "secret"})[1] == 401
+	assert handle_heartbeat(autoscaler, {"id" : "x", "mtoken" : "secret"})[1] == 401
+
+def test_heartbeat_tps_is_saved_with_the_next_perf_record():
+	autoscaler = Heartbeats()
+	for tps in [30.0, 31.0, 32.0]:
+		assert autoscaler.report_heartbeat(1, "secret", False, tps=tps)
+	assert autoscaler.store.calls == [] and autoscaler.perf.calls == [] #nothing on the request path
+	assert autoscaler.instance_info_map[1]["tps"] == 32.0
+	instance = {"id" : 1, "machine_id" : 7}
+	autoscaler.record_reported_perf({1 : instance})
+	assert autoscaler.store.calls == [("update", 1, {"tps" : 32.0})]
+	assert autoscaler.perf.calls == [("record_many", [(instance, {"tps" : 32.0})])]
+	autoscaler.record_reported_perf({1 : instance})
+	assert autoscaler.store.calls[1:] == []
+	assert autoscaler.perf.calls[1:] == [("record_many", [])]
+
+def test_probe_that_couldnt_get_an_ssh_slot_isnt_a_failure():
+	instance = {"id" : 1, "ssh_host" : "10.0.0.1", "ssh_port" : 22}
+	busy = Probing(BusySSH())
+	hot, latency = busy.probe_hot_instance(instance, "token")
+	assert hot is None and busy.tested == []
+	loaded = Probing(LoadedSSH())
+	hot, latency = loaded.probe_hot_instance(instance, "token")
+	assert hot is True and loaded.tested == [1]
@@ -0,0 +1,69 @@
+import random
+
+from indexed_heap import IndexedHeap
+
+def pop_all(heap):
+	keys = []
+	while len(heap) != 0:
+		_, key, _ = heap.peek()
+		heap.remove(key)
+		keys.append(key)
+	return keys
+
+def check_index(heap):
+	for key, i in heap.index.items():
+		assert heap.heap[i][1] == key
+	assert len(heap.index) == len(heap.heap)
+
+def test_orders_by_priority_then_key():
+	heap = IndexedHeap()
+	for key, priority in [("c", 2), ("a", 2), ("b", 1), ("d", 0)]:
+		heap.push(key, priority, None)
+	assert pop_all(heap) == ["d", "b", "a", "c"]
+
+def test_update_moves_entries_both_ways():
+	heap = IndexedHeap()
+	for key in range(10):
+		heap.push(key, key, str(key))
+	heap.update(9, -1)
+	heap.update(0, 100)
+	check_index(heap)
+	assert heap.peek() == (-1, 9, "9")
+	assert pop_all(heap) == [9, 1, 2, 3, 4, 5, 6, 7, 8, 0]
+
+def test_push_existing_key_updates_it():
+	heap = IndexedHeap()
+	heap.push("a", 5, 1)
+	heap.push("b", 3, 2)
+	heap.push("a", 1, 3)
+	assert len(heap) == 2
+	assert heap.peek() == (1, "a", 3)
+
+def test_remove_keeps_order():
+	heap = IndexedHeap()
+	for key in range(10):
+		heap.push(key, (key * 7) % 10, None)
+	for key in [0, 5, 3]:
+		heap.remove(key)
+		check_index(heap)
+		assert key not in heap
+	assert pop_all(heap) == sorted([1, 2, 4, 6, 7, 8, 9], key=lambda key: (key * 7) % 10)
+
+def test_random_updates_and_removes():
+	rand = random.Random(0)
+	heap = IndexedHeap()
+	expected = {}
+	for _ in range(2000):
+		key = rand.randrange(50)
+		op = rand.random()
+		if key in expected and op < 0.3:
+			heap.remove(key)
+			del expected[key]
+		elif key in expected and op < 0.6:
+			expected[key] = rand.randrange(100)
+			heap.update(key, expected[key])
+		else:
+			expected[key] = rand.randrange(100)
+			heap.push(key, expected[key], None)
+		check_index(heap)
+	assert pop_all(heap) == sorted(expected, key=lambda key: (expected[key], key))
@@ -0,0 +1,151 @@
+import loadbalancer
+from loadbalancer import LoadBalancer, FULL_LOAD_THRESHOLD
+
+TPS = 10.0 #every instance serves this many tokens/s, so a lease of n tokens costs n / TPS seconds
+
+class StubClient:
+	def __init__(self, hot_instances=()):
+		self.hot_instances = list(hot_instances)
+		self.reports = []
+
+	def setup_autoscaler(self, autoscaler_args):
+		pass
+
+	def get_hot_instances(self, wait=0):
+		return self.hot_instances
+
+	def hot_perf(self):
+		#as the autoscaler server returns it from /report, with the ids as strings
+		return {str(instance["id"]) : {"tokens/s" : None, "expected_tps" : TPS} for instance in self.hot_instances}
+
+	def report_hot_busy(self, **load):
+		self.reports.append(load)
+		return self.hot_perf()
+
+class StubInstanceClient:
+	def __init__(self, instance_id, instance_addr, mtoken):
+		self.instance_id = instance_id
+
+	def take_token(self):
+		return f"token-{self.instance_id}"
+
+def hot_instance(id):
+	return {"id" : id, "public_ipaddr" : "127.0.0.1", "ports" : {"5000/tcp" : [{"HostPort" : str(5000 + id)}]}, "mtoken" : "m"}
+
+def make_lb(ids):
+	t = [0.0]
+	client = StubClient([hot_instance(id) for id in ids])
+	lb = LoadBalancer({"streaming" : False, "model" : "vllm-13"}, client=client, instance_client=StubInstanceClient, clock=lambda: t[0], background=False)
+	lb.throughput.observe_perf(client.hot_perf())
+	return lb, client, t
+
+def test_new_instances_dont_count_as_busy():
+	lb, client, t = make_lb([1, 2])
+	lb.tick_duration()
+	#two more instances turn hot and are immediately loaded well past busy, while the first two stay idle
+	client.hot_instances += [hot_instance(3), hot_instance(4)]
+	lb.update_hot_queue()
+	for id in (3, 4):
+		lb.hot_queue.update(id, 10 * FULL_LOAD_THRESHOLD)
+	lb.tick_duration()
+	report = client.reports[-1]
+	assert report["num_hot"] == 2
+	assert report["num_busy"] == 0
+	assert report["instance_load"] == {1 : 0, 2 : 0}
+	assert report["capacity"] == 2 * TPS
+	lb.tick_duration()
+	report = client.reports[-1]
+	assert report["num_hot"] == 4
+	assert report["num_busy"] <= report["num_hot"]
+
+def lease(lb, num_tokens=50):
+	addr, token, lease_id = lb.get_next_addr(num_tokens)
+	assert addr is not None
+	return lease_id, int(token.split("-")[1])
+
+def test_leases_go_to_the_least_loaded_instance():
+	lb, client, t = make_lb([1, 2])
+	assert set(lease(lb)[1] for _ in range(2)) == {1, 2}
+	assert lb.hot_queue.priority(1) == lb.hot_queue.priority(2) == 50 / TPS
+
+def test_release_takes_work_off_the_queue():
+	lb, client, t = make_lb([1])
+	lb.tick_duration()
+	lease_id, id = lease(lb)
+	assert lb.hot_queue.priority(1) == 50 / TPS
+	lb.tick_duration()
+	assert client.reports[-1]["num_in_flight"] == 1
+	assert client.reports[-1]["queue_depth"] == 50
+	assert client.reports[-1]["instance_load"] == {1 : 1}
+	assert lb.release(lease_id, 50, 4.0)
+	assert lb.hot_queue.priority(1) == 0
+	assert not lb.release(lease_id) #releasing twice
+	lb.tick_duration()
+	assert client.reports[-1]["num_in_flight"] == 0
+	assert client.reports[-1]["queue_depth"] == 0
+
+def test_overdue_lease_comes_off_the_queue_but_stays_in_flight():
+	lb, client, t = make_lb([1])
+	lb.tick_duration()
+	lease_id, id = lease(lb)
+	#nothing has completed on the instance yet, so the lease is expected to take UNMEASURED_LATENCY_FACTOR times its cost
+	due = loadbalancer.LEASE_OVERDUE_FACTOR * loadbalancer.UNMEASURED_LATENCY_FACTOR * 50 / TPS
+	assert lb.lease_due.priority(lease_id) == due
+	t[0] = due - 1
+	lb.tick_duration()
+	assert client.reports[-1]["queue_depth"] == 50
+	t[0] = due
+	lb.tick_duration()
+	assert lb.hot_queue.priority(1) == 0
+	assert lease_id not in lb.lease_due
+	assert client.reports[-1]["queue_depth"] == 0
+	assert client.reports[-1]["num_in_flight"] == 1
+	#a late release still ends the lease, without taking its work off the queue a second time
+	lease(lb, 20)
+	assert lb.release(lease_id)
+	assert lb.hot_queue.priority(1) == 20 / TPS
+	assert lb.in_flight[1] == 1
+
+def test_unreleased_lease_expires():
+	lb, client, t = make_lb([1])
+	lb.tick_duration()
+	lease_id, id = lease(lb)
+	t[0] = loadbalancer.LEASE_TIMEOUT - 1
+	lb.tick_duration()
+	assert client.reports[-1]["num_in_flight"] == 1
+	t[0] = loadbalancer.LEASE_TIMEOUT
+	lb.tick_duration()
+	assert client.reports[-1]["num_in_flight"] == 0
+	assert lease_id not in lb.leases
+	assert not lb.release(lease_id)
+
+def test_removed_instance_drops_its_leases():
+	lb, client, t = make_lb([1, 2])
+	lb.tick_duration()
+	leases = dict(lease(lb) for _ in range(4))
+	assert sorted(leases.values()) == [1, 1, 2, 2]
+	client.hot_instances = [hot_instance(2)]
+	lb.update_hot_queue()
+	assert 1 not in lb.hot_queue and 1 not in lb.in_flight
+	assert sorted(lb.leases) == sorted(lease_id for lease_id, id in leases.items() if id == 2)
+	assert sorted(lb.lease_due.keys()) == sorted(lb.leases)
+	#the same id coming back starts from an empty queue, and late releases of its old leases change nothing
+	client.hot_instances = [hot_instance(1), hot_instance(2)]
+	lb.update_hot_queue()
+	for lease_id, id in leases.items():
+		assert lb.release(lease_id) == (id == 2)
+	assert lb.hot_queue.priority(1) == 0
+	assert lb.hot_queue.priority(2) == 0
+	assert lb.in_flight.get(1, 0) == 0
+	lb.tick_duration()
+	lb.tick_duration()
+	assert client.reports[-1]["num_in_flight"] == 0
+	assert client.reports[-1]["num_hot"] == 2
+
+def test_reported_perf_sets_routing_weights():
+	lb, client, t = make_lb([1, 2])
+	assert lb.throughput.tps(1) == TPS #expected_tps from the first report replaces the prior
+	t[0] = 100.0
+	lb.throughput.observe_perf({"1" : {"tokens/s" : 3 * TPS, "expected_tps" : 5 * TPS}, "2" : {"tokens/s" : None, "expected_tps" : 5 * TPS}})
+	assert TPS < lb.throughput.tps(1) < 3 * TPS #reported tokens/s nudges it, a later expectation doesn't reset it
+	assert lb.throughput.tps(2) == TPS
@@ -0,0 +1,41 @@
+from offer_cache import OfferCache
+
+GET_CONFIG = {"gpu" : [{"name" : "RTX 4090", "num_gpus" : 1}], "disk_space" : 50}
+
+class FakeApi:
+	def __init__(self):
+		self.queries = []
+		self.offers = [{"id" : 1, "dph_total" : 0.5, "dlperf_per_dphtotal" : 40.0}, {"id" : 2, "dph_total" : 0.3, "dlperf_per_dphtotal" : 20.0}]
+
+	def search_offers(self, query):
+		self.queries.append(query)
+		return self.offers
+
+def orders_searched(api):
+	return sorted(set(str(query.get("order")) for query in api.queries))
+
+def test_prewarm_only_searches_the_rankings_in_use():
+	api = FakeApi()
+	cache = OfferCache(api, GET_CONFIG, background=False)
+	cache.refresh_stale()
+	assert len(api.queries) == 1
+	assert [offer["id"] for offer in cache.get(True)] == [2, 1]
+	assert len(api.queries) == 1 #served from the cache
+	cache.stop()
+
+def test_without_background_stale_offers_are_searched_again():
+	api = FakeApi()
+	cache = OfferCache(api, GET_CONFIG, ttl=0, background=False)
+	assert cache.bt is None
+	assert [offer["id"] for offer in cache.get(True)] == [2, 1]
+	api.offers = None #the marketplace search fails
+	assert [offer["id"] for offer in cache.get(True)] == [2, 1]
+	assert len(api.queries) == 2
+	cache.stop()
+
+def test_dropped_offers_are_left_out():
+	api = FakeApi()
+	cache = OfferCache(api, GET_CONFIG, background=False)
+	cache.drop_offer(2)
+	assert [offer["id"] for offer in cache.get(True)] == [1]
+	cache.stop()
@@ -0,0 +1,36 @@
+import json
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+
+from prompt_OOBA import send_vllm_request_auth
+
+def serve_auth(requests):
+	class Handler(BaseHTTPRequestHandler):
+		def do_POST(self):
+			requests.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+			body = json.dumps({"response" : "hi", "error" : None, "num_tokens" : 2}).encode("utf-8")
+			self.send_response(200)
+			self.send_header("Content-Type", "application/json")
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			pass
+
+	server = HTTPServer(("127.0.0.1", 0), Handler)
+	Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+def test_max_new_tokens_is_sent_only_when_given():
+	requests = []
+	server = serve_auth(requests)
+	addr = f"127.0.0.1:{server.server_address[1]}"
+	try:
+		assert send_vllm_request_auth(addr, "token", "hello", timeout=5, max_new_tokens=50)["num_tokens"] == 2
+		assert send_vllm_request_auth(addr, "token", "hello", timeout=5)["error"] is None
+	finally:
+		server.shutdown()
+		server.server_close()
+	assert requests[0] == {"token" : "token", "model" : {"prompt" : "hello", "max_new_tokens" : 50}}
+	assert requests[1] == {"token" : "token", "model" : {"prompt" : "hello"}}
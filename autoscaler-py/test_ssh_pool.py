@@ -0,0 +1,11 @@
+from ssh_pool import SSHPool
+
+def test_busy_pool_doesnt_send_the_command():
+	pool = SSHPool(max_concurrency=1)
+	pool.semaphore.acquire() #the only slot is taken by a command on another host
+	try:
+		assert pool.try_run("10.0.0.1", 22, "true", timeout=0.01) == (False, None)
+		assert pool.run("10.0.0.1", 22, "true", timeout=0.01) is None
+		assert pool.sessions == {}
+	finally:
+		pool.semaphore.release()
@@ -0,0 +1,41 @@
+import json
+
+from state_snapshot import SnapshotPublisher, hot_projection
+
+def test_only_changes_get_a_new_version():
+	publisher = SnapshotPublisher({"hot_instances" : []})
+	first = publisher.current
+	assert publisher.publish({"hot_instances" : []}) is first
+	second = publisher.publish({"hot_instances" : [{"id" : 1}]})
+	assert second.version == first.version + 1
+	assert json.loads(second.body) == {"version" : second.version, "hot_instances" : [{"id" : 1}]}
+
+def test_since_matches_version_and_etag():
+	publisher = SnapshotPublisher({"num_hot" : 0})
+	snapshot = publisher.current
+	assert snapshot.etag == f"\"{snapshot.version}\""
+	assert snapshot.matches(snapshot.version)
+	assert snapshot.matches(str(snapshot.version))
+	assert snapshot.matches(snapshot.etag)
+	assert snapshot.matches("W/" + snapshot.etag)
+	assert not snapshot.matches(None)
+	assert not snapshot.matches(snapshot.version - 1)
+	assert not snapshot.matches(f"\"{snapshot.version - 1}\"")
+
+def test_wait_returns_right_away_unless_up_to_date():
+	publisher = SnapshotPublisher({"num_hot" : 0})
+	old = publisher.current
+	new = publisher.publish({"num_hot" : 1})
+	assert publisher.wait(old.version, 30) is new
+	assert publisher.wait(None, 30) is new
+	assert publisher.wait(new.etag, 0) is new #no timeout, so no waiting
+
+def test_hot_set_version_ignores_performance():
+	instance = {"id" : 1, "public_ipaddr" : "1.2.3.4", "ports" : {"5000/tcp" : [{"HostPort" : "5000"}]}, "gpu_name" : "RTX 4090", "num_gpus" : 1}
+	publisher = SnapshotPublisher({"hot_instances" : [hot_projection(instance, "m")]})
+	first = publisher.current
+	#a new heartbeat's tokens/s and queue depth, as InstanceSet keeps them on its hot instances
+	busier = dict(instance, **{"tokens/s" : 80.0, "queue_depth" : 7})
+	assert publisher.publish({"hot_instances" : [hot_projection(busier, "m")]}) is first
+	moved = dict(instance, public_ipaddr="5.6.7.8")
+	assert publisher.publish({"hot_instances" : [hot_projection(moved, "m")]}).version == first.version + 1
@@ -0,0 +1,137 @@
+import time
+from threading import Lock
+
+from ratio_manager import update_rolling_average
+
+DEFAULT_TPS = 35.0 #tokens/s of one RTX 3090 serving the 13B model
+MIN_TPS = 1.0
+#rough speed of each gpu type relative to an RTX 3090, only used until an instance has been measured
+GPU_SPEED = {
+	"RTX 3090" : 1.0,
+	"RTX 3090 Ti" : 1.1,
+	"RTX 4080" : 1.2,
+	"RTX 4090" : 1.6,
+	"RTX A5000" : 0.8,
+	"RTX A6000" : 1.0,
+	"A40" : 0.9,
+	"L40" : 1.4,
+	"A100 PCIE" : 1.8,
+	"A100 SXM4" : 2.0,
+	"H100 PCIE" : 2.6,
+	"H100 SXM" : 3.2,
+}
+MODEL_SCALE = {"vllm-13" : 1.0, "vllm-70" : 0.2, "dev" : 1.0} #relative cost per token of each model
+GPU_SCALING = 0.75 #multi-gpu instances don't scale linearly: capacity grows as num_gpus ** GPU_SCALING
+HEARTBEAT_DECAY = 0.05
+CAPACITY_DECAY = 0.1
+LATENCY_DECAY = 0.2
+
+def prior_tps(instance, model=None):
+	gpu_speed = GPU_SPEED.get(instance.get("gpu_name"), 1.0)
+	num_gpus = instance.get("num_gpus") or 1
+	return DEFAULT_TPS * MODEL_SCALE.get(model, 1.0) * gpu_speed * (num_gpus ** GPU_SCALING)
+
+class InstanceThroughput:
+	def __init__(self, tps, clock):
+		self.tps = tps #estimated tokens/s the instance can sustain across all of its concurrent requests
+		self.latency = None #average seconds per completed request
+		self.ttft = None #average seconds to the first token, for clients that report it
+		self.request_tps = None #average tokens/s seen by a single request
+		self.num_completions = 0
+		self.tokens_done = 0 #completed since the last tick
+		self.measured = False
+		self.seeded = False #whether tps has been set from what the autoscaler expects of the instance
+		self.last_update = clock()
+
+#Online per-instance throughput and latency estimates for the load balancer. Each instance starts from what the
+#autoscaler expects of it (its benchmark, or its machine's history), else a prior based on its gpus and the model. It is
+#nudged by the tokens/s its model server reports to the autoscaler (both passed on by observe_perf after each load report),
+#and is then measured from client completion reports:
+#while an instance has a backlog its completed tokens per second is its capacity, and a single request's tokens/s is
+#always a lower bound on it.
+class ThroughputModel:
+	def __init__(self, model=None, clock=time.time):
+		self.model = model
+		self.clock = clock
+		self.instances = {}
+		self.lock = Lock()
+
+	def observe_instance(self, instance):
+		with self.lock:
+			if instance["id"] not in self.instances:
+				self.instances[instance["id"]] = InstanceThroughput(prior_tps(instance, self.model), self.clock)
+
+	def observe_perf(self, hot_perf):
+		#hot_perf is what the autoscaler answers a load report with: instance id -> {"tokens/s" : reported by its model
+		#server, "expected_tps" : from its benchmark or machine history}. Measured instances ignore both.
+		with self.lock:
+			now = self.clock()
+			for id, perf in hot_perf.items():
+				entry = self.instances.get(int(id))
+				if entry is None or entry.measured:
+					continue
+				if perf.get("expected_tps") and not entry.seeded:
+					entry.tps = perf["expected_tps"]
+					entry.seeded = True
+				if perf.get("tokens/s"):
+					entry.tps = update_rolling_average(entry.tps, perf["tokens/s"], now - entry.last_update, HEARTBEAT_DECAY)
+					entry.last_update = now
+
+	def forget(self, id):
+		with self.lock:
+			self.instances.pop(id, None)
+
+	def tps(self, id):
+		entry = self.instances.get(id)
+		return entry.tps if entry is not None else DEFAULT_TPS * MODEL_SCALE.get(self.model, 1.0)
+
+	def cost(self, id, num_tokens):
+		#seconds of the instance's capacity that num_tokens of work takes up
+		return num_tokens / self.tps(id)
+
+	def record_completion(self, id, num_tokens, latency, ttft=None):
+		with self.lock:
+			entry = self.instances.get(id)
+			if entry is None or latency <= 0:
+				return
+			if ttft is not None:
+				entry.ttft = ttft if entry.ttft is None else entry.ttft + LATENCY_DECAY * (ttft - entry.ttft)
+			entry.num_completions += 1
+			entry.tokens_done += num_tokens
+			request_tps = num_tokens / latency
+			if entry.latency is None:
+				entry.latency = latency
+				entry.request_tps = request_tps
+			else:
+				entry.latency += LATENCY_DECAY * (latency - entry.latency)
+				entry.request_tps += LATENCY_DECAY * (request_tps - entry.request_tps)
+			entry.tps = max(entry.tps, request_tps)
+
+	def expected_latency(self, id, num_tokens):
+		#seconds a single request of num_tokens has been taking on the instance, or None before any have completed
+		entry = self.instances.get(id)
+		if entry is None or entry.request_tps is None:
+			return None
+		return num_tokens / entry.request_tps
+
+	def tick(self, saturated_ids, elapsed):
+		#saturated_ids had work queued for the whole of the last elapsed seconds, so what they finished is their capacity
+		with self.lock:
+			now = self.clock()
+			for id, entry in self.instances.items():
+				if id in saturated_ids and entry.tokens_done > 0:
+					entry.tps = max(MIN_TPS, update_rolling_average(entry.tps, entry.tokens_done / elapsed, elapsed, CAPACITY_DECAY))
+					entry.measured = True
+					entry.last_update = now
+				entry.tokens_done = 0
+
+	def measurements(self, ids):
+		#what has actually been measured of each instance, for the autoscaler's machine performance database. Capacity
+		#estimates that are still the prior or the model server's own report are left out.
+		with self.lock:
+			measured = {}
+			for id in ids:
+				entry = self.instances.get(id)
+				if entry is not None and (entry.measured or entry.ttft is not None):
+					measured[id] = {"tps" : entry.tps if entry.measured else None, "ttft" : entry.ttft}
+			return measured
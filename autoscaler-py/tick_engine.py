@@ -0,0 +1,71 @@
+import asyncio
+import time
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+
+from prom_metrics import REGISTRY
+
+MAX_CONCURRENCY = 100
+
+CALL_SECONDS = REGISTRY.histogram("tick_engine_call_seconds", "How long a tick waited for each call that finished within its deadline", ["op"])
+LATE_CALLS = REGISTRY.counter("tick_engine_late_calls_total", "Calls that missed their deadline and were left running for a later tick", ["op"])
+FAILED_CALLS = REGISTRY.counter("tick_engine_failed_calls_total", "Calls that raised", ["op"])
+
+#Runs the autoscaler's blocking api calls and probes on a shared thread pool, driven from one asyncio event loop.
+#Every call has a hard deadline. A call that misses its deadline keeps running, and its result is handed to whoever
+#makes the same call (same key) on a later tick, so one hung host never holds up the rest of the tick.
+class TickEngine:
+	def __init__(self, max_concurrency=MAX_CONCURRENCY):
+		self.max_concurrency = max_concurrency
+		self.loop = asyncio.new_event_loop()
+		self.executor = ThreadPoolExecutor(max_concurrency)
+		self.semaphore = None #created on the loop's own thread
+		self.pending = {} #key -> task still running from an earlier tick
+
+		self.thread = Thread(target=self.loop.run_forever, daemon=True)
+		self.thread.start()
+
+	def submit(self, coro): #from other threads, returns a concurrent.futures.Future
+		return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+	def run(self, coro, timeout=None): #from other threads, blocks until coro is done
+		return self.submit(coro).result(timeout)
+
+	async def run_bounded(self, fn, *args):
+		if self.semaphore is None:
+			self.semaphore = asyncio.Semaphore(self.max_concurrency)
+		async with self.semaphore:
+			return await self.loop.run_in_executor(self.executor, fn, *args)
+
+	async def call(self, key, deadline, fn, *args):
+		#returns (True, result) if fn finished within deadline seconds, otherwise (False, None)
+		t1 = time.time()
+		task = self.pending.pop(key, None)
+		if task is None:
+			task = asyncio.ensure_future(self.run_bounded(fn, *args))
+		try:
+			result = await asyncio.wait_for(asyncio.shield(task), deadline)
+		except asyncio.TimeoutError:
+			self.pending[key] = task
+			LATE_CALLS.labels(key[0]).inc()
+			return False, None
+		except Exception as e:
+			print(f"[tick_engine] call {key} failed: {e}")
+			FAILED_CALLS.labels(key[0]).inc()
+			return False, None
+		CALL_SECONDS.labels(key[0]).observe(time.time() - t1)
+		return True, result
+
+	async def call_many(self, keys, deadline, fn, *arg_lists):
+		return await asyncio.gather(*[self.call(key, deadline, fn, *args) for key, args in zip(keys, zip(*arg_lists))])
+
+	def prune(self, keep):
+		#drops late results for keys that won't be asked for again, e.g. instances that have gone away
+		for key in list(self.pending.keys()):
+			if not keep(key):
+				del self.pending[key]
+
+	def stop(self):
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+		self.executor.shutdown(wait=False)
@@ -0,0 +1,131 @@
+import os
+import re
+import json
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from prom_metrics import REGISTRY
+
+VAST_API_URL = os.environ.get("VAST_API_URL", "https://console.vast.ai/api/v0")
+API_KEY_PATHS = ["~/.config/vastai/vast_api_key", "~/.vast_api_key"]
+POOL_SIZE = 100
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 15.0
+NUM_RETRIES = 3
+BACKOFF_FACTOR = 0.25
+
+#same defaults that 'vastai search offers' applies on top of the user query
+DEFAULT_OFFER_QUERY = {"verified": {"eq": True}, "external": {"eq": False}, "rentable": {"eq": True}, "rented": {"eq": False}}
+OFFER_ORDER_FIELDS = {"dph" : "dph_total", "dlperf_per_dphtotal" : "dlperf_per_dphtotal"}
+
+REQUEST_SECONDS = REGISTRY.histogram("vast_api_request_seconds", "Vast API calls, including retries", ["method", "endpoint", "outcome"])
+
+def read_api_key():
+	if "VAST_API_KEY" in os.environ:
+		return os.environ["VAST_API_KEY"]
+	for path in API_KEY_PATHS:
+		path = os.path.expanduser(path)
+		if os.path.exists(path):
+			with open(path, "r") as f:
+				return f.read().strip()
+	return None
+
+def parse_env(env_str):
+	#turns "-e A=1 -e B='x y'" into {"A": "1", "B": "x y"}, like the vastai CLI does
+	env = {}
+	for arg in env_str.split("-e ")[1:]:
+		arg = arg.strip()
+		if "=" not in arg:
+			continue
+		key, value = arg.split("=", 1)
+		env[key] = value.strip("'\"")
+	return env
+
+def build_offer_query(gpu_config, disk_space, order):
+	query = dict(DEFAULT_OFFER_QUERY)
+	if "gpu_name" in gpu_config.keys():
+		query["gpu_name"] = {"eq" : gpu_config["gpu_name"].replace("_", " ")}
+	if "num_gpus" in gpu_config.keys():
+		query["num_gpus"] = {"eq" : gpu_config["num_gpus"]}
+	if "gpu_ram" in gpu_config.keys():
+		query["gpu_ram"] = {"gte" : gpu_config["gpu_ram"] * 1000} #the marketplace stores gpu_ram in MB
+	query["disk_space"] = {"gte" : disk_space}
+	direction = "asc" if order == "dph" else "desc"
+	query["order"] = [[OFFER_ORDER_FIELDS.get(order, order), direction]]
+	query["type"] = "on-demand"
+	return query
+
+class VastClient:
+	def __init__(self, api_url=VAST_API_URL, api_key=None, pool_size=POOL_SIZE, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), retries=NUM_RETRIES):
+		self.api_url = api_url.rstrip("/")
+		self.api_key = api_key if api_key is not None else read_api_key()
+		self.timeout = timeout
+
+		#keep-alive pools shared by every thread, so each call reuses an open TLS connection
+		retry = Retry(total=retries, backoff_factor=BACKOFF_FACTOR, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=None, raise_on_status=False)
+		self.session = self.make_session(pool_size, retry)
+		#creating an instance is not idempotent, so only retry when the request never reached the server
+		create_retry = Retry(total=retries, connect=retries, read=0, status=0, other=0, backoff_factor=BACKOFF_FACTOR, allowed_methods=None, raise_on_status=False)
+		self.create_session = self.make_session(pool_size, create_retry)
+
+	def make_session(self, pool_size, retry):
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+		session = requests.Session()
+		session.mount("http://", adapter)
+		session.mount("https://", adapter)
+		if self.api_key is not None:
+			session.headers["Authorization"] = f"Bearer {self.api_key}"
+		return session
+
+	def request(self, method, path, timeout=None, session=None, **kwargs):
+		URI = f"{self.api_url}{path}"
+		session = session if session is not None else self.session
+		endpoint = re.sub(r"/\d+/", "/{id}/", path)
+		t1 = time.time()
+		try:
+			response = session.request(method, URI, timeout=timeout if timeout is not None else self.timeout, **kwargs)
+		except requests.exceptions.RequestException as e:
+			REQUEST_SECONDS.labels(method, endpoint, "error").observe(time.time() - t1)
+			print(f"[vast_api] {method} {path} failed: {e}")
+			return None
+		REQUEST_SECONDS.labels(method, endpoint, str(response.status_code)).observe(time.time() - t1)
+		if response.status_code != 200:
+			print(f"[vast_api] {method} {path} returned status code: {response.status_code}")
+			return None
+		try:
+			return response.json()
+		except json.decoder.JSONDecodeError:
+			return None
+
+	def show_instances(self, timeout=None):
+		response = self.request("GET", "/instances/", timeout=timeout, params={"owner" : "me"})
+		if response is None:
+			return None
+		return response.get("instances")
+
+	def search_offers(self, query, timeout=None):
+		response = self.request("GET", "/bundles/", timeout=timeout, params={"q" : json.dumps(query)})
+		if response is None:
+			return None
+		return response.get("offers")
+
+	def start_instance(self, instance_id, timeout=None):
+		response = self.request("PUT", f"/instances/{instance_id}/", timeout=timeout, json={"state" : "running"})
+		return response is not None and response.get("success", False)
+
+	def stop_instance(self, instance_id, timeout=None):
+		response = self.request("PUT", f"/instances/{instance_id}/", timeout=timeout, json={"state" : "stopped"})
+		return response is not None and response.get("success", False)
+
+	def destroy_instance(self, instance_id, timeout=None):
+		response = self.request("DELETE", f"/instances/{instance_id}/", timeout=timeout, json={})
+		return response is not None and response.get("success", False)
+
+	def create_instance(self, ask_id, image, disk, env, onstart_cmd=None, timeout=None):
+		request_dict = {"client_id" : "me", "image" : image, "disk" : float(disk), "env" : env, "onstart" : onstart_cmd, "runtype" : "ssh"}
+		response = self.request("PUT", f"/asks/{ask_id}/", timeout=timeout, session=self.create_session, json=request_dict)
+		if response is not None and response.get("success", False):
+			return response["new_contract"]
+		return None